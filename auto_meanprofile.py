@@ -19,6 +19,8 @@ from podi_definitions import *
 from profile import *
 from meanprofile import *
 import podi_logging
+import podi_catalogcache
+import podi_makecatalogs
 import logging
 import scipy
 import scipy.spatial
@@ -70,6 +72,20 @@ def write_readme_file(hdulist, readme_file, infilename, starcat):
 
 
 
+def needs_source_catalog(infilename):
+    # ODI frames come with their own source catalog
+    hdr = pyfits.getheader(infilename)
+    return not ('INSTRUME' in hdr and hdr['INSTRUME'] == 'podi')
+
+
+
+def psf_sextractor_job(fitsfile):
+    return podi_makecatalogs.sextractor_job(
+        fitsfile, catfile=fitsfile[:-5]+".cat",
+        sex_config="wcsfix.sex", sex_param="wcsfix.sexparam")
+
+
+
 def create_psf_profiles(infilename, outdir_base, width):
 
     #
@@ -113,38 +129,18 @@ def create_psf_profiles(infilename, outdir_base, width):
         logger.info("This is not a ODI frame, running source extractor")
         fitsfile = infilename 
         catfile = infilename[:-5]+".cat" 
-        sex_config_file = "%s/config/wcsfix.sex" % (sitesetup.exec_dir)
-        parameters_file = "%s/config/wcsfix.sexparam" % (sitesetup.exec_dir)
-        sexcmd = "%s -c %s -PARAMETERS_NAME %s -CATALOG_NAME %s %s" % (
-            sitesetup.sextractor, sex_config_file, parameters_file, catfile, 
-            fitsfile)
-        logger.debug("Sextractor command:\n%s" % (sexcmd))
-
-        if (not os.path.isfile(catfile)):
+
+        job = psf_sextractor_job(fitsfile)
+        if (not podi_makecatalogs.catalog_is_current(job)):
             logger.debug("Running SourceExtractor")
-            start_time = time.time()
-            try:
-                ret = subprocess.Popen(sexcmd.split(), 
-                                       stdout=subprocess.PIPE, 
-                                       stderr=subprocess.PIPE)
-                (sex_stdout, sex_stderr) = ret.communicate()
-                #os.system(sexcmd)
-                if (ret.returncode != 0):
-                    logger.warning("Sextractor might have a problem, check the log")
-                    logger.debug("Stdout=\n"+sex_stdout)
-                    logger.debug("Stderr=\n"+sex_stderr)
-            except OSError as e:
-                podi_logging.log_exception()
-                print >>sys.stderr, "Execution failed:", e
-                end_time = time.time()
-                logger.debug("SourceExtractor returned after %.3f seconds" % (end_time - start_time))
+            podi_makecatalogs.run_job(job)
         else:
             logger.debug("Reusing existing source catalog!")
 
         try:
             with warnings.catch_warnings():
                 warnings.simplefilter("ignore")
-                source_cat = numpy.loadtxt(catfile)
+                source_cat = podi_catalogcache.load_catalog(catfile, fitsfile)
         except IOError:
             logger.error("The Sextractor catalog is empty, ignoring this OTA")
             sys.exit(0)
@@ -369,7 +365,13 @@ if __name__ == "__main__":
     max_radius = float(cmdline_arg_set_or_default("-maxr", 5.0))
     width = 50
 
-    for infilename in get_clean_cmdline()[1:]:
+    # Run SourceExtractor on all non-ODI frames in parallel before starting
+    inputlist = get_clean_cmdline()[1:]
+    podi_makecatalogs.CatalogService().run(
+        [psf_sextractor_job(fn) for fn in inputlist
+         if os.path.isfile(fn) and needs_source_catalog(fn)])
+
+    for infilename in inputlist:
         # infilename = get_clean_cmdline()[1]
         create_psf_profiles(infilename, outdir_base, width)
 
@@ -1,114 +1,217 @@
 #!/usr/bin/env python
 
-import os, sys, numpy
-
-import podi_ephemerides as ephem
-import multiprocessing
+"""
 
+Fetch ephemerides for a list of comets/asteroids from NASA Horizons.
 
-def handler(queue, **kwargs):
-
-    # print kwargs
-
-    ephemdata = None
-    # print "querying MPC"
-
-    ephemdata = ephem.get_ephemerides_for_object(**kwargs)
-    #     object_name=object_name,
-    #     start_datetime=start_datetime,
-    #     end_datetime=end_datetime,
-    #     time_interval=time_interval,
-    #     session_log_file=log_file,
-    #     verbose=False,
-    # )
+Objects are queried by a bounded pool of concurrent Horizons sessions. Failed
+queries (time-outs, dropped connections) are retried with exponential
+backoff. The outcome of each object is appended to a progress file in the
+output directory, so an interrupted run can simply be started again and
+continues with the objects that are still missing. All results also go
+through the shared ephemeris cache of podi_ephemerides.
 
-    queue.put(ephemdata)
+Usage:
+  bulk_query.py comet_list.txt [output_dir]
+      -start=2017-12-10 -end=2018-01-15 -step=6h
+      -workers=4 -timeout=60 -retries=3
+      -horizons=host:port
+      -progress=bulk_query.progress
 
-    return
+"""
 
-def query_horizons(timeout, **kwargs):
+from __future__ import print_function
 
-    queue = multiprocessing.Queue()
+import os, sys, numpy
+import time
+import socket
 
-    kwargs['queue'] = queue
-    #kwargs['verbose'] = True
+import podi_ephemerides as ephem
+import multiprocessing
+from podi_commandline import *
 
-    p = multiprocessing.Process(target=handler, kwargs=kwargs)
-    p.start()
-    p.join(timeout)
-    if (p.is_alive()):
-        print "Terminating task after timeout"
-        p.terminate()
-        results = None
-    else:
-        results = queue.get()
+progress_done = "done"
+progress_notfound = "notfound"
+progress_failed = "failed"
 
-    # print kwargs
 
-    return results
+def read_object_list(fn):
+    """
 
-if __name__ == "__main__":
+    Read the object names from a fixed-width comet list, and work out a file
+    name for each.
 
-    start_datetime = '2017-12-10'
-    end_datetime = '2018-01-15'
-    time_interval = '6h'
+    """
 
-    fn = sys.argv[1]
     with open(fn, "r") as f:
         comets = f.readlines()
 
-    try:
-        output_dir = sys.argv[2]
-    except:
-        output_dir = "."
-        pass
-
-    timeout = 60
-
+    objects = []
     for line_number, line in enumerate(comets):
-        if (line_number < 583):
-            continue
-
         name = line[102:158]
         # print name
 
         object_name = " ".join(name.split(' ')[:2])
         if (object_name.find('/') >= 0):
             object_name = object_name.split("/")[0]
-            print "REFINED:", object_name
+            print("REFINED:", object_name)
 
         save_filename = name.strip()
         for c in [' ', '/', '(', ')', ' ']:
             save_filename = save_filename.replace(c, '_')
-        print "% 4d :: %50s ==> %s" %(line_number, name, save_filename)
-
         if (save_filename[-1] == "_"): save_filename = save_filename[:-1]
-        log_file = "%s/%s.log" % (output_dir, save_filename)
-        ephem_file = "%s/%s.ephem" % (output_dir, save_filename)
-
-        ephemdata = query_horizons(timeout=timeout,
-                                   object_name = object_name,
-                                   start_datetime = start_datetime,
-                                   end_datetime = end_datetime,
-                                   time_interval = time_interval,
-                                   session_log_file=log_file,
-                                   verbose=False,
-                                   )
-
-        # ephemdata = ephem.get_ephemerides_for_object(
-        #     object_name = object_name,
-        #     start_datetime = start_datetime,
-        #     end_datetime = end_datetime,
-        #     time_interval = time_interval,
-        #     session_log_file=log_file,
-        #     verbose=False,
-        #     )
-
-        if (ephemdata is not None):
-            numpy.savetxt(ephem_file, ephemdata['data'])
-        #with open(save_filename, "w") as ef:
-        #    ef.write(ephemdata)
-
-
-        # break
-            
+        print("% 4d :: %50s ==> %s" %(line_number, name, save_filename))
+
+        objects.append((object_name, save_filename))
+
+    return objects
+
+
+def read_progress(progress_file):
+    """
+
+    Return the status of all objects completed in earlier runs.
+
+    """
+
+    progress = {}
+    if (not os.path.isfile(progress_file)):
+        return progress
+
+    with open(progress_file, "r") as pf:
+        for line in pf:
+            items = line.rstrip("\n").split("\t")
+            if (len(items) >= 2):
+                progress[items[0]] = items[1]
+    return progress
+
+
+def handler(job):
+    """
+
+    Fetch the ephemeris for one object, retrying with exponential backoff.
+    Returns the object's file name, its status and a short message.
+
+    """
+
+    object_name = job['object_name']
+    save_filename = job['save_filename']
+    retries = job['retries']
+    backoff = job['backoff']
+    kwargs = job['query']
+
+    ephemdata = None
+    message = ""
+    for attempt in range(retries+1):
+        if (attempt > 0):
+            time.sleep(backoff * 2**(attempt-1))
+        try:
+            ephemdata = ephem.get_ephemerides_for_object(object_name=object_name, **kwargs)
+        except (IOError, EOFError, socket.error, ValueError) as e:
+            # Network problems, or a reply we could not parse
+            message = "attempt %d: %s" % (attempt+1, str(e))
+            continue
+
+        if (ephemdata is None):
+            return save_filename, progress_notfound, ""
+
+        numpy.savetxt(job['ephem_file'], ephemdata['data'])
+        return save_filename, progress_done, "%d datapoints" % (ephemdata['data'].shape[0])
+
+    return save_filename, progress_failed, message
+
+
+def bulk_query(objects, output_dir=".",
+               start_datetime='2017-12-10',
+               end_datetime='2018-01-15',
+               time_interval='6h',
+               n_workers=4,
+               timeout=60,
+               retries=3,
+               backoff=5.,
+               host=None,
+               port=None,
+               progress_file=None):
+    """
+
+    Fetch ephemerides for all (object_name, save_filename) in objects, using
+    n_workers concurrent Horizons sessions. Objects recorded as done (or not
+    found) in progress_file are skipped.
+
+    """
+
+    if (progress_file is None):
+        progress_file = os.path.join(output_dir, "bulk_query.progress")
+    progress = read_progress(progress_file)
+
+    jobs = []
+    for object_name, save_filename in objects:
+        if (progress.get(save_filename, None) in [progress_done, progress_notfound]):
+            continue
+        jobs.append({
+            'object_name': object_name,
+            'save_filename': save_filename,
+            'ephem_file': "%s/%s.ephem" % (output_dir, save_filename),
+            'retries': retries,
+            'backoff': backoff,
+            'query': {
+                'start_datetime': start_datetime,
+                'end_datetime': end_datetime,
+                'time_interval': time_interval,
+                'session_log_file': "%s/%s.log" % (output_dir, save_filename),
+                'verbose': False,
+                'host': host,
+                'port': port,
+                'timeout': timeout,
+            },
+        })
+
+    print("Querying %d objects (%d already completed), %d sessions at a time" % (
+        len(jobs), len(objects)-len(jobs), n_workers))
+    if (len(jobs) <= 0):
+        return progress
+
+    pool = multiprocessing.Pool(processes=n_workers)
+    try:
+        with open(progress_file, "a") as pf:
+            for i, (save_filename, status, message) in enumerate(
+                    pool.imap_unordered(handler, jobs)):
+                print("% 4d/%d :: %s: %s %s" % (i+1, len(jobs), save_filename, status, message))
+                print("%s\t%s" % (save_filename, status), file=pf)
+                pf.flush()
+                progress[save_filename] = status
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    return progress
+
+
+if __name__ == "__main__":
+
+    fn = get_clean_cmdline()[1]
+    try:
+        output_dir = get_clean_cmdline()[2]
+    except:
+        output_dir = "."
+        pass
+
+    host, port = None, None
+    if (cmdline_arg_isset("-horizons")):
+        host, port = ephem.parse_horizons_server(get_cmdline_arg("-horizons"))
+
+    objects = read_object_list(fn)
+
+    bulk_query(objects, output_dir=output_dir,
+               start_datetime=cmdline_arg_set_or_default("-start", '2017-12-10'),
+               end_datetime=cmdline_arg_set_or_default("-end", '2018-01-15'),
+               time_interval=cmdline_arg_set_or_default("-step", '6h'),
+               n_workers=int(cmdline_arg_set_or_default("-workers", 4)),
+               timeout=float(cmdline_arg_set_or_default("-timeout", 60)),
+               retries=int(cmdline_arg_set_or_default("-retries", 3)),
+               host=host, port=port,
+               progress_file=cmdline_arg_set_or_default("-progress", None),
+               )
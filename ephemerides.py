@@ -10,6 +10,7 @@ import matplotlib
 import matplotlib.pyplot
 import datetime
 import scipy.interpolate
+import podi_ephemerides
 
 
 def load_ephemerides(filename, plot=False):
@@ -65,8 +66,9 @@ def load_ephemerides(filename, plot=False):
 
     data = numpy.array(data)
 
-    ra_vs_mjd = scipy.interpolate.interp1d( data[:,0], data[:,1], kind='linear' )
-    dec_vs_mjd = scipy.interpolate.interp1d( data[:,0], data[:,2], kind='linear' )
+    ephemeris = podi_ephemerides.Ephemeris(data)
+    ra_vs_mjd = ephemeris.ra
+    dec_vs_mjd = ephemeris.dec
 
     if (plot):
         fig = matplotlib.pyplot.figure()
@@ -15,6 +15,7 @@ import ds9 as pyds9
 pyds9.ds9_xpans()
 
 import podi_asteroidmetry
+import podi_catalogcache
 from podi_definitions import *
 
 if __name__ == "__main__":
@@ -48,7 +49,7 @@ if __name__ == "__main__":
             # Now load the catalog and find the source
             #
             catfile = filename[:-5]+".cat"
-            catdata = numpy.loadtxt(catfile)
+            catdata = podi_catalogcache.load_catalog(catfile, filename)
             # Correct for magzero
             magzero = hdulist[0].header['MAGZERO'] if 'MAGZERO' in hdulist[0].header else 25.
             catdata[:, SXcolumn['mag_aper_2.0']:SXcolumn['mag_aper_12.0']+1] += magzero
@@ -25,11 +25,25 @@ import ephem
 import time
 import scipy.stats
 import scipy.spatial
+import itertools
+import copy
+import shutil
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 
 import podi_sitesetup as sitesetup
 
 import podi_makecatalogs
+import podi_catalogcache
+import podi_catalogstore
 import multiprocessing
+import podi_workerpool
+import podi_orbits
+import podi_asteroidreport
+import podi_candidatedb
+import podi_coordinates
 
 numpy.seterr(divide='ignore', invalid='ignore')
 
@@ -81,7 +95,7 @@ def detection_class_from_comment(comment):
 
     return detection_class
 
-def format_source(src_entry, mjd, magname, filter_name='V', discovery=False, designation='ODI1'):
+def format_source(src_entry, mjd, magname, filter_name='V', discovery=False, designation='ODI1', dt=None):
 
     mag_name = "mag_aper_%s" % magname
     err_name = "mag_err_%s" % magname
@@ -95,8 +109,9 @@ def format_source(src_entry, mjd, magname, filter_name='V', discovery=False, des
                            math.radians(src_entry[SXcolumn['dec']]), 
                            epoch=ephem.J2000)
 
-    t = astropy.time.Time([mjd], format='mjd', scale='utc')
-    dt = t.datetime[0]
+    if (dt == None):
+        t = astropy.time.Time([mjd], format='mjd', scale='utc')
+        dt = t.datetime[0]
     formatted_date = "%04d %02d %08.5f" % (
         dt.year, dt.month, 
         dt.day + dt.hour/24. + dt.minute/1440. + (dt.second + dt.microsecond*1e-6)/86400.
@@ -121,20 +136,22 @@ def format_source(src_entry, mjd, magname, filter_name='V', discovery=False, des
     return ret
 
 
-def write_mpc_header(mpc):
+def mpc_header():
 
-    print >>mpc, "COD 695" # Kitt Peak
-    print >>mpc, "CON R S. McMillan, Univ. of Arizona, 1629 E. Univ. Blvd, Tucson AZ 85721"
-    print >>mpc, "CON [bob@lpl.arizona.edu]"
-    print >>mpc, "OBS --- add info here ---"
-    print >>mpc, "MEA --- add names here ---"
-    print >>mpc, "TEL WIYN 3.5-m f/6.3 reflector + CCDs"
-    print >>mpc, "NET 2MASS"
-    print >>mpc, "COM Astrometric errors are generally 0.6-0.8 arcsec including WCS fitting"
-    print >>mpc, "COM and centroiding."
-    print >>mpc, "BND r"
-    print >>mpc, "ACK WIYN 3.5-m followup"
-    print >>mpc, "AC2 bob@lpl.arizona.edu"
+    return [
+        "COD 695", # Kitt Peak
+        "CON R S. McMillan, Univ. of Arizona, 1629 E. Univ. Blvd, Tucson AZ 85721",
+        "CON [bob@lpl.arizona.edu]",
+        "OBS --- add info here ---",
+        "MEA --- add names here ---",
+        "TEL WIYN 3.5-m f/6.3 reflector + CCDs",
+        "NET 2MASS",
+        "COM Astrometric errors are generally 0.6-0.8 arcsec including WCS fitting",
+        "COM and centroiding.",
+        "BND r",
+        "ACK WIYN 3.5-m followup",
+        "AC2 bob@lpl.arizona.edu",
+    ]
 
 
 def is_valid_tracklet(tracklet_sources, min_rate, logger):
@@ -216,47 +233,155 @@ def is_valid_tracklet(tracklet_sources, min_rate, logger):
 
 
 
-def parallel_wrapper(jobqueue,
-                     shmem_catalogs,
-                     catalog_sizes,
-                     combined_catalog_size,
-                     result_queue,
-                     #
-                     mjd_hours,
-                     source_id,
-                     min_distance,
-                     min_rate, max_rate,
-                     rate_radius
-):
+def tangent_plane_projection(ra, dec, ra0, dec0):
+    """
 
-    # Reconstruct the catalog structure from shared memory
-    buffer = shmem_as_ndarray(shmem_catalogs).reshape(combined_catalog_size)
-    combined_size = 0
-    catalog = []
-    for size in catalog_sizes:
-        catalog.append(buffer[combined_size:combined_size+size])
-        combined_size += size
-        # print size
-    
-    while (True):
-        job = jobqueue.get()
-        if (job == None):
-            jobqueue.task_done()
-            return
-
-        ref_cat, obj1 = job
-        source_entry = check_for_valid_tracklet(catalog, 
-                                                mjd_hours,
-                                                source_id,
-                                                ref_cat, obj1,
-                                                min_distance, min_rate, max_rate,
-                                                rate_radius=rate_radius)
-
-        # Add the results to the result_queue and say we are done
-        result_queue.put(source_entry)
-        jobqueue.task_done()
-    
-    return
+    Project Ra/Dec (in degrees) onto the plane tangent to the sky at ra0/dec0
+    (gnomonic projection). Returns the standard coordinates xi/eta, in degrees.
+
+    """
+
+    ra = numpy.radians(ra)
+    dec = numpy.radians(dec)
+    ra0 = math.radians(ra0)
+    dec0 = math.radians(dec0)
+
+    cos_c = math.sin(dec0)*numpy.sin(dec) + math.cos(dec0)*numpy.cos(dec)*numpy.cos(ra-ra0)
+    xi = numpy.cos(dec) * numpy.sin(ra-ra0) / cos_c
+    eta = (math.cos(dec0)*numpy.sin(dec) - math.sin(dec0)*numpy.cos(dec)*numpy.cos(ra-ra0)) / cos_c
+
+    return numpy.degrees(xi), numpy.degrees(eta)
+
+
+
+def catalog_center(catalog):
+    """
+
+    Center of all sources in all catalogs, from the average unit vector (this
+    also works for fields straddling RA=0/360).
+
+    """
+
+    if (len(catalog) <= 0):
+        return 0., 0.
+    return podi_coordinates.sky_center(
+        numpy.concatenate([cat[:,SXcolumn['ra']] for cat in catalog]),
+        numpy.concatenate([cat[:,SXcolumn['dec']] for cat in catalog]))
+
+
+
+def build_catalog_index(catalog, center=None):
+    """
+
+    Create one spatial index (KD-tree) for each of the catalogs, using 
+    coordinates in a common tangent plane centered on all sources (or on 
+    center, if given).
+
+    """
+
+    ra0, dec0 = catalog_center(catalog) if (center == None) else center
+
+    trees = []
+    max_offset = 0.
+    for cat in catalog:
+        xi, eta = tangent_plane_projection(cat[:,SXcolumn['ra']], cat[:,SXcolumn['dec']], ra0, dec0)
+        trees.append(scipy.spatial.cKDTree(numpy.array([xi, eta]).T))
+        if (cat.shape[0] > 0):
+            max_offset = max(max_offset, math.degrees(math.atan(
+                math.radians(numpy.max(numpy.hypot(xi, eta))))))
+
+    catalog_index = {
+        'center': (ra0, dec0),
+        'max_offset': max_offset,
+        'trees': trees,
+    }
+    return catalog_index
+
+
+
+def find_nearby_sources(catalog_index, cat_id, ra, dec, max_distance):
+    """
+
+    Find all sources in catalog cat_id that might be within max_distance 
+    (in degrees) of any of the positions ra/dec. Distances in the tracklet 
+    search are computed from cos(dec)-corrected Ra/Dec differences, so the 
+    search radius in the tangent plane is padded to make sure the result 
+    includes all sources within max_distance; callers still need to apply 
+    the exact distance cut.
+
+    Returns the index of the position and the index of the source for each 
+    pair, sorted by position first and source second.
+
+    """
+
+    ra0, dec0 = catalog_index['center']
+    xi, eta = tangent_plane_projection(numpy.asarray(ra, dtype=numpy.float64), 
+                                       numpy.asarray(dec, dtype=numpy.float64),
+                                       ra0, dec0)
+
+    # Allow for the difference between flat Ra/Dec offsets and true distances 
+    # (worst at high declination), and for the stretching of distances in 
+    # the tangent plane away from the tangent point
+    max_dec = min(numpy.max(numpy.fabs(dec)) + max_distance, 89.)
+    rho = math.radians(min(catalog_index['max_offset'] + max_distance, 60.))
+    padding = (1.01 + math.radians(max_distance) * math.tan(math.radians(max_dec))) \
+              / math.cos(rho)**2
+    search_radius = max_distance * padding + 1e-4
+
+    neighbors = catalog_index['trees'][cat_id].query_ball_point(
+        numpy.array([xi, eta]).T, r=search_radius)
+
+    n_neighbors = [len(n) for n in neighbors]
+    owner = numpy.repeat(numpy.arange(len(neighbors)), n_neighbors)
+    match = numpy.fromiter(itertools.chain.from_iterable(neighbors), 
+                           dtype=int, count=owner.shape[0])
+
+    si = numpy.lexsort((match, owner))
+    return owner[si], match[si]
+
+
+
+#
+# Number of reference sources handled together in one batch of the 
+# vectorized tracklet search
+#
+tracklet_chunk_size = 128
+
+
+def attach_tracklet_search(stage):
+    """
+
+    Prepare a worker for the tracklet search: attach to the catalog store 
+    shared by all processes and build the spatial index of all catalogs.
+
+    """
+
+    catalog = podi_catalogstore.CatalogStore(stage['catalog_store_path'], mode='r+').frames()
+    source_id = [numpy.arange(cat.shape[0]) for cat in catalog]
+    catalog_index = build_catalog_index(catalog, center=stage['index_center'])
+    return catalog, source_id, catalog_index
+
+
+
+def tracklet_search_task(stage, ref_cat, obj_start, obj_end):
+    """
+
+    Search for tracklets starting at sources obj_start to obj_end of
+    catalog ref_cat; this runs in the shared worker pool.
+
+    """
+
+    catalog, source_id, catalog_index = podi_workerpool.worker_state(
+        "tracklet_search", stage['key'], lambda: attach_tracklet_search(stage))
+
+    return find_tracklets_in_chunk(catalog, 
+                                   stage['mjd_hours'],
+                                   source_id,
+                                   ref_cat, numpy.arange(obj_start, obj_end),
+                                   stage['min_distance'], stage['min_rate'], stage['max_rate'],
+                                   stage['min_count'],
+                                   rate_radius=stage['rate_radius'],
+                                   catalog_index=catalog_index)
 
 
 
@@ -265,11 +390,12 @@ def check_for_valid_tracklet(catalog,
                              source_id, 
                              ref_cat, obj1,
                              min_distance, min_rate, max_rate,
-                             rate_radius=1):
+                             min_count,
+                             rate_radius=1,
+                             catalog_index=None):
 
     motion_rates = numpy.zeros((0,7))
     cos_declination = math.cos(math.radians(catalog[ref_cat][obj1, SXcolumn['dec']]))
-    n_cat_columns = catalog[0].shape[1]
 
     #############################################################################
     #
@@ -283,23 +409,32 @@ def check_for_valid_tracklet(catalog,
         d_hours = mjd_hours[second_cat] - mjd_hours[ref_cat]
         diff_to_rate = 3600 / d_hours
 
-        d_ra = catalog[second_cat][:,SXcolumn['ra']] - catalog[ref_cat][obj1,SXcolumn['ra']]
+        # Only consider sources the spatial index finds close enough
+        if (catalog_index == None):
+            nearby = numpy.arange(catalog[second_cat].shape[0])
+        else:
+            _, nearby = find_nearby_sources(catalog_index, second_cat,
+                                            catalog[ref_cat][obj1:obj1+1,SXcolumn['ra']],
+                                            catalog[ref_cat][obj1:obj1+1,SXcolumn['dec']],
+                                            math.fabs(max_rate/diff_to_rate))
+
+        d_ra = catalog[second_cat][nearby,SXcolumn['ra']] - catalog[ref_cat][obj1,SXcolumn['ra']]
         d_ra *= cos_declination
-        d_dec = catalog[second_cat][:,SXcolumn['dec']] - catalog[ref_cat][obj1,SXcolumn['dec']]
+        d_dec = catalog[second_cat][nearby,SXcolumn['dec']] - catalog[ref_cat][obj1,SXcolumn['dec']]
         d_total = numpy.hypot(d_ra, d_dec) 
 
         # Only use sources with positive flags - we'll mask stars that 
         # are already matched to another tracklet by setting flags to -1 
         possible_match = (d_total < math.fabs(max_rate/diff_to_rate)) & \
                          (d_total > min_distance) & \
-                         (catalog[second_cat][:,SXcolumn['flags']] >= 0)
+                         (catalog[second_cat][nearby,SXcolumn['flags']] >= 0)
         # require a minimum distance of 2 arcsec
 
         matches = numpy.ones(shape=(numpy.sum(possible_match),7))
         matches[:,0] = ref_cat
         matches[:,1] = second_cat
         matches[:,2] = obj1
-        matches[:,3] = source_id[second_cat][possible_match]
+        matches[:,3] = source_id[second_cat][nearby][possible_match]
         matches[:,4] = d_ra[possible_match] * diff_to_rate
         matches[:,5] = d_dec[possible_match] * diff_to_rate
 
@@ -330,6 +465,241 @@ def check_for_valid_tracklet(catalog,
 
     # numpy.savetxt(sys.stdout, motion_rates)
 
+    return tracklet_from_motion_rates(catalog, mjd_hours, ref_cat, obj1,
+                                      motion_rates, min_count, min_rate,
+                                      src_tree=src_tree)
+
+
+
+def chunk_motion_rates(catalog, mjd_hours, source_id, ref_cat, obj_ids,
+                       min_distance, max_rate, catalog_index=None):
+    """
+
+    Vectorized version of the motion-rate search in check_for_valid_tracklet,
+    computing the rate vectors for a whole chunk of reference sources against
+    every later catalog in one go. If available, the spatial index from 
+    build_catalog_index is used to only consider nearby sources.
+
+    Returns the motion-rate table (same 7-column layout as in 
+    check_for_valid_tracklet) and, for each row, the index of the reference 
+    source within obj_ids. Rows are grouped by reference source, and within 
+    each group ordered exactly as in the per-object search.
+
+    """
+
+    ref_ra = catalog[ref_cat][obj_ids, SXcolumn['ra']]
+    ref_dec = catalog[ref_cat][obj_ids, SXcolumn['dec']]
+    # Use math.cos and the catalog data type so the rates are bit-identical 
+    # to the ones computed in the per-object search
+    cos_declination = numpy.array([math.cos(math.radians(d)) for d in ref_dec],
+                                  dtype=ref_dec.dtype)
+
+    all_rates = []
+    all_owners = []
+    for second_cat in range(ref_cat+1, len(catalog)):
+
+        d_hours = mjd_hours[second_cat] - mjd_hours[ref_cat]
+        diff_to_rate = 3600 / d_hours
+        max_distance = math.fabs(max_rate/diff_to_rate)
+
+        # Find all pairs of reference source and source in the second 
+        # catalog that need to be checked, sorted by reference source first 
+        # and by source id second
+        if (catalog_index == None):
+            n_sources = catalog[second_cat].shape[0]
+            owner = numpy.repeat(numpy.arange(obj_ids.shape[0]), n_sources)
+            match = numpy.tile(numpy.arange(n_sources), obj_ids.shape[0])
+        else:
+            owner, match = find_nearby_sources(catalog_index, second_cat, 
+                                               ref_ra, ref_dec, max_distance)
+
+        d_ra = catalog[second_cat][match,SXcolumn['ra']] - ref_ra[owner]
+        d_ra *= cos_declination[owner]
+        d_dec = catalog[second_cat][match,SXcolumn['dec']] - ref_dec[owner]
+        d_total = numpy.hypot(d_ra, d_dec)
+
+        possible_match = (d_total < max_distance) & \
+                         (d_total > min_distance) & \
+                         (catalog[second_cat][match,SXcolumn['flags']] >= 0)
+        owner = owner[possible_match]
+        match = match[possible_match]
+
+        matches = numpy.ones(shape=(owner.shape[0],7))
+        matches[:,0] = ref_cat
+        matches[:,1] = second_cat
+        matches[:,2] = obj_ids[owner]
+        matches[:,3] = source_id[second_cat][match]
+        matches[:,4] = d_ra[possible_match] * diff_to_rate
+        matches[:,5] = d_dec[possible_match] * diff_to_rate
+
+        all_rates.append(matches)
+        all_owners.append(owner)
+
+    if (len(all_rates) <= 0):
+        return numpy.zeros((0,7)), numpy.zeros((0), dtype=int)
+
+    motion_rates = numpy.concatenate(all_rates, axis=0)
+    owners = numpy.concatenate(all_owners)
+
+    # Group all rows by reference source; the stable sort keeps the 
+    # catalog-by-catalog order within each group
+    si = numpy.argsort(owners, kind='mergesort')
+    return motion_rates[si], owners[si]
+
+
+
+def count_rate_neighbors(motion_rates, owners, rate_radius, max_rate):
+    """
+
+    Count, for each row in the motion-rate table, how many rows of the same 
+    reference source have a motion rate within rate_radius. 
+
+    All reference sources share one KD-tree; the reference source index is 
+    added as third coordinate with a spacing larger than any possible rate 
+    difference, so rates from different sources never count towards each 
+    other.
+
+    """
+
+    spacing = 2. * (math.fabs(max_rate) + rate_radius) + 1.
+    points = numpy.empty((motion_rates.shape[0], 3))
+    points[:,0:2] = motion_rates[:,4:6]
+    points[:,2] = owners * spacing
+
+    # Every rate counts itself, plus once for each close pair it is part of
+    tree = scipy.spatial.cKDTree(points)
+    pairs = tree.query_pairs(r=rate_radius, p=2, output_type='ndarray')
+    n_rates = points.shape[0]
+    return 1 + numpy.bincount(pairs[:,0], minlength=n_rates) \
+             + numpy.bincount(pairs[:,1], minlength=n_rates)
+
+
+
+def find_tracklets_in_chunk(catalog, 
+                            mjd_hours,
+                            source_id, 
+                            ref_cat, obj_ids,
+                            min_distance, min_rate, max_rate,
+                            min_count,
+                            rate_radius=1,
+                            catalog_index=None):
+    """
+
+    Batched version of check_for_valid_tracklet. Searches for tracklets 
+    starting at each of the sources obj_ids in catalog ref_cat, and returns a 
+    list of all source entries found, in order of obj_ids.
+
+    Motion rates and rate-cluster counts are computed for the entire chunk
+    at once. Only sources with enough matches are then handled one by one, 
+    in the same order as in the per-object search. Since that step flags 
+    sources as used by a tracklet, each candidate is re-checked against the 
+    current flags, making the results identical to the per-object search.
+
+    """
+
+    obj_ids = numpy.asarray(obj_ids)
+    obj_ids = obj_ids[catalog[ref_cat][obj_ids, SXcolumn['flags']] >= 0]
+    if (obj_ids.shape[0] <= 0):
+        return []
+
+    motion_rates, owners = chunk_motion_rates(catalog, mjd_hours, source_id, 
+                                              ref_cat, obj_ids, 
+                                              min_distance, max_rate,
+                                              catalog_index=catalog_index)
+    if (motion_rates.shape[0] <= 0):
+        return []
+
+    #
+    # Find the range of rows for each of the reference sources
+    #
+    n_rates = numpy.bincount(owners, minlength=obj_ids.shape[0])
+    row_end = numpy.cumsum(n_rates)
+    row_start = row_end - n_rates
+
+    #
+    # Count how many matches we have in each motion rate cluster
+    #
+    motion_rates[:,6] = count_rate_neighbors(motion_rates, owners, rate_radius, max_rate)
+
+    # Find the most frequent rate for each reference source
+    has_rates = n_rates > 0
+    ratecount_max = numpy.zeros((obj_ids.shape[0]))
+    ratecount_max[has_rates] = numpy.maximum.reduceat(motion_rates[:,6], row_start[has_rates])
+
+    # Only sources with enough nearby stars and enough matches in 
+    # the most frequent rate can be the start of a tracklet
+    promising = (n_rates >= 5) & (ratecount_max >= min_count)
+
+    return tracklets_from_rate_groups(catalog, mjd_hours, motion_rates,
+                                      row_start[promising], row_end[promising],
+                                      min_count, min_rate, max_rate, rate_radius)
+
+
+
+def tracklets_from_rate_groups(catalog, mjd_hours, motion_rates, row_start, row_end,
+                               min_count, min_rate, max_rate, rate_radius):
+    """
+
+    Go through the groups of motion rates (rows row_start:row_end of 
+    motion_rates, one group per reference source, with the rate-cluster 
+    counts in column 6) in order, and check each for a valid tracklet. 
+
+    Returns the list of all source entries found.
+
+    """
+
+    source_entries = []
+    for group in range(len(row_start)):
+
+        ref_cat = int(motion_rates[row_start[group], 0])
+        obj1 = int(motion_rates[row_start[group], 2])
+
+        # This source might have become part of a tracklet found earlier
+        if (catalog[ref_cat][obj1,SXcolumn['flags']] < 0):
+            continue
+
+        rates = motion_rates[row_start[group]:row_end[group]].copy()
+        
+        # Drop all counterparts that have been assigned to another tracklet
+        # since the motion rates were computed
+        still_available = numpy.array(
+            [catalog[int(c2)][int(o2),SXcolumn['flags']] >= 0 for c2,o2 in rates[:,[1,3]]]
+        )
+        if (not numpy.all(still_available)):
+            rates = rates[still_available]
+            if (rates.shape[0] < 5):
+                continue
+            rates[:,6] = count_rate_neighbors(rates, numpy.zeros((rates.shape[0])), 
+                                              rate_radius, max_rate)
+
+        source_entry = tracklet_from_motion_rates(catalog, mjd_hours, ref_cat, obj1,
+                                                  rates, min_count, min_rate)
+        if (not source_entry == None):
+            source_entries.append(source_entry)
+
+    return source_entries
+
+
+
+def tracklet_from_motion_rates(catalog, mjd_hours, ref_cat, obj1,
+                               motion_rates, min_count, min_rate,
+                               src_tree=None):
+    """
+
+    Check if the most frequent motion rate in the motion-rate table of 
+    source obj1 in catalog ref_cat forms a valid tracklet. Column 6 of the 
+    table has to contain the number of rates in each rate cluster.
+
+    Returns the source entry for the tracklet or None.
+
+    """
+
+    logger = logging.getLogger("Astro(id)metry")
+
+    n_cat_columns = catalog[0].shape[1]
+    if (src_tree == None):
+        src_tree = scipy.spatial.cKDTree(motion_rates[:,4:6])
+
     #
     # Now we know how often each star appears
     #
@@ -531,7 +901,19 @@ def check_for_valid_tracklet(catalog,
 
 
 
-def remove_static_sources(catalog):
+def remove_static_sources(catalog, match_radius=1./3600, min_epochs=4):
+    """
+
+    Remove all stationary sources from all catalogs. Going through the 
+    catalogs in order, a source is considered a star if it has a counterpart 
+    within match_radius in at least min_epochs of the following catalogs; 
+    stars and all their counterparts are then removed before checking the 
+    next catalog.
+
+    All catalogs are cross-matched against each other in one go, using a 
+    single KD-tree of all sources from all epochs.
+
+    """
 
     logger = logging.getLogger("ClearStars")
 
@@ -544,72 +926,263 @@ def remove_static_sources(catalog):
     #    numpy.savetxt("cat_starclean_%d.raw" % (i), catalog[i])
 
     print "catalog entries start:", [len(i) for i in catalog]
+    if (len(catalog) < 2):
+        return catalog
+
+    # Stack all catalogs, and keep track of the epoch of each source
+    n_sources = numpy.array([cat.shape[0] for cat in catalog])
+    epoch = numpy.repeat(numpy.arange(len(catalog)), n_sources)
+    all_positions = numpy.concatenate([cat[:,0:2] for cat in catalog], axis=0)
+
+    # Find all pairs of sources close to each other, and only keep those 
+    # from different epochs, ordered so the first source is from the 
+    # earlier epoch
+    logger.info("Cross-matching all %d sources from %d catalogs" % (
+        all_positions.shape[0], len(catalog)))
+    kdtree = scipy.spatial.cKDTree(all_positions)
+    pairs = kdtree.query_pairs(r=match_radius, p=2, output_type='ndarray')
+    pairs = pairs[epoch[pairs[:,0]] != epoch[pairs[:,1]]]
+    swap = epoch[pairs[:,0]] > epoch[pairs[:,1]]
+    pairs[swap] = pairs[swap][:,::-1]
+
+    # Group all pairs by the epoch of the earlier source
+    si = numpy.argsort(epoch[pairs[:,0]], kind='mergesort')
+    pairs = pairs[si]
+    pair_start = numpy.searchsorted(epoch[pairs[:,0]], numpy.arange(len(catalog)+1))
+
+    is_alive = numpy.isfinite(all_positions[:,0])
     for c1 in range(len(catalog)-1):
         logger.info("Removing all stationary sources from catalog %d" % (c1+1))
-        kdcat1 = scipy.spatial.cKDTree(catalog[c1][:,0:2])
 
-        total_matches = numpy.zeros((catalog[c1].shape[0]))
-        # print total_matches.shape
+        # Only count counterparts that have not been removed yet
+        src, match = pairs[pair_start[c1]:pair_start[c1+1]].T
+        valid = is_alive[src] & is_alive[match]
+        src, match = src[valid], match[valid]
+
+        # Count the number of later epochs with at least one counterpart
+        epoch_matched = numpy.unique(src * len(catalog) + epoch[match])
+        total_matches = numpy.bincount(epoch_matched // len(catalog),
+                                       minlength=all_positions.shape[0])
+
+        # Now select all objects with more than the minimum number of 
+        # counterparts, and delete them and their counterparts in all 
+        # following catalogs
+        is_a_star = total_matches >= min_epochs
+        is_alive[is_a_star] = False
+        is_alive[match[is_a_star[src]]] = False
+
+    catalog_start = numpy.append([0], numpy.cumsum(n_sources))
+    for i in range(len(catalog)):
+        catalog[i] = catalog[i][is_alive[catalog_start[i]:catalog_start[i+1]]]
+
+    print "catalog entries end:", [len(i) for i in catalog]
+    
+    return catalog
 
-        all_matches = [None] * len(catalog)
 
-        for c2 in range(c1+1, len(catalog)):
-            kdcat2 = scipy.spatial.cKDTree(catalog[c2][:,0:2])
 
-            # Now search for a close counterpart in catalog #2 for 
-            # each source in catalog 1 
-            matches = kdcat1.query_ball_tree(kdcat2, r=1./3600, p=2)
-            all_matches[c2] = matches
+def load_frame_catalog(fitsfile):
+    """
 
-            found_match = numpy.array([i!=[] for i in matches])
-            #print matches[:15]
-            #print numpy.sum(found_match[:15].reshape((-1,1)), axis=1)
-            #print len(matches), len(found_match)
+    Load the source catalog for fitsfile and apply the photometric zeropoint.
+    Returns the catalog, the MJD at the middle of the exposure (in hours) and
+    the filter name, or None if the catalog can not be used.
 
-            new_matches = numpy.sum(found_match.reshape((-1,1)), axis=1)
-            #print new_matches.shape
+    """
 
-            #print type(total_matches), type(new_matches)
-            total_matches += new_matches
+    catalog_filename = fitsfile[:-5]+".cat"
+    phot_ZP = 25.
 
-            # break
+    cat_data = podi_catalogcache.load_catalog(catalog_filename, fitsfile)
+    
+    hdulist = astropy.io.fits.open(fitsfile)
+    obs_mjd = hdulist[0].header['MJD-OBS']
+    exptime = hdulist[0].header['EXPTIME']
+    mjd_middle = (obs_mjd * 24.) + (exptime / 3600.)
+    filter_name = hdulist[0].header['FILTER']
+
+    # print "total catalog", cat_data.shape
+    # in_box = (cat_data[:, SXcolumn['ra']] > 215.22568) & \
+    #          (cat_data[:, SXcolumn['ra']] < 215.2346 ) & \
+    #          (cat_data[:, SXcolumn['dec']] < -15.198908) & \
+    #          (cat_data[:, SXcolumn['dec']] > -15.206894 )
+    # cat_data = cat_data[in_box]
+    # print "in-box:", cat_data.shape
+
+    # Do some preparing of the catalog
+    try:
+        good_photometry = cat_data[:, SXcolumn['mag_aper_2.0']] < 0
+        cat_data = cat_data #[good_photometry]
+    except:
+        # anything might have gone wrong.
+        # do not use this catalog
+        return None
 
-        # print total_matches[:15]
+    # Check if there is  photometric ZP keyword
+    # if there is, this frame likely is a QR'ed frame, so use the PHOTZP_X keyword instead
+    if ('PHOTZP_X' in hdulist[0].header):
+        phot_ZP = hdulist[0].header['PHOTZP_X']
+    elif ('MAGZERO' in hdulist[0].header):
+        phot_ZP = hdulist[0].header['MAGZERO']
+    else:
+        phot_ZP = 25.
+        
+    # Apply photometric zeropoint to all magnitudes
+    for key in SXcolumn_names:
+        if (key.startswith("mag_aper")):
+            cat_data[:, SXcolumn[key]] += phot_ZP
 
-        # Now select all objects with more than the minimum number of counterparts
-        is_a_star = total_matches >= 4
-        # print is_a_star[:15]
+    return cat_data, mjd_middle, filter_name
 
-        # Go and delete all stars from this and the following catalogs
-        catalog[c1][:, 0:2][is_a_star] = numpy.NaN
-        for c2 in range(c1+1, len(catalog)):
-            matches = all_matches[c2]
 
-            for i in range(is_a_star.shape[0]):
-                if (is_a_star[i]):
-                    entries = matches[i]
-                    catalog[c2][:,0:2][entries] = numpy.NaN
 
-            # stars = matches[is_a_star]
-            # print stars
+def search_tracklets(catalog_store, mjd_hours, source_id, min_count, min_rate, batch_search=True):
+    """
 
-        for i in range(len(catalog)):
-            # numpy.savetxt("cat_starclean_%d__%d" % (c1, i), catalog[i])
-            catalog[i] = catalog[i][numpy.isfinite(catalog[i][:,0])]
+    Find all tracklets in the catalogs of the catalog store, and return the
+    list of candidates.
 
-        # print catalog[c1][:15,0:2]
+    """
 
+    logger = logging.getLogger("Astro(id)metry")
 
-        # break
+    catalog = catalog_store.frames()
 
-    print "catalog entries end:", [len(i) for i in catalog]
-    # return
-    
-    return catalog
+    max_rate = 500 # arcsec / hour
+    min_distance = 2. / 3600. # arcsec
+    motion_rates = numpy.zeros((0,6))
+
+    # Now select all neighbors within the search radius
+    radius = 1.
+
+    results = open("results", "w")
+    moving_object_id = 0
+
+    candidates = []
+
+    # The per-object search is only available on a single core
+    execute_in_parallel = batch_search
+
+    if (execute_in_parallel):
+    #############################################################################
+    #
+    # Prepare the actual search for parallel execution. 
+    #
+    # All workers attach to the memory-mapped catalog store to avoid 
+    # synchronization issues when we flag some sources as already assigned 
+    # to a given tracklet, and build their own spatial index.
+    #
+    #############################################################################
 
+        print [cat.shape[0] for cat in catalog]
+
+        # Everything the workers need to attach to this search; the key 
+        # tells them apart from earlier searches
+        stage = {'key': "%s:%d:%f" % (catalog_store.path, os.getpid(), time.time()),
+                 'catalog_store_path': catalog_store.path,
+                 'index_center': catalog_center(catalog),
+                 'mjd_hours': mjd_hours,
+                 'min_distance': min_distance,
+                 'min_rate': min_rate, 
+                 'max_rate': max_rate,
+                 'min_count': min_count,
+                 'rate_radius': radius}
+        pool = podi_workerpool.get_pool()
+
+        # Now queue all work, one source catalog at a time, handing out 
+        # chunks of reference sources to the workers
+        pending = []
+        try:
+            for ref_cat in range(len(catalog)-1-min_count):
+                logger.info("Checking out catalog %d" % (ref_cat+1))
+
+                pending = []
+                for obj_start in range(0, catalog[ref_cat].shape[0], tracklet_chunk_size):
+                    obj_end = min(obj_start+tracklet_chunk_size, catalog[ref_cat].shape[0])
+                    pending.append(pool.submit(tracklet_search_task, stage, ref_cat, obj_start, obj_end))
+
+                # Keep the candidates in the order of the reference sources
+                logger.info("Waiting for results from source catalog %d ..." % (ref_cat+1))
+                for result in pending:
+                    candidates.extend(result.get())
+        finally:
+            # Let the workers drop their catalogs and indices, so the 
+            # catalog store can be deleted
+            for result in pending:
+                result.wait()
+            pool.broadcast(podi_workerpool.release_state, "tracklet_search")
 
+        #return
 
-def find_moving_objects(sidereal_reference, inputlist, min_count, min_rate, mpcfile=None):
+
+    else:
+    #############################################################################
+    #
+    # Run the tracklet detection on a single core - no need for parallel shenanigans
+    #
+    #############################################################################
+
+        # Build the spatial index for all catalogs once, so the search only 
+        # needs to look at nearby sources
+        logger.info("Building spatial index for all catalogs")
+        catalog_index = build_catalog_index(catalog)
+
+        for ref_cat in range(len(catalog)-1-min_count):
+            logger.info("Checking out catalog %d" % (ref_cat))
+
+            if (not batch_search):
+                for obj1 in range(catalog[ref_cat].shape[0]):
+                    # Take one source in first catalog; 
+                    # compute difference and rate from each source in the second 
+                    # catalog to the source in the first catalog.
+
+                    if ((obj1 % 10) == 0):
+                        sys.stdout.write("Working on cat %d, obj %d\r" % (ref_cat+1, obj1+1))
+                        sys.stdout.flush()
+
+                    if (catalog[ref_cat][obj1,SXcolumn['flags']] < 0):
+                        continue
+
+                    #
+                    #
+                    # Check if this is the start of a valid tracklet
+                    #
+                    #
+                    source_entry = check_for_valid_tracklet(catalog, 
+                                                            mjd_hours,
+                                                            source_id,
+                                                            ref_cat, obj1,
+                                                            min_distance, min_rate, max_rate,
+                                                            min_count,
+                                                            rate_radius=radius,
+                                                            catalog_index=catalog_index)
+                    if (not source_entry == None):
+                        candidates.append(source_entry)
+                continue
+
+            for obj_start in range(0, catalog[ref_cat].shape[0], tracklet_chunk_size):
+                obj_end = min(obj_start+tracklet_chunk_size, catalog[ref_cat].shape[0])
+                sys.stdout.write("Working on cat %d, obj %d\r" % (ref_cat+1, obj_start+1))
+                sys.stdout.flush()
+
+                source_entries = find_tracklets_in_chunk(catalog, 
+                                                         mjd_hours,
+                                                         source_id,
+                                                         ref_cat, numpy.arange(obj_start, obj_end),
+                                                         min_distance, min_rate, max_rate,
+                                                         min_count,
+                                                         rate_radius=radius,
+                                                         catalog_index=catalog_index)
+                candidates.extend(source_entries)
+
+        #numpy.savetxt("motion_rates_%d" % (ref_cat), motion_rates)
+
+    return candidates
+
+
+
+def find_moving_objects(sidereal_reference, inputlist, min_count, min_rate, mpcfile=None,
+                        batch_search=True, catalog_store_path=None):
 
     logger = logging.getLogger("Astro(id)metry")
 
@@ -630,46 +1203,13 @@ def find_moving_objects(sidereal_reference, inputlist, min_count, min_rate, mpcf
     for fitsfile in inputlist:
 
         catalog_filename = fitsfile[:-5]+".cat"
-        phot_ZP = 25.
 
-        cat_data = numpy.loadtxt(catalog_filename)
-        
-        hdulist = astropy.io.fits.open(fitsfile)
-        obs_mjd = hdulist[0].header['MJD-OBS']
-        exptime = hdulist[0].header['EXPTIME']
-        mjd_middle = (obs_mjd * 24.) + (exptime / 3600.)
-        filter_name = hdulist[0].header['FILTER']
-
-        # print "total catalog", cat_data.shape
-        # in_box = (cat_data[:, SXcolumn['ra']] > 215.22568) & \
-        #          (cat_data[:, SXcolumn['ra']] < 215.2346 ) & \
-        #          (cat_data[:, SXcolumn['dec']] < -15.198908) & \
-        #          (cat_data[:, SXcolumn['dec']] > -15.206894 )
-        # cat_data = cat_data[in_box]
-        # print "in-box:", cat_data.shape
-
-        # Do some preparing of the catalog
-        try:
-            good_photometry = cat_data[:, SXcolumn['mag_aper_2.0']] < 0
-            cat_data = cat_data #[good_photometry]
-        except:
+        frame = load_frame_catalog(fitsfile)
+        if (frame == None):
             # anything might have gone wrong.
             # do not use this catalog
             continue
-
-        # Check if there is  photometric ZP keyword
-        # if there is, this frame likely is a QR'ed frame, so use the PHOTZP_X keyword instead
-        if ('PHOTZP_X' in hdulist[0].header):
-            phot_ZP = hdulist[0].header['PHOTZP_X']
-        elif ('MAGZERO' in hdulist[0].header):
-            phot_ZP = hdulist[0].header['MAGZERO']
-        else:
-            phot_ZP = 25.
-            
-        # Apply photometric zeropoint to all magnitudes
-        for key in SXcolumn_names:
-            if (key.startswith("mag_aper")):
-                cat_data[:, SXcolumn[key]] += phot_ZP
+        cat_data, mjd_middle, filter_name = frame
 
         catalog_filelist.append(catalog_filename)
         catalog.append(cat_data)
@@ -682,148 +1222,132 @@ def find_moving_objects(sidereal_reference, inputlist, min_count, min_rate, mpcf
 
     catalog = remove_static_sources(catalog)
 
-    max_rate = 500 # arcsec / hour
-    min_distance = 2. / 3600. # arcsec
-    motion_rates = numpy.zeros((0,6))
+    # Move all catalogs into the catalog store, so all processes work 
+    # on the same data and can see which sources are already assigned 
+    # to a tracklet
+    if (catalog_store_path == None):
+        catalog_store_path = podi_catalogstore.unique_path("asteroidmetry")
+    logger.info("Creating catalog store in %s" % (catalog_store_path))
+    try:
+        catalog_store = podi_catalogstore.CatalogStore.create(catalog_store_path, catalog)
+        candidates = search_tracklets(catalog_store, mjd_hours, source_id, 
+                                      min_count, min_rate, batch_search)
+    finally:
+        # All candidates hold their own copy of the source data, so we no 
+        # longer need the catalog store (also if the search failed)
+        shutil.rmtree(catalog_store_path, ignore_errors=True)
 
-    # Now select all neighbors within the search radius
-    radius = 1.
+    logger.info("all search-related work done, associating with known objects !")
 
-    results = open("results", "w")
-    moving_object_id = 0
+    # print candidates
 
-    candidates = []
+    return classify_candidates(candidates, sidereal_reference, min_rate, mpcfile)
 
-    execute_in_parallel = True
 
-    if (execute_in_parallel):
-    #############################################################################
-    #
-    # Prepare the actual search for parallel execution. 
-    #
-    # Use shared memory to avoid synchronization issues when we flag some 
-    # sources as already assigned to a given tracklet.
-    #
-    #############################################################################
 
-        # Prepare a single master-catalog and keep track of the number of 
-        # objects from each frame
-        catalog_sizes = []
-        joined_catalog = None
-        for i in range(len(catalog)):
-            joined_catalog = catalog[i] if joined_catalog == None else \
-                             numpy.append(joined_catalog, catalog[i], axis=0)
-            catalog_sizes.append(catalog[i].shape[0])
-
-        print joined_catalog.shape
-        print catalog_sizes
-
-        # Allocate shared memory to hold all catalogs
-        shmem_buffer = multiprocessing.RawArray(ctypes.c_float, 
-                                                joined_catalog.shape[0]*joined_catalog.shape[1])
-        # Extract the shared memory buffer as numpy array to make things easier
-        buffer = shmem_as_ndarray(shmem_buffer).reshape(joined_catalog.shape)
-        buffer[:] = joined_catalog[:]
-
-        # Prepare the Queue that will direct the work of all worker processes
-        jobqueue = multiprocessing.JoinableQueue()
-        # and another queue via which we will read the results
-        result_queue = multiprocessing.Queue()
-
-        # Start the worker processes
-        logger.info("Starting worker processes ...")
-        processes = []
-        for i in range(sitesetup.number_cpus):
-            worker_kwargs = {'jobqueue': jobqueue, 
-                             'shmem_catalogs': shmem_buffer, 
-                             'catalog_sizes': catalog_sizes,
-                             'combined_catalog_size': joined_catalog.shape,
-                             'result_queue': result_queue,
-                             'mjd_hours': mjd_hours,
-                             'source_id': source_id,
-                             'min_distance': min_distance,
-                             'min_rate': min_rate, 
-                             'max_rate': max_rate,
-                             'rate_radius': radius}
-            p = multiprocessing.Process(target=parallel_wrapper, kwargs=worker_kwargs)
-            p.start()
-            processes.append(p)
-
-        # Now queue all work, one source catalog at a time
-        for ref_cat in range(len(catalog)-1-min_count):
-            logger.info("Checking out catalog %d" % (ref_cat+1))
+#
+# A known object is a likely counterpart of a candidate if it is within 
+# known_match_radius (arcsec) and its rates are within known_rate_tolerance 
+# (arcsec/hour) in both Ra and Dec
+#
+known_match_radius = 5.
+known_rate_tolerance = 1.5
 
-            jobs_queued = 0
-            for obj1 in range(catalog[ref_cat].shape[0]):
-                # Take one source in first catalog; 
-                # compute difference and rate from each source in the second 
-                # catalog to the source in the first catalog.
 
-                if (catalog[ref_cat][obj1,SXcolumn['flags']] < 0):
-                    continue
 
-                jobqueue.put((ref_cat, obj1))
-                jobs_queued += 1
+def reference_position(cand, mjd_reference):
+    """
 
-            logger.info("Waiting for results from source catalog %d ..." % (ref_cat+1))
-            for i in range(jobs_queued):
-                source_entry = result_queue.get()
-                if (not source_entry == None):
-                    candidates.append(source_entry)
+    Return the position of the candidate at the time of the reference frame
+    (median of all detections, corrected for the motion), and the scatter
+    of the corrected positions in arcsec.
 
-        # Now we are done with all catalogs, send the termination signal
-        logger.info("Sending workers home")
-        for p in processes:
-            jobqueue.put(None)
+    """
 
-        # And wait until all jobs are terminated
-        logger.info("Making sure all worker processes are terminated")
-        for p in processes:
-            p.join()
-        logger.info("done!")
+    # Get time difference in hours
+    delta_mjd_hours = (cand['mjd'] - mjd_reference) * 24.
+    # total motion
+    delta_radec = numpy.array(cand['rate']).reshape((1,2)).repeat(delta_mjd_hours.shape[0], axis=0) \
+                  * delta_mjd_hours.reshape((delta_mjd_hours.shape[0],1)).repeat(2, axis=1)
+    # Account for the cos(dec) factor
+    cos_dec = numpy.cos(numpy.radians(cand['sex'][:,SXcolumn['dec']]))
+    delta_radec[:,0] /= cos_dec
+    ra_dec_corrected = cand['sex'][:,0:2] - delta_radec/3600.
+    radec = numpy.median(ra_dec_corrected, axis=0)
+    radec_std = numpy.std(ra_dec_corrected, axis=0)*3600.
 
-        #return
+    return radec, radec_std
 
 
-    else:
-    #############################################################################
-    #
-    # Run the tracklet detection on a single core - no need for parallel shenanigans
-    #
-    #############################################################################
-        for ref_cat in range(len(catalog)-1-min_count):
-            logger.info("Checking out catalog %d" % (ref_cat))
 
-            for obj1 in range(catalog[ref_cat].shape[0]):
-                # Take one source in first catalog; 
-                # compute difference and rate from each source in the second 
-                # catalog to the source in the first catalog.
-
-                if ((obj1 % 10) == 0):
-                    sys.stdout.write("Working on cat %d, obj %d\r" % (ref_cat+1, obj1+1))
-                    sys.stdout.flush()
-
-                if (catalog[ref_cat][obj1,SXcolumn['flags']] < 0):
-                    continue
-
-                #
-                #
-                # Check if this is the start of a valid tracklet
-                #
-                #
-                source_entry = check_for_valid_tracklet(catalog, 
-                                                        mjd_hours,
-                                                        source_id,
-                                                        ref_cat, obj1,
-                                                        min_distance, min_rate, max_rate,
-                                                        rate_radius=radius)
-                if (not source_entry == None):
-                    candidates.append(source_entry)
+def associate_known_objects(radec, rates, known_ra, known_dec, known_dra, known_ddec):
+    """
 
-        #numpy.savetxt("motion_rates_%d" % (ref_cat), motion_rates)
-    logger.info("all search-related work done, associating with known objects !")
+    Find the likely counterparts among all known objects for all candidates
+    at once. radec and rates have one row per candidate (Ra/Dec in degrees, 
+    rates in arcsec/hour, like the known objects). 
 
-    # print candidates
+    All known objects go into one spatial index of position (in the tangent
+    plane) and rate; the rates are scaled so that the tolerances in position
+    and rate have the same size. A single query then returns all possible 
+    matches, on which the exact criteria are applied.
+
+    Returns, for each candidate, the indices of all likely counterparts.
+
+    """
+
+    n_candidates = radec.shape[0]
+    matches = [numpy.zeros(0, dtype=int) for i in range(n_candidates)]
+
+    valid = numpy.isfinite(known_ra) & numpy.isfinite(known_dec) & \
+            numpy.isfinite(known_dra) & numpy.isfinite(known_ddec)
+    known_ids = numpy.nonzero(valid)[0]
+    if (known_ids.shape[0] <= 0 or n_candidates <= 0):
+        return matches
+
+    ra0, dec0 = podi_coordinates.sky_center(known_ra[valid], known_dec[valid])
+    rate_scale = known_match_radius / known_rate_tolerance
+
+    def index_coordinates(ra, dec, dra, ddec):
+        xi, eta = tangent_plane_projection(ra, dec, ra0, dec0)
+        return numpy.array([xi * 3600., eta * 3600., dra * rate_scale, ddec * rate_scale]).T
+
+    tree = scipy.spatial.cKDTree(index_coordinates(
+        known_ra[valid], known_dec[valid], known_dra[valid], known_ddec[valid]))
+
+    # Search a box slightly larger than the tolerances, to allow for the
+    # difference between tangent-plane and Ra/Dec offsets
+    neighbors = tree.query_ball_point(
+        index_coordinates(radec[:,0], radec[:,1], rates[:,0], rates[:,1]),
+        r=1.1 * known_match_radius + 1., p=numpy.inf)
+
+    for cand_id in range(n_candidates):
+        if (len(neighbors[cand_id]) <= 0):
+            continue
+        nearby = known_ids[numpy.array(neighbors[cand_id], dtype=int)]
+        d_ra_cat = (known_ra[nearby] - radec[cand_id,0]) * math.cos(math.radians(radec[cand_id,1]))
+        d_dec_cat = known_dec[nearby] - radec[cand_id,1]
+        d_total = numpy.hypot(d_ra_cat, d_dec_cat) * 3600. # convert to arcsec
+        d_dra = known_dra[nearby] - rates[cand_id,0]
+        d_ddec = known_ddec[nearby] - rates[cand_id,1]
+        likely = (d_total < known_match_radius) & \
+                 (numpy.fabs(d_dra) < known_rate_tolerance) & \
+                 (numpy.fabs(d_ddec) < known_rate_tolerance)
+        matches[cand_id] = numpy.sort(nearby[likely])
+
+    return matches
+
+
+
+def classify_candidates(candidates, sidereal_reference, min_rate, mpcfile=None, tracklet_format=None):
+    """
+
+    Match all tracklet candidates against the known objects from MPC, and 
+    write the region files, tracklet catalogs and (optionally) the MPC report.
+
+    """
+
+    logger = logging.getLogger("Astro(id)metry")
 
     # Query MPC for all objects nearby
     logger.info("Getting list of known objects from MPC")
@@ -838,21 +1362,38 @@ def find_moving_objects(sidereal_reference, inputlist, min_count, min_rate, mpcf
     #print mpc_data['RA'].shape
     #print mpc_data['RA']
 
-    mpc_ra = [None]*len(mpc_data['Name'])
-    mpc_dec = [None]*len(mpc_data['Name'])
-    # Convert the sexagesimal data from MPC into degrees
-    ds9_known = open("asteroidmetry_known.reg", "w")
-    print >>ds9_known, """\
+    # Convert the sexagesimal data from MPC into degrees (positions from 
+    # the local orbit engine are available in degrees already)
+    if ('ra_deg' in mpc_data):
+        mpc_ra = numpy.asarray(mpc_data['ra_deg'], dtype=numpy.float64)
+        mpc_dec = numpy.asarray(mpc_data['dec_deg'], dtype=numpy.float64)
+    else:
+        mpc_ra = podi_mpchecker.parse_sexagesimal(mpc_data['RA'], hours=True)
+        mpc_dec = podi_mpchecker.parse_sexagesimal(mpc_data['DEC'])
+    mpc_dra = numpy.asarray(mpc_data['dracosdec'], dtype=numpy.float64)
+    mpc_ddec = numpy.asarray(mpc_data['ddec'], dtype=numpy.float64)
+    mpc_names = numpy.array(mpc_data['Name'])
+
+    ds9_known = podi_asteroidreport.TextReport("asteroidmetry_known.reg")
+    ds9_known.add("""\
 # Region file format: DS9 version 4.1
 global color=red dashlist=8 3 width=1 font="helvetica 10 normal roman" select=1 highlite=1 dash=0 fixed=0 edit=1 move=1 delete=1 include=1 source=1
 fk5\
-"""
-    for i in range(len(mpc_data['Name'])):
-        j2000 = ephem.Equatorial(mpc_data['RA'][i], mpc_data['DEC'][i], epoch=ephem.J2000)
-        mpc_ra[i] = math.degrees(j2000.ra)
-        mpc_dec[i] = math.degrees(j2000.dec)
-        print >>ds9_known, 'circle(%f,%f,%f")' % (mpc_ra[i], mpc_dec[i], 3.) 
-    ds9_known.close()
+""")
+    for i in range(mpc_ra.shape[0]):
+        ds9_known.add('circle(%f,%f,%f")' % (mpc_ra[i], mpc_dec[i], 3.))
+    ds9_known.write()
+
+    #
+    # Match all candidates against the known objects at once
+    #
+    cand_radec = numpy.zeros((len(candidates), 2))
+    cand_rates = numpy.zeros((len(candidates), 2))
+    for cand_id in range(len(candidates)):
+        cand_radec[cand_id], _ = reference_position(candidates[cand_id], mjd_reference)
+        cand_rates[cand_id] = candidates[cand_id]['rate']
+    all_likely_ids = associate_known_objects(cand_radec, cand_rates, 
+                                             mpc_ra, mpc_dec, mpc_dra, mpc_ddec)
 
     #print mpc_ra
     #print mpc_dec
@@ -860,20 +1401,23 @@ fk5\
     #
     # Now go though each found asteroid, and see if it's known already
     #
-    ds9_reg = open("asteroidmetry.reg", "w")
-    print >>ds9_reg, """\
+    ds9_reg = podi_asteroidreport.TextReport("asteroidmetry.reg")
+    ds9_reg.add("""\
 # Region file format: DS9 version 4.1
 global color=green dashlist=8 3 width=1 font="helvetica 10 normal roman" select=1 highlite=1 dash=0 fixed=0 edit=1 move=1 delete=1 include=1 source=1
 fk5\
-"""
+""")
 
     # If requested, also write the information in the MPC-style into a separate MPC file
     mpc = None
     if (not mpcfile == None):
-        mpc = open(mpcfile, "w")
+        mpc = podi_asteroidreport.TextReport(mpcfile)
         
         # Write some basic info into MPC file
-        write_mpc_header(mpc)
+        mpc.extend(mpc_header())
+
+    # Collect the sources of all tracklets, written in one table at the end
+    tracklets = podi_asteroidreport.TrackletTable(output_format=tracklet_format)
 
     new_discovery_number = 0
     n_multiples = 0
@@ -899,9 +1443,7 @@ fk5\
         #
         # Save the catalogs with all sources in this tracklet
         #
-        if (True):
-            track_full = numpy.append(mjd_sorted.reshape((-1,1)), sex_sorted, axis=1)
-            numpy.savetxt("tracklet_%03d.cat" % (cand_id+1), track_full)
+        tracklets.add(cand_id+1, mjd_sorted, sex_sorted)
 
         radec_start = sex_sorted[0, 0:2]
         radec_end = sex_sorted[-1, 0:2]
@@ -915,44 +1457,13 @@ fk5\
         #
         # Correct all coordinates to match the MJD of the reference frame
         #
-        # Get time difference in hours
-        delta_mjd_hours = (cand['mjd'] - mjd_reference) * 24.
-        # total motion
-        delta_radec = numpy.array(cand['rate']).reshape((1,2)).repeat(delta_mjd_hours.shape[0], axis=0) \
-                      * delta_mjd_hours.reshape((delta_mjd_hours.shape[0],1)).repeat(2, axis=1)
-        # Account for the cos(dec) factor
-        cos_dec = numpy.cos(numpy.radians(cand['sex'][:,SXcolumn['dec']]))
-        delta_radec[:,0] /= cos_dec
-        ra_dec_corrected = cand['sex'][:,0:2] - delta_radec/3600.
-        radec = numpy.median(ra_dec_corrected, axis=0)
-        radec_std = numpy.std(ra_dec_corrected, axis=0)*3600.
-
+        radec, radec_std = reference_position(cand, mjd_reference)
 
-
-            
-
-
-        # With this information, search for asteroids that are both 
-        # nearby in Ra/Dec and in proper motion
-        #
-        # search radii: ra/dec: 5 arcsec, +/- 1''/hr
-
-        d_ra_cat = (mpc_ra - radec[0]) * math.cos(math.radians(radec[1]))
-        d_dec_cat = mpc_dec - radec[1]
-        d_total = numpy.hypot(d_ra_cat, d_dec_cat) * 3600. # convert to arcsec
-        # print d_total
-
-        d_dra = mpc_data['dracosdec'] - cand['rate'][0]
-        d_ddec = mpc_data['ddec'] - cand['rate'][1]
-        d_dtotal = numpy.hypot(d_dra, d_ddec) # this already is in arcsec/hr
-        # print d_dtotal
-
-        likely_id = (d_total < 5.) & (numpy.fabs(d_dra) < 1.5) & (numpy.fabs(d_ddec) < 1.5)
-
-        # numpy.savetxt(sys.stdout, likely_id)
+        # Known objects that are both nearby in Ra/Dec and in proper motion
+        likely_id = all_likely_ids[cand_id]
 
         new_discovery = False
-        n_likelies = numpy.sum(likely_id)
+        n_likelies = likely_id.shape[0]
         logger.info("This is candidate # %d ..." % (cand_id+1))
 
         counterpart_name = 'new'
@@ -963,22 +1474,20 @@ fk5\
         if (n_likelies == 0):
             logger.info("This is a new object")
             detection_class  = 'new'
-            print >>ds9_reg, '# text(%(ra)f,%(dec)f) color=%(color)s text={NEW %(id)d: %(dra).1f %(ddec).1f} ' % {
+            ds9_reg.add('# text(%(ra)f,%(dec)f) color=%(color)s text={NEW %(id)d: %(dra).1f %(ddec).1f} ' % {
                 'ra': radec[0],
                 'dec': radec[1],
                 'color': ds9_colors[detection_class],
                 'id': cand_id+1,
                 'dra': cand['rate'][0],
                 'ddec': cand['rate'][1],
-            }
+            })
             # print >>ds9_reg, '# text(%f,%f) text={NEW (%d): %.1f, %.1f}' % (radec[0], radec[1], cand_id+1, cand['rate'][0], cand['rate'][1])
 
             # If this object is not known, draw markers at all detected positions
             for i in range(cand['sex'].shape[0]):
-                print >>ds9_reg, 'point(%f,%f) # point=circle color=%s' % (cand['sex'][i,0], cand['sex'][i,1], ds9_colors[detection_class])
+                ds9_reg.add('point(%f,%f) # point=circle color=%s' % (cand['sex'][i,0], cand['sex'][i,1], ds9_colors[detection_class]))
 
-            logger.debug(d_total)
-            logger.debug(d_dtotal)
             new_discovery = True
             new_discovery_number += 1
             counterpart_name = "new_%d" % (cand_id+1)
@@ -987,7 +1496,7 @@ fk5\
         elif (n_likelies == 1):
 
             detection_class = 'known'
-            counterpart_name = (numpy.array(mpc_data['Name'])[likely_id])[0]
+            counterpart_name = mpc_names[likely_id][0]
             comment = (numpy.array(mpc_data['comment'])[likely_id])[0] if 'comment' in mpc_data else "none"
             logger.info("Found unique counterpart: %s" % (counterpart_name))
             if (not comment == None):
@@ -1000,17 +1509,17 @@ fk5\
 
                 if (not detection_class == 'known'):
                     for i in range(cand['sex'].shape[0]):
-                        print >>ds9_reg, 'point(%f,%f) # point=circle color=%s' % (
-                            cand['sex'][i,0], cand['sex'][i,1], ds9_colors[detection_class])
+                        ds9_reg.add('point(%f,%f) # point=circle color=%s' % (
+                            cand['sex'][i,0], cand['sex'][i,1], ds9_colors[detection_class]))
 
-            print >>ds9_reg, '# text(%(ra)f,%(dec)f) color=%(color)s text={%(name)s (%(dra).1f %(ddec).1f)} ' % {
+            ds9_reg.add('# text(%(ra)f,%(dec)f) color=%(color)s text={%(name)s (%(dra).1f %(ddec).1f)} ' % {
                 'ra': radec[0],
                 'dec': radec[1],
                 'color': ds9_colors[detection_class],
                 'name': counterpart_name,
                 'dra': cand['rate'][0],
                 'ddec': cand['rate'][1],
-            }
+            })
             designation = podi_mpchecker.mpc_name2id(counterpart_name)
             comment = "Incidental astrometry for %s" % (counterpart_name)
         else:
@@ -1019,17 +1528,16 @@ fk5\
             detection_class = 'multiple'
             logger.info("Found more than one likely counterpart")
             n_multiples += 1
-            likely_ids = numpy.arange(likely_id.shape[0])[likely_id] #
-            ds9_candidate_names = numpy.array(mpc_data['Name'])[likely_id]
+            ds9_candidate_names = mpc_names[likely_id]
             for cand_name in ds9_candidate_names:
                 logger.info("  Candidate: %s" % (cand_name))
             ds9_label = "-?-?-: " + " / ".join(ds9_candidate_names)
-            print >>ds9_reg, '# text(%(ra)f,%(dec)f) color=%(color)s text={%(name)s)} ' % {
+            ds9_reg.add('# text(%(ra)f,%(dec)f) color=%(color)s text={%(name)s)} ' % {
                 'ra': radec[0],
                 'dec': radec[1],
                 'color': ds9_colors[detection_class],
                 'name': ds9_label,
-            }
+            })
             # print >>ds9_reg, '# text(%f,%f) text={%s} color=%s' % (
             #     radec[0], radec[1], ds9_label, ds9_color[detection_class])
             comment = "More than one plausible counterpart identified"
@@ -1037,8 +1545,8 @@ fk5\
         candidates[cand_id]['new_discovery'] = new_discovery
         candidates[cand_id]['name'] = counterpart_name if (not new_discovery) else "NEW: %s" % (designation)
         candidates[cand_id]['comment'] = comment if (not comment == "") else "none"
+        candidates[cand_id]['detection_class'] = detection_class
 
-        time.sleep(0.01)
         logger.info("ra/dec: %s" % (str(radec)))
         logger.info("ra/dec corrected scatter: %s" % (str(radec_std)))
         logger.info("rate: %s" % (str(cand['rate'])))
@@ -1049,18 +1557,18 @@ fk5\
         # Draw a circle at the starting position of this tracklet, i.e. at the 
         # computed position of the source at the start-MJD of the reference frame
         #
-        print >>ds9_reg, 'circle(%f,%f,%f") # color=%s' % (
-            radec[0], radec[1], 5., ds9_colors[detection_class]) #13:22:17.482,-15:33:16.91,11.9449")
+        ds9_reg.add('circle(%f,%f,%f") # color=%s' % (
+            radec[0], radec[1], 5., ds9_colors[detection_class])) #13:22:17.482,-15:33:16.91,11.9449")
         #
         # Draw an arror from the first to the last position of this source
         #
-        print >>ds9_reg, 'line(%(ra0)f,%(dec0)f,%(ra1)f,%(dec1)f) # line=0 1 color=%(color)s' % {
+        ds9_reg.add('line(%(ra0)f,%(dec0)f,%(ra1)f,%(dec1)f) # line=0 1 color=%(color)s' % {
             'ra0': radec_start[0], 
             'dec0': radec_start[1],
             'ra1': radec_end[0], 
             'dec1': radec_end[1],
             'color': ds9_colors[detection_class],
-        }
+        })
 
         # print "\n".join(cand['formatted'])
         # numpy.savetxt(sys.stdout, cand['sex'][:,0:4])
@@ -1071,26 +1579,408 @@ fk5\
         all_fs.append("COM %s" % (comment))
         average_mag_error = numpy.median(sex_sorted[:, SXcolumn['mag_err_3.0']])
         all_fs.append("COM average photometric uncertainty: %.2f mag" % (average_mag_error))
+        obs_dates = astropy.time.Time(mjd_sorted, format='mjd', scale='utc').datetime
         for i_src in range(mjd_sorted.shape[0]):
             
             fs = format_source(sex_sorted[i_src], mjd_sorted[i_src], '3.0', 
                                discovery=new_discovery, 
                                designation=designation, 
-                               filter_name='r')
+                               filter_name='r',
+                               dt=obs_dates[i_src])
             new_discovery = False
             all_fs.append(fs)
         # logger.info("for MPC:\n------\n%s\n------\n\n" % ("\n".join(all_fs)))
         if (not mpc == None):
-            mpc.write(os.linesep.join(all_fs)+os.linesep)
+            mpc.extend(all_fs)
 
-    ds9_reg.close()
+    ds9_reg.write()
     if (not mpc == None):
-        mpc.close()
+        mpc.write(linesep=os.linesep)
+    tracklets.write()
 
     return candidates
 
 
 
+#############################################################################
+#
+# Streaming search: process frames one at a time as they come in, keeping 
+# all intermediate results in a state file
+#
+#############################################################################
+
+#
+# Flag marking sources identified as stationary in the streaming search, 
+# in addition to the -1 flag marking sources already used in a tracklet
+#
+static_source_flag = -2.
+
+
+def create_stream_state(min_count, min_rate):
+    """
+
+    Return an empty state for the streaming search. For each frame the state 
+    holds the catalog (with flags updated to mark used and stationary 
+    sources), the original SourceExtractor flags and the number of later 
+    epochs with a counterpart (for identifying stationary sources). It also 
+    keeps the motion rates of all pairs of sources found so far, and all 
+    tracklets found so far.
+
+    """
+
+    state = {
+        'min_count': min_count,
+        'min_rate': min_rate,
+        'files': [],
+        'mjd_hours': [],
+        'catalog': [],
+        'sex_flags': [],
+        'star_matches': [],
+        'center': None,
+        'motion_rates': numpy.zeros((0,7)),
+        'tracklets': [],
+    }
+    return state
+
+
+
+def load_stream_state(state_file, min_count, min_rate):
+
+    logger = logging.getLogger("StreamState")
+
+    if (not os.path.isfile(state_file)):
+        logger.info("Starting new streaming search (%s)" % (state_file))
+        return create_stream_state(min_count, min_rate)
+
+    with open(state_file, "rb") as sf:
+        state = pickle.load(sf)
+    logger.info("Continuing streaming search with %d frames and %d tracklets from %s" % (
+        len(state['files']), len(state['tracklets']), state_file))
+
+    if (not state['min_count'] == min_count or not state['min_rate'] == min_rate):
+        logger.warning("Using min. count/rate (%d, %.2f) from state file instead of (%d, %.2f)" % (
+            state['min_count'], state['min_rate'], min_count, min_rate))
+    return state
+
+
+
+def save_stream_state(state, state_file):
+
+    # Write to a temporary file first so we never leave a broken state file
+    tmp_file = "%s.tmp.%d" % (state_file, os.getpid())
+    with open(tmp_file, "wb") as sf:
+        pickle.dump(state, sf, protocol=pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp_file, state_file)
+
+
+
+def flatten_neighbors(neighbors):
+    """
+
+    Convert the list of neighbor lists returned by query_ball_point and 
+    query_ball_tree into two arrays of (query, neighbor) pairs.
+
+    """
+
+    n_neighbors = [len(n) for n in neighbors]
+    query = numpy.repeat(numpy.arange(len(neighbors)), n_neighbors)
+    match = numpy.fromiter(itertools.chain.from_iterable(neighbors), 
+                           dtype=int, count=query.shape[0])
+    return query, match
+
+
+
+def update_static_sources(state, match_radius=1./3600, min_epochs=4):
+    """
+
+    Update the list of stationary sources after the most recent frame has 
+    been added to the state, following the same rules as 
+    remove_static_sources: a source with counterparts in at least min_epochs
+    later frames is a star, and all its counterparts in later frames are 
+    removed as well.
+
+    Returns a boolean array marking all newly identified stationary sources
+    across all frames.
+
+    """
+
+    catalog = state['catalog']
+    new_frame = len(catalog) - 1
+
+    n_sources = numpy.array([cat.shape[0] for cat in catalog])
+    epoch = numpy.repeat(numpy.arange(len(catalog)), n_sources)
+    catalog_start = numpy.append([0], numpy.cumsum(n_sources))
+    all_positions = numpy.concatenate([cat[:,0:2] for cat in catalog], axis=0)
+    was_static = numpy.concatenate(
+        [cat[:,SXcolumn['flags']] == static_source_flag for cat in catalog])
+    is_static = was_static.copy()
+    star_matches = numpy.concatenate(state['star_matches'])
+
+    if (new_frame > 0):
+        # Find all counterparts of the new sources in earlier frames
+        earlier_tree = scipy.spatial.cKDTree(all_positions[:catalog_start[new_frame]])
+        new_tree = scipy.spatial.cKDTree(all_positions[catalog_start[new_frame]:])
+        new_src, earlier_src = flatten_neighbors(
+            new_tree.query_ball_tree(earlier_tree, r=match_radius, p=2))
+        new_src += catalog_start[new_frame]
+
+        # Sources matching a known star are removed right away
+        is_static[new_src[is_static[earlier_src]]] = True
+
+        # Count one more epoch for all sources with a counterpart
+        valid = ~is_static[earlier_src] & ~is_static[new_src]
+        star_matches[numpy.unique(earlier_src[valid])] += 1
+
+    # Now go through all epochs in order, and remove all new stars and their 
+    # counterparts in all later frames
+    all_tree = scipy.spatial.cKDTree(all_positions)
+    for c1 in range(new_frame):
+        is_a_star = (epoch == c1) & ~is_static & (star_matches >= min_epochs)
+        if (numpy.sum(is_a_star) <= 0):
+            continue
+        is_static[is_a_star] = True
+
+        star, match = flatten_neighbors(
+            all_tree.query_ball_point(all_positions[is_a_star], r=match_radius, p=2))
+        is_static[match[epoch[match] > c1]] = True
+
+    new_static = is_static & ~was_static
+    for i in range(len(catalog)):
+        this_frame = slice(catalog_start[i], catalog_start[i+1])
+        catalog[i][:, SXcolumn['flags']][new_static[this_frame]] = static_source_flag
+        state['star_matches'][i] = star_matches[this_frame]
+
+    return new_static
+
+
+
+def release_tracklet(state, tracklet):
+    """
+
+    Dissolve a tracklet, making all its sources available again (unless 
+    they have been found to be stationary in the meantime).
+
+    """
+
+    for c, o in [tracklet['anchor']] + [(int(t[1]), int(t[3])) for t in tracklet['tracklet']]:
+        if (not state['catalog'][c][o, SXcolumn['flags']] == static_source_flag):
+            state['catalog'][c][o, SXcolumn['flags']] = state['sex_flags'][c][o]
+
+
+
+def rate_group_keys(motion_rates):
+    # Unique key for each reference source, sorting by catalog first and 
+    # source second
+    return motion_rates[:,0].astype(numpy.int64) * (2**32) + motion_rates[:,2].astype(numpy.int64)
+
+
+
+def add_frame_to_stream(state, fitsfile, cat_data, mjd_middle,
+                        min_distance, max_rate, rate_radius=1):
+    """
+
+    Add a new frame to the streaming search: update the list of stationary 
+    sources, compute motion rates between all earlier sources and the new 
+    frame (earlier pairs are kept in the state and never recomputed), 
+    extend existing tracklets with sources in the new frame, and search for 
+    new tracklets among all sources that gained new motion rates.
+
+    """
+
+    logger = logging.getLogger("StreamSearch")
+
+    min_count = state['min_count']
+    min_rate = state['min_rate']
+    catalog = state['catalog']
+    mjd_hours = state['mjd_hours']
+    flags = SXcolumn['flags']
+
+    new_frame = len(catalog)
+    state['files'].append(fitsfile)
+    mjd_hours.append(mjd_middle)
+    catalog.append(cat_data)
+    state['sex_flags'].append(cat_data[:, flags].copy())
+    state['star_matches'].append(numpy.zeros((cat_data.shape[0]), dtype=int))
+    if (state['center'] == None):
+        state['center'] = build_catalog_index([cat_data])['center']
+    logger.info("Adding frame %d (%s, %d sources)" % (new_frame+1, fitsfile, cat_data.shape[0]))
+
+    #
+    # Remove all stationary sources, and forget about all motion rates and 
+    # tracklets involving them
+    #
+    new_static = update_static_sources(state)
+    if (numpy.sum(new_static) > 0):
+        catalog_start = numpy.append([0], numpy.cumsum([cat.shape[0] for cat in catalog]))
+        motion_rates = state['motion_rates']
+        involves_static = \
+            new_static[catalog_start[motion_rates[:,0].astype(int)] + motion_rates[:,2].astype(int)] | \
+            new_static[catalog_start[motion_rates[:,1].astype(int)] + motion_rates[:,3].astype(int)]
+        state['motion_rates'] = motion_rates[~involves_static]
+
+        for tracklet in list(state['tracklets']):
+            members = [tracklet['anchor']] + [(int(t[1]), int(t[3])) for t in tracklet['tracklet']]
+            if (numpy.any([catalog[c][o, flags] == static_source_flag for c,o in members])):
+                logger.debug("Dropping tracklet with stationary sources")
+                release_tracklet(state, tracklet)
+                state['tracklets'].remove(tracklet)
+    logger.debug("%d stationary sources" % (numpy.sum([numpy.sum(cat[:,flags] == static_source_flag) for cat in catalog])))
+
+    #
+    # Compute the motion rates of all available sources in earlier frames 
+    # (and all tracklet anchors, to extend tracklets) to the new frame
+    #
+    new_index = build_catalog_index([cat_data], center=state['center'])
+    new_index['trees'] = [None] + new_index['trees']
+    new_rates = [numpy.zeros((0,7))]
+    for ref_cat in range(new_frame):
+        is_anchor = numpy.zeros((catalog[ref_cat].shape[0]), dtype=bool)
+        for tracklet in state['tracklets']:
+            if (tracklet['anchor'][0] == ref_cat):
+                is_anchor[tracklet['anchor'][1]] = True
+        obj_ids = numpy.arange(catalog[ref_cat].shape[0])[
+            (catalog[ref_cat][:,flags] >= 0) | is_anchor]
+        if (obj_ids.shape[0] <= 0):
+            continue
+
+        rates, _ = chunk_motion_rates([catalog[ref_cat], cat_data],
+                                      [mjd_hours[ref_cat], mjd_middle],
+                                      [numpy.arange(catalog[ref_cat].shape[0]), 
+                                       numpy.arange(cat_data.shape[0])],
+                                      0, obj_ids, min_distance, max_rate,
+                                      catalog_index=new_index)
+        rates[:,0] = ref_cat
+        rates[:,1] = new_frame
+        new_rates.append(rates)
+    new_rates = numpy.concatenate(new_rates, axis=0)
+    new_keys = rate_group_keys(new_rates)
+
+    # Keep all motion rates sorted by reference source; the stable sort 
+    # keeps them in frame order within each group
+    motion_rates = numpy.append(state['motion_rates'], new_rates, axis=0)
+    motion_rates = motion_rates[numpy.argsort(rate_group_keys(motion_rates), kind='mergesort')]
+    state['motion_rates'] = motion_rates
+
+    #
+    # Extend existing tracklets with a source in the new frame matching 
+    # the motion rate of the tracklet
+    #
+    n_extended = 0
+    for tracklet in state['tracklets']:
+        ref_cat, obj1 = tracklet['anchor']
+        key = ref_cat * (2**32) + obj1
+        rates = new_rates[new_keys == key]
+        rates = rates[cat_data[rates[:,3].astype(int), flags] >= 0]
+        close_rates = numpy.hypot(rates[:,4] - tracklet['rate'][0], 
+                                  rates[:,5] - tracklet['rate'][1]) <= rate_radius
+        if (not numpy.sum(close_rates) == 1):
+            continue
+        new_rate = rates[close_rates][0]
+        o2 = int(new_rate[3])
+
+        # Re-validate the tracklet including the new source
+        tracklet_sources = numpy.zeros((tracklet['positions']+1, catalog[0].shape[1]+1))
+        tracklet_sources[:-1, 0] = tracklet['mjd'] * 24.
+        tracklet_sources[:-1, 1:] = tracklet['sex']
+        tracklet_sources[-1, 0] = mjd_middle
+        tracklet_sources[-1, 1:] = cat_data[o2]
+        if (not is_valid_tracklet(tracklet_sources, min_rate, logger)):
+            continue
+
+        cat_data[o2, flags] = -1.
+        tracklet['sex'] = numpy.append(tracklet['sex'], cat_data[o2].reshape((1,-1)), axis=0)
+        tracklet['mjd'] = numpy.append(tracklet['mjd'], [mjd_middle / 24.])
+        tracklet['formatted'].append(format_source(cat_data[o2], mjd_middle/24., '3.0'))
+        tracklet['tracklet'] = numpy.append(tracklet['tracklet'], new_rate.reshape((1,-1)), axis=0)
+        tracklet['positions'] = tracklet['sex'].shape[0]
+        tracklet['rate'] = numpy.median(tracklet['tracklet'][:,4:6], axis=0)
+        n_extended += 1
+
+    #
+    # Now search for new tracklets, starting at all sources with new motion 
+    # rates, and enough later frames for a valid tracklet
+    #
+    all_flags = numpy.concatenate([cat[:, flags] for cat in catalog])
+    catalog_start = numpy.append([0], numpy.cumsum([cat.shape[0] for cat in catalog]))
+    can_start_tracklet = (new_rates[:,0] < len(catalog)-1-min_count) & \
+        (all_flags[catalog_start[new_rates[:,0].astype(int)] + new_rates[:,2].astype(int)] >= 0)
+    search_keys = numpy.unique(new_keys[can_start_tracklet])
+    search_rates = motion_rates[numpy.isin(rate_group_keys(motion_rates), search_keys)]
+
+    # Only use counterparts that are still available
+    available = all_flags[catalog_start[search_rates[:,1].astype(int)] + 
+                          search_rates[:,3].astype(int)] >= 0
+    search_rates = search_rates[available]
+    search_keys, owners = numpy.unique(rate_group_keys(search_rates), return_inverse=True)
+
+    new_tracklets = []
+    if (search_rates.shape[0] > 0):
+        n_rates = numpy.bincount(owners, minlength=search_keys.shape[0])
+        row_end = numpy.cumsum(n_rates)
+        row_start = row_end - n_rates
+        search_rates[:,6] = count_rate_neighbors(search_rates, owners, rate_radius, max_rate)
+        ratecount_max = numpy.maximum.reduceat(search_rates[:,6], row_start)
+        promising = (n_rates >= 5) & (ratecount_max >= min_count)
+
+        new_tracklets = tracklets_from_rate_groups(catalog, mjd_hours, search_rates,
+                                                   row_start[promising], row_end[promising],
+                                                   min_count, min_rate, max_rate, rate_radius)
+
+    for tracklet in new_tracklets:
+        # Also mark the first source as used, so it can't become part of 
+        # tracklets found later on
+        tracklet['anchor'] = (int(tracklet['tracklet'][0,0]), int(tracklet['tracklet'][0,2]))
+        catalog[tracklet['anchor'][0]][tracklet['anchor'][1], flags] = -1.
+        state['tracklets'].append(tracklet)
+
+    logger.info("Frame %d: extended %d tracklets, found %d new tracklets (%d total)" % (
+        new_frame+1, n_extended, len(new_tracklets), len(state['tracklets'])))
+
+    return
+
+
+
+def find_moving_objects_streaming(sidereal_reference, inputlist, min_count, min_rate, 
+                                  mpcfile=None, state_file="asteroidmetry.state"):
+    """
+
+    Streaming version of find_moving_objects. All frames in inputlist not 
+    yet handled in an earlier call (as recorded in state_file) are added 
+    one by one, in the given order, extending the tracklets found so far. 
+
+    """
+
+    logger = logging.getLogger("Astro(id)metry")
+
+    state = load_stream_state(state_file, min_count, min_rate)
+
+    max_rate = 500 # arcsec / hour
+    min_distance = 2. / 3600. # arcsec
+    radius = 1.
+
+    new_files = [fn for fn in inputlist if not fn in state['files']]
+    logger.info("Adding %d new frames to the streaming search" % (len(new_files)))
+    if (len(new_files) > 0):
+        podi_makecatalogs.make_catalogs(new_files, "moving.sex", "moving.sexparam")
+
+    for fitsfile in new_files:
+        frame = load_frame_catalog(fitsfile)
+        if (frame == None):
+            logger.warning("Unable to use catalog for %s" % (fitsfile))
+            continue
+        cat_data, mjd_middle, filter_name = frame
+
+        add_frame_to_stream(state, fitsfile, cat_data, mjd_middle,
+                            min_distance, max_rate, rate_radius=radius)
+        # Save the state after each frame, so we can pick up from here
+        save_stream_state(state, state_file)
+
+    # Work on a copy, so the state only holds the raw tracklets
+    candidates = copy.deepcopy(state['tracklets'])
+    return classify_candidates(candidates, sidereal_reference, state['min_rate'], mpcfile)
+
+
+
 if __name__ == "__main__":
 
     
@@ -1103,6 +1993,25 @@ if __name__ == "__main__":
     min_rate = float(cmdline_arg_set_or_default('-minrate', 2))
     mpc_file = cmdline_arg_set_or_default('-mpc', None)
 
+    # -orbits=MPCORB.DAT computes all known objects locally instead of 
+    # asking the MPC
+    if (cmdline_arg_isset("-orbits")):
+        podi_orbits.mpcorb_file = get_cmdline_arg("-orbits")
+
+    # -tracklets=fits|npz|text|none selects the output for the sources of all
+    # tracklets (text: one tracklet_XXX.cat file per candidate, as before)
+    if (cmdline_arg_isset("-tracklets")):
+        tracklet_output = get_cmdline_arg("-tracklets")
+        if (not tracklet_output in podi_asteroidreport.tracklet_formats):
+            logger.critical("Unknown tracklet output %s, use one of %s" % (
+                tracklet_output, ", ".join(podi_asteroidreport.tracklet_formats)))
+            podi_logging.shutdown_logging(options)
+            sys.exit(1)
+        podi_asteroidreport.tracklet_output = tracklet_output
+
+    # All results are added to this database, see podi_candidatedb
+    candidate_db = cmdline_arg_set_or_default("-candidatedb", podi_candidatedb.default_filename)
+
     try:
         import cPickle as pickle
     except ImportError:
@@ -1113,9 +2022,16 @@ if __name__ == "__main__":
         ref_file = get_clean_cmdline()[1]
         region_file = get_clean_cmdline()[2]
 
-        pickle_file = cmdline_arg_set_or_default("-pickle", "asteroidmetry.pickle")
-        with open(pickle_file, "rb") as pf:
-            candidates = pickle.load(pf)
+        if (cmdline_arg_isset("-pickle")):
+            # results of older versions
+            with open(get_cmdline_arg("-pickle"), "rb") as pf:
+                candidates = pickle.load(pf)
+        else:
+            # Only load the classified candidates of the selected run (the
+            # most recent one by default)
+            with podi_candidatedb.CandidateDB(candidate_db) as db:
+                candidates = db.candidates(run=cmdline_arg_set_or_default("-run", "last"),
+                                           named=True)
 
         draw_points = cmdline_arg_isset("-points")
         draw_lines = cmdline_arg_isset("-lines")
@@ -1123,12 +2039,12 @@ if __name__ == "__main__":
         # for cand in candidates:
         #     print cand['rate']
 
-        ds9_reg = open(region_file, "w")
-        print >>ds9_reg, """\
+        ds9_reg = podi_asteroidreport.TextReport(region_file)
+        ds9_reg.add("""\
         # Region file format: DS9 version 4.1
         global color=green dashlist=8 3 width=1 font="helvetica 10 normal roman" select=1 highlite=1 dash=0 fixed=0 edit=1 move=1 delete=1 include=1 source=1
         fk5\
-        """
+        """)
         
         hdulist = astropy.io.fits.open(ref_file)
         rel_ra = rel_dec = rel_mjd = 0
@@ -1165,14 +2081,14 @@ if __name__ == "__main__":
             # Draw a circle for each detection
             if (draw_points):
                 for i in range(cand['sex'].shape[0]):
-                    print >>ds9_reg, 'point(%f,%f) # point=circle' % (ra_fixed[i], dec_fixed[i])
+                    ds9_reg.add('point(%f,%f) # point=circle' % (ra_fixed[i], dec_fixed[i]))
             if (draw_lines):
                 for i in range(1, cand['sex'].shape[0]):
-                    print >>ds9_reg, 'line %f %f %f %f' % (ra_fixed[i-1], dec_fixed[i-1], ra_fixed[i], dec_fixed[i])
+                    ds9_reg.add('line %f %f %f %f' % (ra_fixed[i-1], dec_fixed[i-1], ra_fixed[i], dec_fixed[i]))
                     #print >>ds9_reg, 'point(%f,%f) # point=circle' % (ra_fixed[i], dec_fixed[i])
             if (label_point):
                 for i in range(cand['sex'].shape[0]):
-                    print >>ds9_reg, '# text(%f,%f) text={%d} font="times 24"' % (ra_fixed[i], dec_fixed[i], i+1)
+                    ds9_reg.add('# text(%f,%f) text={%d} font="times 24"' % (ra_fixed[i], dec_fixed[i], i+1))
 
             # Add some label with the name
             # Use the coordinates of the first recorded point, and correct 
@@ -1184,12 +2100,12 @@ if __name__ == "__main__":
             ra0 = cand['sex'][0,0] - dra0 / math.cos(math.radians(dec0))
 
             try:
-                print >>ds9_reg, '# text(%f,%f) text={%s}' % (ra0, dec0, cand['name'])
+                ds9_reg.add('# text(%f,%f) text={%s}' % (ra0, dec0, cand['name']))
                 if (draw_lines):
-                    print >>ds9_reg, 'line %f %f %f %f' % (ra_fixed[0], dec_fixed[0], ra0, dec0)
+                    ds9_reg.add('line %f %f %f %f' % (ra_fixed[0], dec_fixed[0], ra0, dec0))
             except:
                 pass
-        ds9_reg.close()
+        ds9_reg.write()
 
                 
     elif (cmdline_arg_isset("-check")):
@@ -1251,7 +2167,7 @@ if __name__ == "__main__":
         catalog = []
         for fitsfile in inputlist:
             catalog_filename = fitsfile[:-5]+".cat"
-            cat_data = numpy.loadtxt(catalog_filename)
+            cat_data = podi_catalogcache.load_catalog(catalog_filename, fitsfile)
             catalog.append(cat_data)
             
         import cProfile, pstats
@@ -1282,10 +2198,23 @@ if __name__ == "__main__":
                         inputlist.append(filename)
         print "After adding -fromfile:\n","\n".join(inputlist)
 
-        candidates = find_moving_objects(sidereal_reference, inputlist, min_count, min_rate, mpc_file)
+        # -legacysearch runs the original one-source-at-a-time tracklet search
+        batch_search = not cmdline_arg_isset("-legacysearch")
+
+        if (cmdline_arg_isset("-stream")):
+            # Keep all intermediate results in a state file, and only add 
+            # frames not handled in earlier runs
+            state_file = cmdline_arg_set_or_default("-statefile", "asteroidmetry.state")
+            candidates = find_moving_objects_streaming(sidereal_reference, inputlist, 
+                                                       min_count, min_rate, mpc_file,
+                                                       state_file=state_file)
+        else:
+            candidates = find_moving_objects(sidereal_reference, inputlist, min_count, min_rate, mpc_file,
+                                             batch_search=batch_search)
 
-        with open("asteroidmetry.pickle", "wb") as pf:
-            pickle.dump(candidates, pf)
+        # Add all candidates as a new run to the candidate database
+        with podi_candidatedb.CandidateDB(candidate_db) as db:
+            db.add_run(candidates, reference=sidereal_reference)
             
         # print candidates[0]
 
@@ -0,0 +1,150 @@
+#
+# Copyright (C) 2014, Ralf Kotulla
+#                     kotulla@uwm.edu
+#
+# All rights reserved
+#
+
+"""
+
+Output stage for the asteroid search: DS9 region files, MPC reports and the
+tracklet catalogs.
+
+All records are collected in memory while the candidates are processed, and
+each file is written in one go (atomically, see podi_catalogcache) at the
+end, instead of one write per line.
+
+The sources of all tracklets go into one table (tracklet_output):
+
+  fits -- one FITS table, with the candidate number and MJD of each source
+          followed by all catalog columns (default)
+  npz  -- the same in a numpy archive
+  text -- one text file per candidate (tracklet_001.cat, ...), as before
+  none -- no tracklet catalogs
+
+"""
+
+import os
+import logging
+import numpy
+import astropy.io.fits
+
+from podi_definitions import *
+from podi_catalogcache import write_atomic
+
+tracklet_formats = ['fits', 'npz', 'text', 'none']
+tracklet_output = 'fits'
+
+
+
+class TextReport(object):
+    """
+
+    Collect the lines of a text file (region file, MPC report, ...).
+
+    """
+
+    def __init__(self, filename, header=None):
+        self.filename = filename
+        self.lines = []
+        if (header is not None):
+            self.extend(header.split("\n"))
+
+    def add(self, line):
+        self.lines.append(line)
+
+    def extend(self, lines):
+        self.lines.extend(lines)
+
+    def write(self, linesep="\n"):
+        def write_report(filename):
+            with open(filename, "w") as f:
+                if (len(self.lines) > 0):
+                    f.write(linesep.join(self.lines) + linesep)
+        write_atomic(self.filename, write_report)
+        return self.filename
+
+
+
+class TrackletTable(object):
+    """
+
+    Collect the sources of all tracklets, and write them in the format
+    selected by tracklet_output (the file extension is added to filename).
+
+    """
+
+    def __init__(self, filename="asteroidmetry_tracklets", output_format=None):
+        self.filename = filename
+        self.output_format = tracklet_output if output_format is None else output_format
+        if (not self.output_format in tracklet_formats):
+            raise ValueError("Unknown tracklet format %s, use one of %s" % (
+                self.output_format, ", ".join(tracklet_formats)))
+        self.candidates = []
+        self.logger = logging.getLogger("TrackletTable")
+
+    def add(self, cand_id, mjd, sources):
+        """
+
+        Add the sources (catalog rows) of candidate cand_id, observed at mjd.
+
+        """
+
+        if (self.output_format == 'none'):
+            return
+        self.candidates.append((cand_id, numpy.asarray(mjd), numpy.asarray(sources)))
+
+    def table(self):
+        """
+
+        Return candidate numbers, MJDs and catalog rows of all sources.
+
+        """
+
+        if (len(self.candidates) <= 0):
+            return numpy.zeros(0, dtype=int), numpy.zeros(0), numpy.zeros((0, len(SXcolumn_names)))
+        cand_ids = numpy.concatenate([numpy.repeat(c[0], c[1].shape[0]) for c in self.candidates])
+        mjd = numpy.concatenate([c[1] for c in self.candidates])
+        sources = numpy.concatenate([c[2] for c in self.candidates], axis=0)
+        return cand_ids, mjd, sources
+
+    def write(self):
+        """
+
+        Write all tracklets; returns the name of the file written, if any.
+
+        """
+
+        if (self.output_format == 'none'):
+            return None
+
+        if (self.output_format == 'text'):
+            for (cand_id, mjd, sources) in self.candidates:
+                numpy.savetxt("tracklet_%03d.cat" % (cand_id),
+                              numpy.append(mjd.reshape((-1,1)), sources, axis=1))
+            return None
+
+        cand_ids, mjd, sources = self.table()
+
+        if (self.output_format == 'npz'):
+            filename = self.filename + ".npz"
+            def write_archive(fn):
+                with open(fn, "wb") as f:
+                    numpy.savez(f, candidate=cand_ids, mjd=mjd, sources=sources,
+                                columns=numpy.array(SXcolumn_names))
+            write_atomic(filename, write_archive)
+        else:
+            filename = self.filename + ".fits"
+            columns = [astropy.io.fits.Column(name='CANDIDATE', format='J', array=cand_ids),
+                       astropy.io.fits.Column(name='MJD', format='D', array=mjd)]
+            for key in SXcolumn_names:
+                columns.append(astropy.io.fits.Column(name=key, format='D',
+                                                      array=sources[:, SXcolumn[key]]))
+            hdu = astropy.io.fits.BinTableHDU.from_columns(columns)
+            hdu.name = "TRACKLETS"
+            hdulist = astropy.io.fits.HDUList([astropy.io.fits.PrimaryHDU(), hdu])
+            write_atomic(filename, lambda fn: hdulist.writeto(fn))
+
+        self.logger.info("Wrote %d sources of %d tracklets to %s" % (
+            mjd.shape[0], len(self.candidates), filename))
+        return filename
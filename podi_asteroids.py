@@ -26,6 +26,7 @@ bn, _ = os.path.split(os.path.abspath(sys.argv[0]))
 sys.path.append(bn+"/../")
 from podi_commandline import *
 import podi_mpchecker
+import podi_orbits
 
 
 mjd0 = + 2400000.5
@@ -157,7 +158,12 @@ def get_asteroid_list_from_fitsfile(fitsfile):
     dec = center_coord[0,1]
     sr = 0.4
 
-    votab = get_minorobjects(epoch, ra, dec, sr)
+    if (podi_orbits.mpcorb_file is not None):
+        # Compute all positions locally instead of asking SkyBoT
+        votab = podi_orbits.ObjectTable(
+            podi_orbits.known_objects(epoch - mjd0, ra, dec, sr))
+    else:
+        votab = get_minorobjects(epoch, ra, dec, sr)
 
     hdulist.close()
 
@@ -169,6 +175,9 @@ if __name__ == "__main__":
 
     fitsfile = sys.argv[1]
 
+    if (cmdline_arg_isset("-orbits")):
+        podi_orbits.mpcorb_file = get_cmdline_arg("-orbits")
+
     if (cmdline_arg_isset("-mpc")):
         mp_data = podi_mpchecker.get_mpc_catalog(fitsfile)
         print mp_data
@@ -28,10 +28,7 @@ import scipy.stats
 import Image
 import ImageDraw
 
-try:
-    import cPickle as pickle
-except ImportError:
-    import pickle
+import podi_candidatedb
 
 
 if __name__ == "__main__":
@@ -62,9 +59,25 @@ if __name__ == "__main__":
 
     margin = 1 # arcmin
 
-    candidates = None
-    with open("asteroidmetry.pickle", "rb") as pf:
-        candidates = pickle.load(pf)
+    #
+    # Only load the classified candidates within the reference frame from the 
+    # candidate database (of the most recent run, unless -run is given)
+    #
+    ny, nx = hdulist[0].data.shape
+    ref_corners = wcs.wcs_pix2world([[0, 0], [nx-1, 0], [0, ny-1], [nx-1, ny-1]], 0)
+    ref_center = wcs.wcs_pix2world([[0.5*(nx-1), 0.5*(ny-1)]], 0)[0]
+    cos_dec_center = math.cos(math.radians(ref_center[1]))
+    ref_radius = numpy.max(numpy.hypot(
+        ((ref_corners[:,0] - ref_center[0] + 180.) % 360. - 180.) * cos_dec_center, 
+        ref_corners[:,1] - ref_center[1]))
+
+    candidate_db = cmdline_arg_set_or_default("-candidatedb", podi_candidatedb.default_filename)
+    with podi_candidatedb.CandidateDB(candidate_db) as db:
+        candidates = db.candidates(run=cmdline_arg_set_or_default("-run", "last"),
+                                   named=True,
+                                   ra=ref_center[0], dec=ref_center[1],
+                                   radius=ref_radius + margin/60.)
+    logger.info("Found %d candidates within the reference frame" % (len(candidates)))
 
     all_bglevels = {}
     all_bglevel_std = {}
@@ -0,0 +1,329 @@
+#
+# Copyright (C) 2014, Ralf Kotulla
+#                     kotulla@uwm.edu
+#
+# All rights reserved
+#
+
+"""
+
+Database of the moving-object candidates found by podi_asteroidmetry, shared
+with the tools working on these results (the -writeregion mode,
+podi_asteroidstalker, ...).
+
+The database is a single SQLite file. Each search adds a new run (e.g. one
+per night), so results of several runs can be kept in the same file. Each
+candidate is one row in the candidates table, with its name, classification,
+motion rate and sky position (center of all detections), all of which
+are indexed. The detections of each candidate (catalog rows, MJDs and the
+tracklet) are stored as numpy arrays in a separate table, and are only loaded
+for the candidates that were selected.
+
+Usage:
+
+  db = podi_candidatedb.CandidateDB("asteroidmetry.db")
+  run = db.add_run(candidates, reference="stack.fits")
+  ...
+  rows = db.select(detection_class='new', min_rate=5, ra=ra, dec=dec, radius=0.2)
+  candidates = db.load(rows)
+
+"""
+
+import io
+import json
+import math
+import time
+import numpy
+import sqlite3
+import logging
+
+import podi_coordinates
+
+default_filename = "asteroidmetry.db"
+
+schema = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created REAL,
+    reference TEXT,
+    n_candidates INTEGER
+);
+CREATE TABLE IF NOT EXISTS candidates (
+    cand_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    run_id INTEGER NOT NULL REFERENCES runs(run_id),
+    number INTEGER,
+    name TEXT,
+    detection_class TEXT,
+    new_discovery INTEGER,
+    comment TEXT,
+    rate_ra REAL,
+    rate_dec REAL,
+    rate REAL,
+    ra REAL,
+    dec REAL,
+    mjd_start REAL,
+    mjd_end REAL,
+    positions INTEGER
+);
+CREATE TABLE IF NOT EXISTS detections (
+    cand_id INTEGER PRIMARY KEY REFERENCES candidates(cand_id),
+    sex BLOB,
+    mjd BLOB,
+    tracklet BLOB,
+    formatted TEXT
+);
+CREATE INDEX IF NOT EXISTS candidates_run ON candidates(run_id, number);
+CREATE INDEX IF NOT EXISTS candidates_name ON candidates(name);
+CREATE INDEX IF NOT EXISTS candidates_class ON candidates(detection_class);
+CREATE INDEX IF NOT EXISTS candidates_rate ON candidates(rate);
+CREATE INDEX IF NOT EXISTS candidates_position ON candidates(dec, ra);
+"""
+
+candidate_columns = ['cand_id', 'run_id', 'number', 'name', 'detection_class',
+                     'new_discovery', 'comment', 'rate_ra', 'rate_dec', 'rate',
+                     'ra', 'dec', 'mjd_start', 'mjd_end', 'positions']
+
+
+
+def array_to_blob(array):
+    if (array is None):
+        return None
+    buf = io.BytesIO()
+    numpy.save(buf, numpy.asarray(array), allow_pickle=False)
+    return sqlite3.Binary(buf.getvalue())
+
+
+
+def blob_to_array(blob):
+    if (blob is None):
+        return None
+    return numpy.load(io.BytesIO(bytes(blob)), allow_pickle=False)
+
+
+
+class CandidateDB(object):
+
+    def __init__(self, filename=default_filename):
+
+        self.filename = filename
+        self.logger = logging.getLogger("CandidateDB")
+
+        self.db = sqlite3.connect(filename)
+        self.db.executescript(schema)
+        self.db.commit()
+
+    def close(self):
+        if (self.db is not None):
+            self.db.close()
+        self.db = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def runs(self):
+        """
+
+        Return (run_id, created, reference, n_candidates) of all runs, oldest
+        first.
+
+        """
+
+        return self.db.execute(
+            "SELECT run_id, created, reference, n_candidates FROM runs ORDER BY run_id").fetchall()
+
+    def last_run(self):
+        row = self.db.execute("SELECT MAX(run_id) FROM runs").fetchone()
+        return row[0]
+
+    def add_run(self, candidates, reference=None):
+        """
+
+        Add all candidates (as returned by find_moving_objects) as a new run,
+        and return its run_id.
+
+        """
+
+        with self.db:
+            cursor = self.db.execute(
+                "INSERT INTO runs (created, reference, n_candidates) VALUES (?, ?, ?)",
+                (time.time(), reference, len(candidates)))
+            run_id = cursor.lastrowid
+
+            for number, cand in enumerate(candidates):
+                sex = numpy.asarray(cand['sex'])
+                mjd = numpy.asarray(cand['mjd'])
+                rate = cand['rate'] if ('rate' in cand) else (numpy.nan, numpy.nan)
+                # from the average unit vector, so tracklets crossing 
+                # RA=0/360 do not end up on the other side of the sky
+                ra, dec = podi_coordinates.sky_center(sex[:,0], sex[:,1]) \
+                          if (sex.shape[0] > 0) else (None, None)
+                values = {
+                    'run_id': run_id,
+                    'number': number+1,
+                    'name': cand.get('name'),
+                    'detection_class': cand.get('detection_class'),
+                    'new_discovery': None if (not 'new_discovery' in cand) else int(cand['new_discovery']),
+                    'comment': cand.get('comment'),
+                    'rate_ra': float(rate[0]),
+                    'rate_dec': float(rate[1]),
+                    'rate': float(numpy.hypot(rate[0], rate[1])),
+                    'ra': ra,
+                    'dec': dec,
+                    'mjd_start': float(numpy.min(mjd)) if (mjd.shape[0] > 0) else None,
+                    'mjd_end': float(numpy.max(mjd)) if (mjd.shape[0] > 0) else None,
+                    'positions': int(cand.get('positions', sex.shape[0])),
+                }
+                keys = candidate_columns[1:]
+                cursor = self.db.execute(
+                    "INSERT INTO candidates (%s) VALUES (%s)" % (
+                        ", ".join(keys), ", ".join(["?"] * len(keys))),
+                    [values[k] for k in keys])
+
+                formatted = cand.get('formatted')
+                self.db.execute(
+                    "INSERT INTO detections (cand_id, sex, mjd, tracklet, formatted) VALUES (?, ?, ?, ?, ?)",
+                    (cursor.lastrowid, array_to_blob(sex), array_to_blob(mjd),
+                     array_to_blob(cand.get('tracklet')),
+                     None if formatted is None else json.dumps(list(formatted))))
+
+        self.logger.info("Added %d candidates as run %d to %s" % (
+            len(candidates), run_id, self.filename))
+        return run_id
+
+    def select(self, run=None, name=None, detection_class=None, named=False,
+               min_rate=None, max_rate=None, ra=None, dec=None, radius=None):
+        """
+
+        Return the candidates (as dictionaries of the indexed columns, without
+        the detections) matching all given criteria:
+
+          run -- run_id, or 'last' for the most recent run
+          name -- exact name, or a pattern with % as wildcard
+          detection_class -- one class, or a list of classes
+          named -- only candidates that were classified (i.e. have a name)
+          min_rate, max_rate -- total motion rate, in arcsec/hour
+          ra, dec, radius -- position within radius (all degrees)
+
+        """
+
+        where = []
+        args = []
+
+        if (run == 'last'):
+            run = self.last_run()
+        if (run is not None):
+            where.append("run_id = ?")
+            args.append(int(run))
+
+        if (name is not None):
+            where.append("name LIKE ?" if ('%' in name) else "name = ?")
+            args.append(name)
+        if (named):
+            where.append("name IS NOT NULL")
+
+        if (detection_class is not None):
+            if (not isinstance(detection_class, (list, tuple))):
+                detection_class = [detection_class]
+            where.append("detection_class IN (%s)" % (", ".join(["?"] * len(detection_class))))
+            args.extend(detection_class)
+
+        if (min_rate is not None):
+            where.append("rate >= ?")
+            args.append(min_rate)
+        if (max_rate is not None):
+            where.append("rate <= ?")
+            args.append(max_rate)
+
+        if (radius is not None):
+            # use the index to select a box around the position, and only
+            # compute the exact distance for the candidates in the box
+            where.append("dec BETWEEN ? AND ?")
+            args.extend([dec - radius, dec + radius])
+            max_dec = min(89.999, math.fabs(dec) + radius)
+            ra_width = radius / math.cos(math.radians(max_dec))
+            if (ra_width < 180.):
+                ra_min = (ra - ra_width) % 360.
+                ra_max = (ra + ra_width) % 360.
+                if (ra_min <= ra_max):
+                    where.append("ra BETWEEN ? AND ?")
+                else:
+                    where.append("(ra >= ? OR ra <= ?)")
+                args.extend([ra_min, ra_max])
+
+        sql = "SELECT %s FROM candidates" % (", ".join(candidate_columns))
+        if (len(where) > 0):
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY run_id, number"
+
+        rows = [dict(zip(candidate_columns, row)) for row in self.db.execute(sql, args)]
+
+        if (radius is not None and len(rows) > 0):
+            cand_ra = numpy.radians([r['ra'] for r in rows])
+            cand_dec = numpy.radians([r['dec'] for r in rows])
+            ra0, dec0 = math.radians(ra), math.radians(dec)
+            cos_d = numpy.sin(cand_dec) * math.sin(dec0) + \
+                    numpy.cos(cand_dec) * math.cos(dec0) * numpy.cos(cand_ra - ra0)
+            d = numpy.degrees(numpy.arccos(numpy.clip(cos_d, -1., 1.)))
+            rows = [rows[i] for i in range(len(rows)) if d[i] <= radius]
+
+        return rows
+
+    def load(self, rows):
+        """
+
+        Return the full candidate dictionaries (in the format written by
+        find_moving_objects, including the detections) for rows returned by
+        select(), or for a list of cand_ids.
+
+        """
+
+        candidates = []
+        for row in rows:
+            if (not isinstance(row, dict)):
+                row = self.select_id(row)
+            det = self.db.execute(
+                "SELECT sex, mjd, tracklet, formatted FROM detections WHERE cand_id = ?",
+                (row['cand_id'],)).fetchone()
+
+            cand = {
+                'sex': blob_to_array(det[0]),
+                'mjd': blob_to_array(det[1]),
+                'rate': numpy.array([row['rate_ra'], row['rate_dec']]),
+                'positions': row['positions'],
+                'cand_id': row['cand_id'],
+                'run_id': row['run_id'],
+                'number': row['number'],
+            }
+            if (det[2] is not None):
+                cand['tracklet'] = blob_to_array(det[2])
+            if (det[3] is not None):
+                cand['formatted'] = json.loads(det[3])
+            # Only candidates that were classified have these
+            for key in ['name', 'detection_class', 'comment']:
+                if (row[key] is not None):
+                    cand[key] = row[key]
+            if (row['new_discovery'] is not None):
+                cand['new_discovery'] = bool(row['new_discovery'])
+            candidates.append(cand)
+
+        return candidates
+
+    def select_id(self, cand_id):
+        row = self.db.execute(
+            "SELECT %s FROM candidates WHERE cand_id = ?" % (", ".join(candidate_columns)),
+            (cand_id,)).fetchone()
+        if (row is None):
+            raise KeyError("No candidate with id %s in %s" % (str(cand_id), self.filename))
+        return dict(zip(candidate_columns, row))
+
+    def candidates(self, **kwargs):
+        """
+
+        Select candidates (see select()) and return them with all detections.
+
+        """
+
+        return self.load(self.select(**kwargs))
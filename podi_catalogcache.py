@@ -0,0 +1,180 @@
+#
+# Copyright (C) 2014, Ralf Kotulla
+#                     kotulla@uwm.edu
+#
+# All rights reserved
+#
+
+"""
+
+Shared loader for SourceExtractor ASCII catalogs.
+
+The first time a catalog is read it is converted into a binary sidecar file
+(catalog.cat.npy) that is re-used for all following reads. A small stamp file
+(catalog.cat.npy.stamp) records size and modification time of the catalog and
+the associated FITS file; if either changes the sidecar is rebuilt.
+
+"""
+
+import os
+import numpy
+import logging
+
+#
+# Set to False to always read the ASCII catalogs
+#
+use_catalog_cache = True
+
+sidecar_extension = ".npy"
+stamp_extension = ".stamp"
+
+
+
+def file_stamp(filename):
+    """
+
+    Return a one-line description (name, size, mtime) of a file that changes
+    whenever the file itself changes.
+
+    """
+
+    if (filename == None):
+        return "-"
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return "%s missing" % (os.path.abspath(filename))
+    return "%s %d %r" % (os.path.abspath(filename), stat.st_size, stat.st_mtime)
+
+
+
+def catalog_stamp(catfile, fitsfile=None):
+    return "\n".join([file_stamp(catfile), file_stamp(fitsfile)])+"\n"
+
+
+
+def write_atomic(filename, write_func):
+    """
+
+    Write a file under a temporary name and rename it once complete, so
+    concurrent readers never see a half-written file.
+
+    """
+
+    tmpfile = "%s.tmp.%d" % (filename, os.getpid())
+    try:
+        write_func(tmpfile)
+        os.rename(tmpfile, filename)
+    finally:
+        if (os.path.isfile(tmpfile)):
+            os.remove(tmpfile)
+
+
+
+def sidecar_is_valid(catfile, fitsfile=None):
+    """
+
+    Check if the binary sidecar of catfile exists and is up-to-date.
+
+    """
+
+    sidecar_file = catfile + sidecar_extension
+    stamp_file = sidecar_file + stamp_extension
+    if (not os.path.isfile(sidecar_file) or not os.path.isfile(stamp_file)):
+        return False
+
+    try:
+        with open(stamp_file, "r") as stamp:
+            return stamp.read() == catalog_stamp(catfile, fitsfile)
+    except IOError:
+        return False
+
+
+
+def load_catalog(catfile, fitsfile=None, mmap_mode=None):
+    """
+
+    Load a SourceExtractor ASCII catalog, returning the same array as
+    numpy.loadtxt(catfile).
+
+    If fitsfile is given, the cached copy is also invalidated when the FITS
+    file changes. With mmap_mode (see numpy.load), the sidecar file is memory-
+    mapped instead of read into memory.
+
+    """
+
+    logger = logging.getLogger("CatalogCache")
+
+    sidecar_file = catfile + sidecar_extension
+
+    if (use_catalog_cache and sidecar_is_valid(catfile, fitsfile)):
+        try:
+            cat_data = numpy.load(sidecar_file, mmap_mode=mmap_mode)
+            logger.debug("Read %s from binary cache" % (catfile))
+            return cat_data
+        except (IOError, ValueError):
+            logger.debug("Unable to read binary cache %s, re-reading catalog" % (sidecar_file))
+
+    # Get the stamp before reading the catalog, so a catalog changing while
+    # we are reading it does not end up being marked as valid
+    stamp = catalog_stamp(catfile, fitsfile)
+    cat_data = numpy.loadtxt(catfile)
+
+    if (not use_catalog_cache):
+        return cat_data
+
+    if (not write_sidecar(catfile, cat_data, stamp)):
+        return cat_data
+
+    if (mmap_mode != None):
+        return numpy.load(sidecar_file, mmap_mode=mmap_mode)
+    return cat_data
+
+
+
+def write_sidecar(catfile, cat_data, stamp):
+    """
+
+    Write the binary sidecar and stamp for catfile; returns True on success.
+
+    """
+
+    logger = logging.getLogger("CatalogCache")
+
+    sidecar_file = catfile + sidecar_extension
+    stamp_file = sidecar_file + stamp_extension
+
+    try:
+        def write_data(filename):
+            with open(filename, "wb") as f:
+                numpy.save(f, cat_data)
+        def write_stamp(filename):
+            with open(filename, "w") as f:
+                f.write(stamp)
+        write_atomic(sidecar_file, write_data)
+        write_atomic(stamp_file, write_stamp)
+        logger.debug("Wrote binary cache for %s" % (catfile))
+    except (IOError, OSError):
+        logger.debug("Unable to write binary cache for %s" % (catfile))
+        return False
+
+    return True
+
+
+
+def save_catalog(catfile, cat_data, fitsfile=None):
+    """
+
+    Write a catalog created in memory (e.g. by podi_detection) as ASCII
+    catalog, for all tools reading catalogs with numpy.loadtxt, together with
+    its binary sidecar so load_catalog never has to parse the ASCII version.
+
+    """
+
+    def write_ascii(filename):
+        numpy.savetxt(filename, cat_data)
+    write_atomic(catfile, write_ascii)
+
+    if (use_catalog_cache):
+        write_sidecar(catfile, cat_data, catalog_stamp(catfile, fitsfile))
+
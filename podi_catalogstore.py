@@ -0,0 +1,234 @@
+#
+# Copyright (C) 2014, Ralf Kotulla
+#                     kotulla@uwm.edu
+#
+# All rights reserved
+#
+
+"""
+
+Columnar, memory-mapped store for the source catalogs of all frames in a run.
+
+All catalogs are stored in a single directory, with one memory-mapped .npy
+file per catalog column (float64, so no precision is lost on Ra/Dec) and an
+offsets table marking the first row of each frame. Worker processes attach to
+an existing store by path, so catalogs never need to be pickled or copied
+between processes; changes written by one process (e.g. flagging sources as
+used) are visible to all others.
+
+Each frame is accessed through a CatalogFrame, which supports the same
+indexing as the 2-d numpy catalogs it replaces (cat[:, col], cat[rows, col],
+cat[row], cat.shape, numpy.array(cat), ...).
+
+"""
+
+import os
+import copy
+import numpy
+import json
+import shutil
+import logging
+import tempfile
+
+metadata_filename = "catalogstore.json"
+offsets_filename = "offsets.npy"
+
+
+
+def column_filename(path, column):
+    return os.path.join(path, "column_%03d.npy" % (column))
+
+
+
+def unique_path(prefix, dir="."):
+    """
+
+    Create and return a new, empty directory (prefix.catalogs.XXXXXX) for the
+    catalog store of one run, so several runs in the same directory do not
+    overwrite or delete each other's stores.
+
+    """
+
+    return tempfile.mkdtemp(prefix="%s.catalogs." % (prefix), dir=dir)
+
+
+
+class CatalogFrame(object):
+    """
+
+    View of the rows of one frame in a CatalogStore, behaving like a 2-d
+    catalog array with one row per source.
+
+    """
+
+    def __init__(self, store, frame):
+        self.store = store
+        self.frame = frame
+        self.start = int(store.offsets[frame])
+        self.end = int(store.offsets[frame+1])
+        self.columns = [col[self.start:self.end] for col in store.columns]
+
+    @property
+    def shape(self):
+        return (self.end - self.start, len(self.columns))
+
+    @property
+    def ndim(self):
+        return 2
+
+    @property
+    def dtype(self):
+        return self.store.dtype
+
+    def __len__(self):
+        return self.end - self.start
+
+    def column(self, column):
+        return self.columns[column]
+
+    def replace_columns(self, columns):
+        """
+
+        Return a view of this frame with some columns replaced (a dictionary
+        of column index and new values). All other columns still share memory
+        with the store, so this is a cheap way to apply changes that are only
+        needed by one user of a shared store.
+
+        """
+
+        frame = copy.copy(self)
+        frame.columns = list(self.columns)
+        for column, values in columns.items():
+            frame.columns[column] = values
+        return frame
+
+    def _split_key(self, key):
+        if (not type(key) == tuple):
+            return key, slice(None)
+        if (len(key) == 1):
+            return key[0], slice(None)
+        return key
+
+    def __getitem__(self, key):
+        rows, cols = self._split_key(key)
+        if (isinstance(cols, (int, numpy.integer))):
+            return self.columns[cols][rows]
+
+        col_ids = numpy.arange(len(self.columns))[cols]
+        return numpy.stack([self.columns[c][rows] for c in col_ids], axis=-1)
+
+    def __setitem__(self, key, value):
+        rows, cols = self._split_key(key)
+        if (isinstance(cols, (int, numpy.integer))):
+            self.columns[cols][rows] = value
+            return
+
+        col_ids = numpy.arange(len(self.columns))[cols]
+        value = numpy.asarray(value)
+        for i, c in enumerate(col_ids):
+            self.columns[c][rows] = value[..., i] if value.ndim > 0 else value
+
+    def __array__(self, dtype=None, copy=None):
+        data = numpy.empty(self.shape, dtype=self.dtype)
+        for c, column in enumerate(self.columns):
+            data[:,c] = column
+        return data if dtype == None else data.astype(dtype)
+
+
+
+class CatalogStore(object):
+    """
+
+    Attach to an existing catalog store in directory path. Use mode='r+' if
+    catalogs are to be modified.
+
+    """
+
+    def __init__(self, path, mode='r'):
+
+        self.path = path
+        self.mode = mode
+
+        with open(os.path.join(path, metadata_filename), "r") as mf:
+            metadata = json.load(mf)
+        self.dtype = numpy.dtype(metadata['dtype'])
+        self.n_columns = metadata['n_columns']
+
+        self.offsets = numpy.load(os.path.join(path, offsets_filename))
+        self.n_frames = self.offsets.shape[0] - 1
+        self.n_rows = int(self.offsets[-1])
+
+        self.columns = []
+        for c in range(self.n_columns):
+            if (self.n_rows > 0):
+                column = numpy.load(column_filename(path, c), mmap_mode=mode)
+            else:
+                column = numpy.zeros((0), dtype=self.dtype)
+            # Use plain ndarray views of the memory-mapped files
+            self.columns.append(numpy.asarray(column))
+
+    @classmethod
+    def create(cls, path, catalogs, dtype=numpy.float64):
+        """
+
+        Create a new store in directory path from a list of 2-d catalogs (one
+        per frame), and return it attached in read-write mode.
+
+        """
+
+        logger = logging.getLogger("CatalogStore")
+
+        catalogs = [numpy.asarray(cat) for cat in catalogs]
+        n_columns = 0
+        for cat in catalogs:
+            if (cat.ndim == 2):
+                n_columns = max(n_columns, cat.shape[1])
+            elif (cat.size > 0):
+                n_columns = max(n_columns, cat.shape[0])
+        # Single-source catalogs from numpy.loadtxt come back as 1-d arrays
+        catalogs = [cat.reshape((-1, n_columns)) for cat in catalogs]
+
+        offsets = numpy.zeros((len(catalogs)+1), dtype=numpy.int64)
+        offsets[1:] = numpy.cumsum([cat.shape[0] for cat in catalogs])
+        n_rows = int(offsets[-1])
+        logger.debug("Creating catalog store in %s (%d frames, %d sources, %d columns)" % (
+            path, len(catalogs), n_rows, n_columns))
+
+        if (not os.path.isdir(path)):
+            os.makedirs(path)
+        numpy.save(os.path.join(path, offsets_filename), offsets)
+
+        if (n_rows > 0):
+            for c in range(n_columns):
+                column = numpy.lib.format.open_memmap(column_filename(path, c), mode='w+',
+                                                      dtype=dtype, shape=(n_rows,))
+                for i, cat in enumerate(catalogs):
+                    column[offsets[i]:offsets[i+1]] = cat[:,c]
+                column.flush()
+                del column
+
+        # Write the metadata last, marking the store as complete
+        metadata = {
+            'dtype': numpy.dtype(dtype).str,
+            'n_columns': n_columns,
+        }
+        with open(os.path.join(path, metadata_filename), "w") as mf:
+            json.dump(metadata, mf)
+
+        return cls(path, mode='r+')
+
+    def frame(self, frame):
+        return CatalogFrame(self, frame)
+
+    def frames(self):
+        return [CatalogFrame(self, i) for i in range(self.n_frames)]
+
+    def remove(self):
+        """
+
+        Detach from and delete the store.
+
+        """
+        self.columns = []
+        shutil.rmtree(self.path, ignore_errors=True)
+
@@ -0,0 +1,111 @@
+#
+# Copyright (C) 2014, Ralf Kotulla
+#                     kotulla@uwm.edu
+#
+# All rights reserved
+#
+
+"""
+
+Iterative outlier rejection for the differential photometry correction.
+
+Starting from the magnitudes of all reference stars in all frames (for each
+aperture), each iteration
+
+  1. computes the median magnitude of each reference star over all frames,
+  2. computes the correction of each frame as the median offset of all
+     reference stars from their median magnitudes,
+  3. computes the scatter of the corrected offsets in each frame, and
+  4. masks all offsets deviating by more than n_sigma times the scatter.
+
+The apertures are independent of each other, so each aperture is clipped on
+its own and stops as soon as no new outliers are found; further iterations
+would not change the result. Within an aperture, only the median magnitudes
+of reference stars that lost data points are recomputed.
+
+"""
+
+import logging
+import numpy
+import bottleneck
+
+
+
+def clip_aperture(mags, n_sigma=3., max_iterations=15):
+    """
+
+    Run the clipping for one aperture; mags has shape (frames, stars) and
+    outliers are set to NaN in place. Returns correction and scatter (per
+    frame), median and standard deviation of each star, and the number of
+    iterations.
+
+    """
+
+    n_stars = mags.shape[1]
+    median_mags = numpy.empty(n_stars)
+    std_mags = numpy.empty(n_stars)
+    changed = numpy.ones(n_stars, dtype=bool)
+
+    for iteration in range(max_iterations):
+
+        # Update the stars that lost data points in the last iteration
+        if (numpy.all(changed)):
+            median_mags[:] = bottleneck.nanmedian(mags, axis=0)
+            std_mags[:] = bottleneck.nanstd(mags, axis=0)
+        else:
+            columns = numpy.nonzero(changed)[0]
+            median_mags[columns] = bottleneck.nanmedian(mags[:, columns], axis=0)
+            std_mags[columns] = bottleneck.nanstd(mags[:, columns], axis=0)
+
+        median_corrected = mags - median_mags
+        correction = bottleneck.nanmedian(median_corrected, axis=1)
+        corrected = median_corrected - correction.reshape((-1, 1))
+        scatter = bottleneck.nanstd(corrected, axis=1)
+
+        # NaNs never compare as outliers, so this only finds new outliers
+        with numpy.errstate(invalid='ignore'):
+            outliers = numpy.fabs(corrected) > n_sigma * scatter.reshape((-1, 1))
+        if (not numpy.any(outliers)):
+            break
+        mags[outliers] = numpy.NaN
+        changed = numpy.any(outliers, axis=0)
+
+    return correction, scatter, median_mags, std_mags, iteration + 1
+
+
+
+def clip_differential_photometry(mags, n_sigma=3., max_iterations=15):
+    """
+
+    Compute the differential photometry correction from the reference star
+    magnitudes mags, with shape (frames, stars, apertures).
+
+    Returns correction and scatter for each frame and aperture (shape
+    (frames, apertures)), the clipped magnitudes (outliers set to NaN),
+    median and standard deviation of each star (shape (stars, apertures)),
+    and the number of iterations used for each aperture.
+
+    """
+
+    logger = logging.getLogger("Clipping")
+
+    n_frames, n_stars, n_apertures = mags.shape
+    clipped = numpy.array(mags, dtype=numpy.float64)
+
+    correction = numpy.empty((n_frames, n_apertures))
+    scatter = numpy.empty((n_frames, n_apertures))
+    median_mags = numpy.empty((n_stars, n_apertures))
+    std_mags = numpy.empty((n_stars, n_apertures))
+    n_iterations = numpy.zeros(n_apertures, dtype=int)
+
+    for ap in range(n_apertures):
+        # work on a contiguous copy of this aperture
+        ap_mags = clipped[:, :, ap].copy()
+        (correction[:, ap], scatter[:, ap], median_mags[:, ap], std_mags[:, ap],
+         n_iterations[ap]) = clip_aperture(ap_mags, n_sigma=n_sigma, max_iterations=max_iterations)
+        clipped[:, :, ap] = ap_mags
+        logger.debug("Aperture %d: %d iterations, %d of %d data points clipped" % (
+            ap, n_iterations[ap], numpy.sum(numpy.isnan(ap_mags)) - numpy.sum(numpy.isnan(mags[:, :, ap])),
+            ap_mags.size))
+
+    return correction, scatter, clipped, median_mags, std_mags, n_iterations
@@ -0,0 +1,37 @@
+#
+# Copyright (C) 2014, Ralf Kotulla
+#                     kotulla@uwm.edu
+#
+# All rights reserved
+#
+
+"""
+
+Small helpers for sky coordinates, shared by the asteroid search and the
+tools working on its results.
+
+"""
+
+import math
+import numpy
+
+
+
+def sky_center(ra, dec):
+    """
+
+    Center of all positions, from the average unit vector (this also works
+    for fields straddling RA=0/360).
+
+    """
+
+    ra = numpy.radians(ra)
+    dec = numpy.radians(dec)
+    x = numpy.sum(numpy.cos(dec)*numpy.cos(ra))
+    y = numpy.sum(numpy.cos(dec)*numpy.sin(ra))
+    z = numpy.sum(numpy.sin(dec))
+    ra0 = math.degrees(math.atan2(y, x)) % 360.
+    if (ra0 >= 360.):
+        # tiny negative angles come back as 360 from the modulo
+        ra0 = 0.
+    return ra0, math.degrees(math.atan2(z, math.hypot(x, y)))
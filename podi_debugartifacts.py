@@ -0,0 +1,88 @@
+#
+# Copyright (C) 2014, Ralf Kotulla
+#                     kotulla@uwm.edu
+#
+# All rights reserved
+#
+
+"""
+
+Collect intermediate results for debugging in memory, and write them to one
+compressed numpy archive (numpy.savez_compressed) at the end of a run,
+instead of creating many small text files.
+
+Each artifact has a debug level; it is only kept if the level is at most the
+level selected for the run:
+
+  0 -- nothing (default)
+  1 -- summary data, a few arrays per run
+  2 -- per-frame data
+  3 -- everything, including full copies of all source catalogs
+
+Load an archive with numpy.load(filename); each artifact is stored under its
+name.
+
+"""
+
+import logging
+import numpy
+
+from podi_catalogcache import write_atomic
+
+level_off = 0
+level_summary = 1
+level_frames = 2
+level_all = 3
+
+
+
+class DebugArtifacts(object):
+
+    def __init__(self, filename, level=level_off):
+
+        self.filename = filename
+        self.level = level
+        self.artifacts = {}
+        self.logger = logging.getLogger("DebugArtifacts")
+
+    def enabled(self, level=level_summary):
+        """
+
+        Check if artifacts of this level are kept, e.g. to skip preparing
+        data that would be discarded anyway.
+
+        """
+
+        return (level <= self.level)
+
+    def add(self, name, data, level=level_summary):
+        """
+
+        Keep a copy of data (anything numpy.array accepts) under name.
+
+        """
+
+        if (not self.enabled(level)):
+            return
+        if (name in self.artifacts):
+            self.logger.debug("Replacing debug artifact %s" % (name))
+        self.artifacts[name] = numpy.array(data)
+
+    def write(self):
+        """
+
+        Write all artifacts to the archive; returns the filename, or None if
+        there was nothing to write.
+
+        """
+
+        if (len(self.artifacts) <= 0):
+            return None
+
+        def write_archive(filename):
+            with open(filename, "wb") as f:
+                numpy.savez_compressed(f, **self.artifacts)
+
+        write_atomic(self.filename, write_archive)
+        self.logger.info("Wrote %d debug artifacts to %s" % (len(self.artifacts), self.filename))
+        return self.filename
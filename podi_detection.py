@@ -0,0 +1,447 @@
+#
+# Copyright (C) 2014, Ralf Kotulla
+#                     kotulla@uwm.edu
+#
+# All rights reserved
+#
+
+"""
+
+In-process source detection and aperture photometry, as a replacement for
+running SourceExtractor on small frames where starting the external program
+and reading back its ASCII catalog takes longer than the detection itself.
+
+The catalog returned by source_catalog has the same column layout as the
+SourceExtractor catalogs (see SXcolumn), but only the columns needed by
+diffphot and multiasteroidstack are filled in:
+
+  ra, dec, x, y, ota/ext_number, background, flux_max, fwhm_image,
+  fwhm_world, flags, and all mag_aper_* / mag_err_* columns (SXapertures,
+  aperture diameters in arcsec, magnitudes with zeropoint 0)
+
+All other columns are NaN. Flags follow the SourceExtractor convention, but
+only 4 (saturated), 8 (truncated at the image border) and 16 (aperture
+photometry incomplete, i.e. off the image or including masked pixels) are
+set. Sources are not deblended.
+
+Weight maps are only used to mask pixels (weight <= 0); the noise is derived
+from the background map, like SourceExtractor does for the detection.
+
+"""
+
+import math
+import logging
+import numpy
+import scipy.ndimage
+import astropy.io.fits
+import astropy.wcs
+
+from podi_definitions import *
+
+#
+# Default parameters, similar to the SourceExtractor configuration
+#
+default_options = {
+    'detect_thresh': 1.5,       # detection threshold, in sigma
+    'min_area': 5,              # minimum number of pixels above threshold
+    'filter_fwhm': 2.0,         # FWHM of the detection filter, in pixels
+    'back_size': 64,            # size of the background mesh, in pixels
+    'back_filtersize': 3,       # median filter size for the background mesh
+}
+
+#
+# Pixel scale in arcsec/pixel for frames without WCS (ODI)
+#
+default_pixelscale = 0.11
+
+# chunk size for the aperture photometry, to limit memory usage
+aperture_chunk = 128
+
+
+
+def interpolation_matrix(n_mesh, n_pixels, box_size):
+    """
+
+    Return the (n_pixels, n_mesh) matrix that linearly interpolates values
+    given at the centers of the mesh cells to all pixels.
+
+    """
+
+    # Position of each pixel in units of mesh cells
+    pos = numpy.clip((numpy.arange(n_pixels) + 0.5) / box_size - 0.5, 0, n_mesh - 1)
+    i0 = numpy.minimum(numpy.floor(pos).astype(numpy.int64), max(n_mesh - 2, 0))
+    i1 = numpy.minimum(i0 + 1, n_mesh - 1)
+    f = pos - i0
+
+    matrix = numpy.zeros((n_pixels, n_mesh))
+    pixels = numpy.arange(n_pixels)
+    matrix[pixels, i0] += 1. - f
+    matrix[pixels, i1] += f
+    return matrix
+
+
+
+def interpolate_mesh(mesh, shape, box_size):
+    """
+
+    Bilinearly interpolate a background mesh with one value per box to the
+    full image resolution.
+
+    """
+
+    wy = interpolation_matrix(mesh.shape[0], shape[0], box_size)
+    wx = interpolation_matrix(mesh.shape[1], shape[1], box_size)
+    return numpy.dot(numpy.dot(wy, mesh), wx.T)
+
+
+
+def estimate_background(data, mask=None, box_size=64, filter_size=3,
+                        n_iterations=3, clip_sigma=3.):
+    """
+
+    Estimate background level and noise of an image, from the sigma-clipped
+    pixel distribution in boxes of box_size x box_size pixels. Masked pixels
+    (mask == True) are ignored. Returns background and rms maps.
+
+    """
+
+    ny, nx = data.shape
+    my = int(math.ceil(float(ny) / box_size))
+    mx = int(math.ceil(float(nx) / box_size))
+
+    # Pad the image to a multiple of the box size, and sort the pixels by box
+    padded = numpy.empty((my * box_size, mx * box_size))
+    padded[:, :] = numpy.NaN
+    padded[:ny, :nx] = data
+    if (mask is not None):
+        padded[:ny, :nx][mask] = numpy.NaN
+    boxes = padded.reshape(my, box_size, mx, box_size).transpose(0, 2, 1, 3)
+    boxes = boxes.reshape(my * mx, box_size * box_size)
+
+    #
+    # Sort the pixels in each box once (NaNs go to the end); the pixels kept
+    # by each clipping iteration are then a contiguous range [lo, hi), and
+    # mean and sigma follow from cumulative sums.
+    #
+    boxes = numpy.sort(boxes, axis=1)
+    good = numpy.isfinite(boxes)
+    values = numpy.where(good, boxes, 0.)
+    zeros = numpy.zeros((my * mx, 1))
+    sum1 = numpy.concatenate([zeros, numpy.cumsum(values, axis=1)], axis=1)
+    sum2 = numpy.concatenate([zeros, numpy.cumsum(values**2, axis=1)], axis=1)
+
+    lo = numpy.zeros((my * mx, 1), dtype=numpy.int64)
+    hi = numpy.sum(good, axis=1).reshape((-1, 1))
+    last = boxes.shape[1] - 1
+
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        for iteration in range(n_iterations + 1):
+            n = (hi - lo).astype(numpy.float64)
+            median = 0.5 * (numpy.take_along_axis(boxes, numpy.clip((lo + hi - 1) // 2, 0, last), axis=1) +
+                            numpy.take_along_axis(boxes, numpy.clip((lo + hi) // 2, 0, last), axis=1))
+            median[n <= 0] = numpy.NaN
+            mean = (numpy.take_along_axis(sum1, hi, axis=1) - numpy.take_along_axis(sum1, lo, axis=1)) / n
+            sigma = numpy.sqrt(numpy.clip(
+                (numpy.take_along_axis(sum2, hi, axis=1) - numpy.take_along_axis(sum2, lo, axis=1)) / n
+                - mean**2, 0, None))
+            if (iteration >= n_iterations):
+                break
+            lo = numpy.sum(boxes < median - clip_sigma * sigma, axis=1).reshape((-1, 1))
+            hi = numpy.sum(boxes <= median + clip_sigma * sigma, axis=1).reshape((-1, 1))
+
+        median = median.reshape((my, mx))
+        mean = mean.reshape((my, mx))
+        sigma = sigma.reshape((my, mx))
+
+        # Same mode estimate as SourceExtractor, unless the distribution is
+        # too skewed (i.e. the box is crowded)
+        mode = 2.5 * median - 1.5 * mean
+        crowded = numpy.fabs(mean - median) > 0.3 * sigma
+    mesh_bkg = numpy.where(crowded, median, mode)
+
+    # Fill boxes without any good pixels
+    empty = ~numpy.isfinite(mesh_bkg) | ~numpy.isfinite(sigma)
+    if (numpy.all(empty)):
+        return numpy.zeros(data.shape), numpy.ones(data.shape)
+    mesh_bkg[empty] = numpy.median(mesh_bkg[~empty])
+    sigma[empty] = numpy.median(sigma[~empty])
+
+    if (filter_size > 1):
+        mesh_bkg = scipy.ndimage.median_filter(mesh_bkg, size=filter_size, mode='nearest')
+        sigma = scipy.ndimage.median_filter(sigma, size=filter_size, mode='nearest')
+
+    return (interpolate_mesh(mesh_bkg, data.shape, box_size),
+            interpolate_mesh(sigma, data.shape, box_size))
+
+
+
+def detect_sources(image, rms, mask=None, detect_thresh=1.5, min_area=5, filter_fwhm=2.0):
+    """
+
+    Find all groups of at least min_area connected pixels more than
+    detect_thresh sigma above the (background-subtracted) image, after
+    smoothing it with a gaussian of the given FWHM. Like in SourceExtractor,
+    the threshold refers to the noise of the unfiltered image. Returns the
+    label image (0 = no source) and the number of sources.
+
+    """
+
+    if (filter_fwhm > 0):
+        sigma = filter_fwhm / (2. * math.sqrt(2. * math.log(2.)))
+        filtered = scipy.ndimage.gaussian_filter(image, sigma, mode='constant')
+    else:
+        filtered = image
+
+    detected = filtered > detect_thresh * rms
+    if (mask is not None):
+        detected &= ~mask
+
+    labels, n_labels = scipy.ndimage.label(detected, structure=numpy.ones((3, 3)))
+    if (n_labels <= 0):
+        return labels, 0
+
+    # Drop all detections that are too small, and renumber the others
+    area = numpy.bincount(labels.ravel(), minlength=n_labels + 1)
+    keep = area >= min_area
+    keep[0] = False
+    new_label = numpy.zeros(n_labels + 1, dtype=labels.dtype)
+    new_label[keep] = numpy.arange(1, numpy.sum(keep) + 1)
+
+    return new_label[labels], int(numpy.sum(keep))
+
+
+
+def aperture_photometry(image, x, y, radii, valid=None):
+    """
+
+    Sum the flux in circular apertures of the given radii around all (x,y)
+    (0-based pixel coordinates). Pixels on the aperture border are weighted
+    by the fraction of the pixel inside the aperture. Returns flux, aperture
+    area and an "incomplete" flag (aperture off the image or touching invalid
+    pixels), each with shape (n_sources, n_apertures).
+
+    """
+
+    radii = numpy.asarray(radii, dtype=numpy.float64)
+    n_sources = x.shape[0]
+    flux = numpy.zeros((n_sources, radii.shape[0]))
+    area = numpy.zeros((n_sources, radii.shape[0]))
+    incomplete = numpy.zeros((n_sources, radii.shape[0]), dtype=bool)
+    if (n_sources <= 0):
+        return flux, area, incomplete
+
+    if (valid is None):
+        valid = numpy.ones(image.shape, dtype=bool)
+
+    # Pad the image, so all stamps can be cut out without bounds checks
+    r_max = int(math.ceil(numpy.max(radii))) + 1
+    pad = r_max + 1
+    padded = numpy.pad(numpy.where(valid, image, 0.), pad, mode='constant')
+    padded_valid = numpy.pad(valid, pad, mode='constant', constant_values=False)
+    offsets = numpy.arange(-r_max, r_max + 1)
+
+    for start in range(0, n_sources, aperture_chunk):
+        end = min(start + aperture_chunk, n_sources)
+        ix = numpy.round(x[start:end]).astype(numpy.int64)
+        iy = numpy.round(y[start:end]).astype(numpy.int64)
+
+        rows = (iy + pad)[:, None, None] + offsets[None, :, None]
+        cols = (ix + pad)[:, None, None] + offsets[None, None, :]
+        stamps = padded[rows, cols]
+        stamps_valid = padded_valid[rows, cols]
+
+        dx = (ix - x[start:end])[:, None, None] + offsets[None, None, :]
+        dy = (iy - y[start:end])[:, None, None] + offsets[None, :, None]
+        distance = numpy.hypot(dx, dy)
+
+        for i_aper, radius in enumerate(radii):
+            fraction = numpy.clip(radius + 0.5 - distance, 0., 1.)
+            flux[start:end, i_aper] = numpy.sum(stamps * fraction, axis=(1, 2))
+            area[start:end, i_aper] = numpy.sum(fraction, axis=(1, 2))
+            incomplete[start:end, i_aper] = numpy.any((fraction > 0) & ~stamps_valid, axis=(1, 2))
+
+    return flux, area, incomplete
+
+
+
+def source_catalog(data, header=None, weight=None, ext_number=1,
+                   apertures=None, pixelscale=None, gain=None, saturation=None,
+                   detect_thresh=1.5, min_area=5, filter_fwhm=2.0,
+                   back_size=64, back_filtersize=3):
+    """
+
+    Detect all sources in data, and return a catalog in the SourceExtractor
+    column layout (see SXcolumn). Sky coordinates are computed from the WCS
+    in header; the pixel scale (arcsec/pixel), gain and saturation level are
+    taken from the header as well, unless given explicitly.
+
+    """
+
+    if (apertures is None):
+        apertures = SXapertures
+
+    data = numpy.asarray(data, dtype=numpy.float64)
+    mask = ~numpy.isfinite(data)
+    if (weight is not None):
+        mask |= ~(numpy.asarray(weight) > 0)
+
+    wcs = None
+    if (header is not None):
+        wcs = astropy.wcs.WCS(header)
+        if (not wcs.has_celestial):
+            wcs = None
+        if (gain is None and 'GAIN' in header):
+            gain = header['GAIN']
+        if (saturation is None and 'SATURATE' in header):
+            saturation = header['SATURATE']
+    if (pixelscale is None):
+        if (wcs is not None):
+            pixelscale = math.sqrt(math.fabs(numpy.linalg.det(wcs.celestial.pixel_scale_matrix))) * 3600.
+        else:
+            pixelscale = default_pixelscale
+
+    background, rms = estimate_background(data, mask=mask, box_size=back_size,
+                                          filter_size=back_filtersize)
+    image = numpy.where(mask, 0., data - background)
+
+    labels, n_sources = detect_sources(image, rms, mask=mask, detect_thresh=detect_thresh,
+                                       min_area=min_area, filter_fwhm=filter_fwhm)
+
+    catalog = numpy.empty((n_sources, len(SXcolumn_names)))
+    catalog[:, :] = numpy.NaN
+    if (n_sources <= 0):
+        return catalog
+
+    #
+    # Flux-weighted centroids, peaks and extent of all sources
+    #
+    yy, xx = numpy.nonzero(labels)
+    label = labels[yy, xx]
+    values = image[yy, xx]
+    positive = numpy.clip(values, 0, None)
+
+    weight_sum = numpy.bincount(label, positive, minlength=n_sources + 1)[1:]
+    weight_sum[weight_sum <= 0] = 1.
+    x = numpy.bincount(label, positive * xx, minlength=n_sources + 1)[1:] / weight_sum
+    y = numpy.bincount(label, positive * yy, minlength=n_sources + 1)[1:] / weight_sum
+
+    peak = numpy.empty(n_sources + 1)
+    peak[:] = -numpy.inf
+    numpy.maximum.at(peak, label, values)
+
+    # FWHM from the area above half the peak value
+    above_half = values > 0.5 * peak[label]
+    n_half = numpy.bincount(label, above_half, minlength=n_sources + 1)[1:]
+    fwhm = 2. * numpy.sqrt(n_half / math.pi)
+    peak = peak[1:]
+
+    # Truncated at the image border?
+    x_min = numpy.empty(n_sources + 1, dtype=numpy.int64); x_min[:] = data.shape[1]
+    y_min = numpy.empty(n_sources + 1, dtype=numpy.int64); y_min[:] = data.shape[0]
+    x_max = numpy.zeros(n_sources + 1, dtype=numpy.int64)
+    y_max = numpy.zeros(n_sources + 1, dtype=numpy.int64)
+    numpy.minimum.at(x_min, label, xx)
+    numpy.minimum.at(y_min, label, yy)
+    numpy.maximum.at(x_max, label, xx)
+    numpy.maximum.at(y_max, label, yy)
+    truncated = (x_min[1:] <= 0) | (y_min[1:] <= 0) | \
+                (x_max[1:] >= data.shape[1] - 1) | (y_max[1:] >= data.shape[0] - 1)
+
+    ix = numpy.clip(numpy.round(x).astype(numpy.int64), 0, data.shape[1] - 1)
+    iy = numpy.clip(numpy.round(y).astype(numpy.int64), 0, data.shape[0] - 1)
+    source_background = background[iy, ix]
+    source_rms = rms[iy, ix]
+
+    #
+    # Aperture photometry; the apertures are diameters in arcsec
+    #
+    radii = 0.5 * numpy.asarray(apertures, dtype=numpy.float64) / pixelscale
+    flux, area, incomplete = aperture_photometry(image, x, y, radii, valid=~mask)
+    variance = area * source_rms[:, None] ** 2
+    if (gain is not None and gain > 0):
+        variance += numpy.clip(flux, 0, None) / gain
+    flux_err = numpy.sqrt(variance)
+
+    good = flux > 0
+    mag = numpy.empty(flux.shape); mag[:, :] = 99.
+    mag_err = numpy.empty(flux.shape); mag_err[:, :] = 99.
+    mag[good] = -2.5 * numpy.log10(flux[good])
+    mag_err[good] = 2.5 / math.log(10.) * flux_err[good] / flux[good]
+
+    flags = numpy.zeros(n_sources, dtype=numpy.int64)
+    if (saturation is not None):
+        flags[peak + source_background >= saturation] |= 4
+    flags[truncated] |= 8
+    flags[numpy.any(incomplete, axis=1)] |= 16
+
+    if (wcs is not None):
+        ra, dec = wcs.all_pix2world(x + 1., y + 1., 1)
+    else:
+        ra = dec = numpy.NaN
+
+    columns = {
+        'ra': ra,
+        'dec': dec,
+        'x': x + 1.,
+        'y': y + 1.,
+        'ota': ext_number,
+        'ext_number': ext_number,
+        'background': source_background,
+        'flux_max': peak,
+        'fwhm_image': fwhm,
+        'fwhm_world': fwhm * pixelscale / 3600.,
+        'flags': flags,
+    }
+    for i_aper, aperture in enumerate(apertures):
+        columns['mag_aper_%.1f' % (aperture)] = mag[:, i_aper]
+        columns['mag_err_%.1f' % (aperture)] = mag_err[:, i_aper]
+
+    for name, values in columns.items():
+        if (name in SXcolumn):
+            catalog[:, SXcolumn[name]] = values
+
+    return catalog
+
+
+
+def catalog_from_fits(fitsfile, weightfile=None, options=None):
+    """
+
+    Run source_catalog on all image extensions of fitsfile and return the
+    combined catalog. Extensions are numbered from 1, like SourceExtractor's
+    EXT_NUMBER.
+
+    """
+
+    logger = logging.getLogger("Detection")
+
+    kwargs = dict(default_options)
+    if (options is not None):
+        kwargs.update(options)
+
+    hdulist = astropy.io.fits.open(fitsfile)
+    weight_hdulist = None
+    if (weightfile is not None):
+        weight_hdulist = astropy.io.fits.open(weightfile)
+
+    catalogs = []
+    ext_number = 0
+    for i_ext, hdu in enumerate(hdulist):
+        if (hdu.data is None or hdu.data.ndim != 2):
+            continue
+        ext_number += 1
+        weight = None
+        if (weight_hdulist is not None and i_ext < len(weight_hdulist)):
+            weight = weight_hdulist[i_ext].data
+        catalogs.append(source_catalog(hdu.data, hdu.header, weight=weight,
+                                       ext_number=ext_number, **kwargs))
+        logger.debug("Found %d sources in extension %d of %s" % (
+            catalogs[-1].shape[0], ext_number, fitsfile))
+
+    hdulist.close()
+    if (weight_hdulist is not None):
+        weight_hdulist.close()
+
+    if (len(catalogs) <= 0):
+        return numpy.empty((0, len(SXcolumn_names)))
+    return numpy.concatenate(catalogs, axis=0)
@@ -28,311 +28,263 @@ import scipy.stats
 import scipy.spatial
 import bottleneck
 import matplotlib.pyplot
+import matplotlib.figure
+import matplotlib.backends.backend_agg
 import multiprocessing
 import copy
+import shutil
+import shlex
 import podi_ephemerides
+import podi_catalogcache
+import podi_catalogstore
+import podi_makecatalogs
+import podi_clipping
+import podi_debugartifacts
+import podi_workerpool
 
 import podi_sitesetup as sitesetup
 
-output_debugfiles = True
-
-def parallel_sourceextractor(queue, dummy):
+#
+# Debug level for the debug artifacts (see podi_debugartifacts), set with
+# -debug=N; 0 writes only the final catalogs
+#
+debug_level = podi_debugartifacts.level_off
 
-    logger = logging.getLogger("ParSEx")
+#
+# "sextractor" or "python" (in-process detection, see podi_detection)
+#
+detection_backend = "sextractor"
 
-    while (True):
+def diffphot_sextractor_job(fitsfile):
+    return podi_makecatalogs.catalog_job(
+        fitsfile, backend=detection_backend,
+        weightfile=podi_makecatalogs.default_weightfile(fitsfile),
+        sex_config="diffphot.sex", sex_param="diffphot.sexparam")
 
-        cmd = queue.get()
-        if (cmd == None):
-            queue.task_done()
-            break
-
-        sexcmd, fitsfile = cmd
-        logger.info("Creating source catalog for %s" % (fitsfile))
-        start_time = time.time()
-        try:
-            ret = subprocess.Popen(sexcmd.split(), 
-                                   stdout=subprocess.PIPE, 
-                                   stderr=subprocess.PIPE)
-            (sex_stdout, sex_stderr) = ret.communicate()
-            #os.system(sexcmd)
-            if (ret.returncode != 0):
-                logger.warning("Sextractor might have a problem, check the log")
-                logger.debug("Stdout=\n"+sex_stdout)
-                logger.debug("Stderr=\n"+sex_stderr)
-        except OSError as e:
-            podi_logging.log_exception()
-            print >>sys.stderr, "Execution failed:", e
-        end_time = time.time()
-        logger.debug("SourceExtractor returned after %.3f seconds" % (end_time - start_time))
-
-        queue.task_done()
 
 def make_catalogs(inputlist):
 
-    jobqueue = multiprocessing.JoinableQueue()
-
-    number_sex_runs = 0
-    for fitsfile in inputlist:
-        catfile = "%s.cat" % (fitsfile[:-5])
-
-        if (os.path.isfile(catfile)):
-            # Don't do anything if the catalog already exists
-            continue
-
-        logger.debug("Ordering source catalog for %s" % (fitsfile))
-        sex_config_file = "%s/config/diffphot.sex" % (sitesetup.exec_dir)
-        parameters_file = "%s/config/diffphot.sexparam" % (sitesetup.exec_dir)
-        sexcmd = "%s -c %s -PARAMETERS_NAME %s -CATALOG_NAME %s %s" % (
-            sitesetup.sextractor, sex_config_file, parameters_file, catfile, 
-            fitsfile)
-        
-        jobqueue.put((sexcmd, fitsfile))
-        number_sex_runs += 1
-
-    logger.info("Ordered %d new source catalogs, please wait" % (number_sex_runs))
-
-    #
-    # Start worker processes
-    #
-    worker_args = (jobqueue, "")
-    processes = []
-    for i in range(sitesetup.number_cpus):
-        p = multiprocessing.Process(target=parallel_sourceextractor, args=worker_args)
-        p.start()
-        processes.append(p)
-
-        # also add a quit-command for each process
-        jobqueue.put(None)
-        
-    #
-    # wait until all work is done
-    #
-    jobqueue.join()
+    podi_makecatalogs.CatalogService().run(
+        [diffphot_sextractor_job(fitsfile) for fitsfile in inputlist])
     logger.info("All source catalogs have been created!")
 
     return
 
 
-def sextract_and_load(jobqueue, resultqueue, skipotas, cos_declination):
+def sextract_and_load(fitsfile, scratch_file, skipotas, cos_declination, job):
+    """
+
+    Read the source catalog of fitsfile (creating it from job if necessary)
+    and prepare it for the photometry. The catalog is left in scratch_file;
+    returns fitsfile, scratch_file and the MJD (in hours), or None if there
+    is no usable catalog.
+
+    """
 
     logger = logging.getLogger("ParSEx")
+    logger.debug("Loading catalog for %s" % (fitsfile))
 
-    while (True):
+    # If the file does not exist there's nothing to do here
+    if (not os.path.isfile(fitsfile)):
+        # Don't do anything if the input file does not exist
+        logger.debug("File %s does not exist"  % (fitsfile))
+        return None
 
-        # Check if we received the termination signal
-        cmd = jobqueue.get()
-        logger.debug("Command received: %s"  % (str(cmd)))
-        if (cmd == None):
-            logger.debug("Received shutdown command")
-            jobqueue.task_done()
-            break
+    # Create the catalog filename
+    catfile = "%s.cat" % (fitsfile[:-5])
 
-        # Read the FITS filename to work on
-        fitsfile = cmd
+    # If the catalog file does not yet exist or is out of date (the
+    # catalogs are normally all created up-front), run SourceExtractor
+    if (not podi_makecatalogs.catalog_is_current(job)):
+        podi_makecatalogs.run_job(job)
+    else:
+        logger.debug("No sextractor necessary!")
 
-        # If the file does not exist there's nothing to do here
-        if (not os.path.isfile(fitsfile)):
-            # Don't do anything if the input file does not exist
-            logger.debug("File %s does not exist"  % (fitsfile))
-            resultqueue.put(None)
-            jobqueue.task_done()
-            continue
+    # Now we should have the catalog file, but better double check to be sure
+    if (not os.path.isfile(catfile)):
+        logger.debug("Catalog file %s does not exist"  % (catfile))
+        return None
 
-        # Create the catalog filename
-        catfile = "%s.cat" % (fitsfile[:-5])
-
-        # If the catalog file does not yet exist, 
-        # run SourceExtractor and create it
-        if (not os.path.isfile(catfile)):
-
-            logger.debug("Ordering source catalog for %s" % (fitsfile))
-            sex_config_file = "%s/config/diffphot.sex" % (sitesetup.exec_dir)
-            parameters_file = "%s/config/diffphot.sexparam" % (sitesetup.exec_dir)
-
-            weightfile = fitsfile[:-5]+".weight.fits"
-            weightoption = ""
-            if (os.path.isfile(weightfile)):
-                weightoption = "-WEIGHT_IMAGE %s -WEIGHT_TYPE MAP_WEIGHT" % (weightfile)
-            sexcmd = "%(sex)s -c %(conf)s -PARAMETERS_NAME %(param)s -CATALOG_NAME %(cat)s %(weight)s %(fits)s" % {
-                "sex": sitesetup.sextractor, 
-                "conf": sex_config_file, 
-                "param": parameters_file, 
-                "cat": catfile, 
-                "weight": weightoption,
-                "fits": fitsfile,
-            }
-        
-            logger.info("Creating source catalog for %s" % (fitsfile))
-            start_time = time.time()
-            try:
-                ret = subprocess.Popen(sexcmd.split(), 
-                                       stdout=subprocess.PIPE, 
-                                       stderr=subprocess.PIPE)
-                (sex_stdout, sex_stderr) = ret.communicate()
-                #os.system(sexcmd)
-                if (ret.returncode != 0):
-                    logger.warning("Sextractor might have a problem, check the log")
-                    logger.debug("Stdout=\n"+sex_stdout)
-                    logger.debug("Stderr=\n"+sex_stderr)
-            except OSError as e:
-                podi_logging.log_exception()
-                print >>sys.stderr, "Execution failed:", e
-            end_time = time.time()
-            logger.debug("SourceExtractor returned after %.3f seconds" % (end_time - start_time))
-        else:
-            logger.debug("No sextractor necessary!")
+    # Read the catalog file
+    phot_ZP = 25.
 
-        # Now we should have the catalog file, but better double check to be sure
-        if (not os.path.isfile(catfile)):
-            logger.debug("Catalog file %s does not exist"  % (catfile))
-            resultqueue.put(None)
-            jobqueue.task_done()
-            continue
+    logger.debug("Reading source catalog (%s)" % (catfile))
+    try:
+        cat_data = podi_catalogcache.load_catalog(catfile, fitsfile)
+    except:
+        logger.error("Unable to load catalog file %s" % (catfile))
+        return None
 
-        # Read the catalog file
-        phot_ZP = 25.
+    logger.debug("Read %d sources from %s" % (cat_data.shape[0], catfile))
 
-        logger.debug("Reading source catalog (%s)" % (catfile))
-        try:
-            cat_data = numpy.loadtxt(catfile)
-        except:
-            logger.error("Unable to load catalog file %s" % (catfile))
-            resultqueue.put(None)
-            jobqueue.task_done()
-            continue
+    # Correct for the absolute zeropoint
+    hdulist = astropy.io.fits.open(fitsfile)
+    magzero = 25.
+    if ('MAGZERO'  in hdulist[0].header): magzero = hdulist[0].header['MAGZERO']
+    if ('PHOTZP_X' in hdulist[0].header): magzero = hdulist[0].header['PHOTZP_X']
 
-        logger.debug("Read %d sources from %s" % (cat_data.shape[0], catfile))
+    #
+    # Skip sources in certain extensions, if requested
+    #
+    if (len(skipotas) > 0):
+        logger.debug("Eliminating all sources from OTAs %s" % ",".join(["%02d" % i for i in skipotas]))
+        # Translate all extension numbers to proper OTAs
+        extensions = set(numpy.array(cat_data[:, SXcolumn['ota']], dtype=numpy.int))
+        print extensions
+        for i in extensions:
+            ota = hdulist[i].header['OTA']
+            cat_data[:, SXcolumn['ota']][cat_data[:, SXcolumn['ota']] == i] = ota
+
+        # Now eliminate all sources in OTAs marked for omission
+        if (not skipotas == []):
+            for ota in skipotas:
+                to_skip = cat_data[:, SXcolumn['ota']] == ota
+                cat_data = cat_data[~to_skip]
+
+    # Apply the photometric zeropoint to all apertures
+    cat_data[:, SXcolumn['mag_aper_2.0']:SXcolumn['mag_aper_12.0']+1] += magzero
+
+    # Set all invalid magnitudes to NaN 
+    invalid = (cat_data[:, SXcolumn['mag_aper_2.0']:SXcolumn['mag_aper_12.0']+1] > 90) | \
+              (cat_data[:, SXcolumn['mag_err_2.0' ]:SXcolumn['mag_err_12.0' ]+1] > 10)
+    cat_data[:, SXcolumn['mag_aper_2.0']:SXcolumn['mag_aper_12.0']+1][invalid] = numpy.NaN
+
+    # Account for cos(dec) distortion
+    cat_data[:, SXcolumn['ra']] *= cos_declination
+
+    if ("MJD-STRT" in hdulist[0].header and 
+        "MJD-END" in hdulist[0].header):
+        mjd_middle = 0.5* 24. * (hdulist[0].header['MJD-STRT'] + hdulist[0].header['MJD-END'])
+    else:
+        obs_mjd = hdulist[0].header['MJD-OBS']
+        exptime = hdulist[0].header['EXPTIME']
+        mjd_middle = (obs_mjd * 24.) + (exptime / 3600.)
 
-        # Correct for the absolute zeropoint
-        hdulist = astropy.io.fits.open(fitsfile)
-        magzero = 25.
-        if ('MAGZERO'  in hdulist[0].header): magzero = hdulist[0].header['MAGZERO']
-        if ('PHOTZP_X' in hdulist[0].header): magzero = hdulist[0].header['PHOTZP_X']
+    logger.debug("MJD (%s) = %f" % (fitsfile,mjd_middle))
 
-        #
-        # Skip sources in certain extensions, if requested
-        #
-        if (len(skipotas) > 0):
-            logger.debug("Eliminating all sources from OTAs %s" % ",".join(["%02d" % i for i in skipotas]))
-            # Translate all extension numbers to proper OTAs
-            extensions = set(numpy.array(cat_data[:, SXcolumn['ota']], dtype=numpy.int))
-            print extensions
-            for i in extensions:
-                ota = hdulist[i].header['OTA']
-                cat_data[:, SXcolumn['ota']][cat_data[:, SXcolumn['ota']] == i] = ota
-
-            # Now eliminate all sources in OTAs marked for omission
-            if (not skipotas == []):
-                for ota in skipotas:
-                    to_skip = cat_data[:, SXcolumn['ota']] == ota
-                    cat_data = cat_data[~to_skip]
-
-        # Apply the photometric zeropoint to all apertures
-        cat_data[:, SXcolumn['mag_aper_2.0']:SXcolumn['mag_aper_12.0']+1] += magzero
-
-        # Set all invalid magnitudes to NaN 
-        invalid = (cat_data[:, SXcolumn['mag_aper_2.0']:SXcolumn['mag_aper_12.0']+1] > 90) | \
-                  (cat_data[:, SXcolumn['mag_err_2.0' ]:SXcolumn['mag_err_12.0' ]+1] > 10)
-        cat_data[:, SXcolumn['mag_aper_2.0']:SXcolumn['mag_aper_12.0']+1][invalid] = numpy.NaN
-
-        # Account for cos(dec) distortion
-        cat_data[:, SXcolumn['ra']] *= cos_declination
-
-        if ("MJD-STRT" in hdulist[0].header and 
-            "MJD-END" in hdulist[0].header):
-            mjd_middle = 0.5* 24. * (hdulist[0].header['MJD-STRT'] + hdulist[0].header['MJD-END'])
-        else:
-            obs_mjd = hdulist[0].header['MJD-OBS']
-            exptime = hdulist[0].header['EXPTIME']
-            mjd_middle = (obs_mjd * 24.) + (exptime / 3600.)
+    # print "XXX"
+    # # Do some preparing of the catalog
+    # good_photometry = cat_data[:, aperture_column] < 0
+    # cat_data = cat_data[good_photometry]
 
-        logger.debug("MJD (%s) = %f" % (fitsfile,mjd_middle))
+    # # Apply photometric zeropoint to all magnitudes
+    # for key in SXcolumn_names:
+    #     if (key.startswith("mag_aper")):
+    #         cat_data[:, SXcolumn[key]] += phot_ZP
 
-        # print "XXX"
-        # # Do some preparing of the catalog
-        # good_photometry = cat_data[:, aperture_column] < 0
-        # cat_data = cat_data[good_photometry]
+    # Hand the catalog back via a scratch file rather than pickling it 
+    # along with the results
+    numpy.save(scratch_file, cat_data)
+    results = (fitsfile, 
+               scratch_file,
+               mjd_middle)
 
-        # # Apply photometric zeropoint to all magnitudes
-        # for key in SXcolumn_names:
-        #     if (key.startswith("mag_aper")):
-        #         cat_data[:, SXcolumn[key]] += phot_ZP
+    # catalog_filelist.append(catalog_filename)
+    # catalog.append(cat_data)
+    # mjd_hours.append(mjd_middle)
+    # source_id.append(numpy.arange(cat_data.shape[0]))
+    # filters.append(filter_name)
 
-        # Post all results to the resultqueue
-        results = (fitsfile, 
-                   cat_data,
-                   mjd_middle)
-        resultqueue.put(results)
+    # print catalog_filename, cat_data.shape
 
-        # catalog_filelist.append(catalog_filename)
-        # catalog.append(cat_data)
-        # mjd_hours.append(mjd_middle)
-        # source_id.append(numpy.arange(cat_data.shape[0]))
-        # filters.append(filter_name)
+    # logger.info("All catalog files created and read...")
+    # logger.debug("Cos(dec) correction = %.10f" % (cos_declination))
 
-        # print catalog_filename, cat_data.shape
+    logger.info("Created and read source catalog for %s" % (fitsfile))
+    return results
 
-        # logger.info("All catalog files created and read...")
-        # logger.debug("Cos(dec) correction = %.10f" % (cos_declination))
 
-        logger.info("Created and read source catalog for %s" % (fitsfile))
-        jobqueue.task_done()
 
+def reference_cos_declination(ref_fits):
+    """
+
+    Derive the cos_declination correction factor from the reference frame.
 
-def create_load_catalogs(filelist, skipotas=[]):
+    """
 
-    # Derive the cos_declination correction factor from the reference frame
     try:
-        ref_fits = filelist[-1]
         ref_hdu = pyfits.open(ref_fits)
         for ext in ref_hdu:
             if ('CRVAL2' in ext.header):
-                cos_declination = math.cos(math.radians(ext.header['CRVAL2']))
-                break
+                return math.cos(math.radians(ext.header['CRVAL2']))
     except:
-        cos_declination = 1.0
+        pass
+    return 1.0
+
+
+
+def load_catalogs(filelist, skipotas=[], cos_declination=1.0,
+                  catalog_store_path=None):
+    """
+
+    Create (if necessary) and read the source catalogs of all files into a
+    catalog store (in catalog_store_path, or a new directory if not given).
+    Returns a dictionary with the catalog (a CatalogFrame) and the MJD (in
+    hours) of each file that could be read.
+
+    """
 
     # First of all make sure we only extract sources from each file once, 
     # even if a file might be given multiple times
     unique_filelist = set(filelist)
 
-    # Create a queue to hold all jobs
-    jobqueue = multiprocessing.JoinableQueue()
-    resultqueue = multiprocessing.Queue()
-    jobcount = 0
-
-    # Deal out all files
-    for fn in unique_filelist:
-        jobqueue.put((fn))
-        jobcount += 1
-
-    # Now start a number of processes to do the work
-    worker_args = (jobqueue, resultqueue, skipotas, cos_declination)
-    processes = []
-    for i in range(sitesetup.number_cpus):
-        p = multiprocessing.Process(target=sextract_and_load, args=worker_args)
-        p.start()
-        processes.append(p)
-        # also add a quit-command for each process
-        jobqueue.put(None)
-    
+    # Create all missing catalogs first, largest frames first
+    podi_makecatalogs.CatalogService().run(
+        [diffphot_sextractor_job(fn) for fn in unique_filelist])
+
+    # All catalogs end up in the catalog store; the workers leave their 
+    # catalogs in scratch files in the same directory
+    if (catalog_store_path == None):
+        catalog_store_path = podi_catalogstore.unique_path("diffphot")
+    if (not os.path.isdir(catalog_store_path)):
+        os.makedirs(catalog_store_path)
+
+    # Deal out all files to the shared worker pool
+    pool = podi_workerpool.get_pool()
+    pending = []
+    for jobcount, fn in enumerate(unique_filelist):
+        scratch_file = os.path.join(catalog_store_path, "scratch_%04d.npy" % (jobcount))
+        pending.append(pool.submit(sextract_and_load, fn, scratch_file, skipotas, cos_declination,
+                                   diffphot_sextractor_job(fn)))
+
     # store all results in a dictionary for now
     all_results = {}
     
     # Receive the results
-    for i in range(jobcount):
-        res = resultqueue.get()
-        # print "XXX = ", res
+    for result in pending:
+        try:
+            res = result.get()
+        except:
+            podi_logging.log_exception()
+            continue
         if (not res == None):
-            fitsfile, cat_data, mjd_hours = res
-            all_results[fitsfile] = (cat_data, mjd_hours)
+            fitsfile, scratch_file, mjd_hours = res
+            all_results[fitsfile] = (scratch_file, mjd_hours)
 
-    # Wait until all work is complete
-    jobqueue.join()
+    # Move all catalogs into the catalog store, one frame per unique file
+    store_files = sorted(all_results.keys())
+    catalog_store = podi_catalogstore.CatalogStore.create(
+        catalog_store_path, 
+        [numpy.load(all_results[fn][0], mmap_mode='r') for fn in store_files])
+    store_frames = catalog_store.frames()
+    for idx, fitsfile in enumerate(store_files):
+        os.remove(all_results[fitsfile][0])
+        all_results[fitsfile] = (store_frames[idx], all_results[fitsfile][1])
+
+    return all_results
+
+
+
+def sort_catalogs(filelist, all_results):
+    """
+
+    Sort the catalogs of all files in filelist by time, excluding the
+    reference frame (the last file in filelist) and all files without a
+    catalog. Returns the sorted files, catalogs and MJDs, and the catalog of
+    the reference frame.
+
+    """
 
-    # Now sort all data by time, excluding the reference frame 
-    # (which is the last fitsfile in the input filelist)
     raw_catalogs = [None] * len(filelist)
     raw_mjds = [numpy.NaN] * len(filelist)
     for idx, fitsfile in enumerate(filelist):
@@ -361,11 +313,214 @@ def create_load_catalogs(filelist, skipotas=[]):
     # Lastly, extract and separate the data for the reference file
     ref_catalog = raw_catalogs[-1]
 
+    return clean_fitsfile, clean_catalogs, clean_mjds, ref_catalog
+
+
+
+def diffphot_filelist(inputlist, reference_star_frame=None):
+    """
+
+    Return the list of all frames a run needs catalogs for, i.e. the input
+    files plus the reference frame as the last entry.
+
+    """
+
+    full_filelist = copy.copy(inputlist)
+    if (not reference_star_frame == None and
+        not reference_star_frame in inputlist):
+        full_filelist.append(reference_star_frame)
+    else:
+        full_filelist.append(full_filelist[0])
+    return full_filelist
+
+
+
+def create_load_catalogs(filelist, skipotas=[], catalog_store_path=None):
+
+    cos_declination = reference_cos_declination(filelist[-1])
+
+    all_results = load_catalogs(filelist, skipotas=skipotas, cos_declination=cos_declination,
+                                catalog_store_path=catalog_store_path)
+    clean_fitsfile, clean_catalogs, clean_mjds, ref_catalog = sort_catalogs(filelist, all_results)
+
     logger.info("all catalogs created and read, moving on!")
     return clean_fitsfile, clean_catalogs, clean_mjds, ref_catalog, cos_declination
 
 
 
+def scale_catalogs(all_results, filelist, cos_declination):
+    """
+
+    Return the catalogs of all files in filelist from a shared catalog store
+    (see load_catalogs, read with cos_declination=1), with the RA column
+    corrected for cos_declination, as done by create_load_catalogs.
+
+    """
+
+    scaled = {}
+    ra = SXcolumn['ra']
+    for fitsfile in set(filelist):
+        if (fitsfile in all_results):
+            (cat, mjd) = all_results[fitsfile]
+            scaled[fitsfile] = (cat.replace_columns({ra: cat.column(ra) * cos_declination}), mjd)
+    return scaled
+
+
+
+def match_unique_counterparts(cat_tree, src_cat, positions, match_radius):
+    """
+
+    Find the counterparts of all positions in the catalog src_cat (indexed by
+    cat_tree) with a single nearest-neighbor query. The second-nearest
+    neighbor tells whether a match is ambiguous.
+
+    Returns the catalog entries of all positions with exactly one counterpart
+    within match_radius (NaN for all others), and the number of counterparts
+    (0, 1, or 2 for two or more).
+
+    """
+
+    matched = numpy.empty((positions.shape[0], src_cat.shape[1]))
+    matched.fill(numpy.NaN)
+    n_counterparts = numpy.zeros(positions.shape[0], dtype=int)
+    if (src_cat.shape[0] <= 0 or positions.shape[0] <= 0):
+        return matched, n_counterparts
+
+    # Missing neighbors (catalogs with a single source) come back with
+    # infinite distance
+    distance, index = cat_tree.query(positions, k=2)
+    n_counterparts = numpy.sum(distance <= match_radius, axis=1)
+
+    unique = (n_counterparts == 1)
+    if (numpy.sum(unique) > 0):
+        matched[unique] = src_cat[index[unique, 0], :]
+
+    return matched, n_counterparts
+
+
+
+def write_target_catalog(job):
+    """
+
+    Write the corrected photometry of one target, with MJD and the
+    differential photometry correction and its scatter, to a text file.
+
+    """
+
+    n_frames, n_columns = job['target_corrected'].shape
+    n_apertures = job['diffphot_correction'].shape[1]
+
+    output = numpy.empty((n_frames, n_columns + 1 + 2*n_apertures))
+    output[:, :n_columns] = job['target_corrected']
+    output[:, n_columns] = job['target_mjd'] / 24.
+    output[:, n_columns+1:n_columns+1+n_apertures] = job['diffphot_correction']
+    output[:, n_columns+1+n_apertures:] = job['dp_corr_std']
+
+    fn = open(job['catalog_file'], "w")
+    for line in range(len(job['labels'])):
+        print >>fn, "Line %02d: %s" % (line+1, job['labels'][line])
+    numpy.savetxt(fn, output)
+    fn.close()
+
+
+
+def plot_lightcurve(fig, job):
+    """
+
+    Plot the light curve of one target, before and after correction, with
+    the correction amplitude below it.
+
+    """
+
+    target_mjd = job['target_mjd']
+    target_source = job['target_source']
+    target_corrected = job['target_corrected']
+    diffphot_correction = job['diffphot_correction']
+
+    # hours since last noon
+    time = numpy.fmod(target_mjd -19., 24.)
+
+    width = 0.83
+    ax_final = fig.add_axes([0.15,0.3,width,0.65])
+    ax_corr = fig.add_axes([0.15,0.1,width,0.2])
+
+    if (not job['plot_title'] == None):
+        ax_final.set_title(job['plot_title'])
+
+    from matplotlib.ticker import NullFormatter
+    nullfmt   = NullFormatter()         # no labels
+    ax_final.xaxis.set_major_formatter(nullfmt)
+    ax_corr.set_xlabel("hours since last noon") #modified julian date ")
+
+    #
+    # Also plot the uncorrected light curve as crossed connected with a thin line
+    #
+    c = '#A75858'
+    ax_final.scatter(time, target_source[:, SXcolumn['mag_auto']],
+                     color=c, marker='x', label='aperture-corr.')
+    ax_final.plot(time, target_source[:, SXcolumn['mag_auto']],
+                     color=c, linestyle='-')
+
+    #
+    # Also show the actual 4'' aperture data
+    #
+    c = '#4AA2A5'
+    ax_final.scatter(time, target_source[:, SXcolumn['mag_aper_4.0']],
+                     color=c, marker='x', label='raw 4"')
+    ax_final.plot(time, target_source[:, SXcolumn['mag_aper_4.0']],
+                     color=c, linestyle='-')
+
+    #
+    # Plot the light curve as data points with uncertainties
+    # 
+    ax_final.errorbar(time, target_corrected[:, SXcolumn[job['col_name']]], 
+                yerr=target_corrected[:, SXcolumn['mag_err_4.0']], 
+                fmt='o', c='blue')
+    ax_final.scatter(time, target_corrected[:, SXcolumn[job['col_name']]],
+                     c='blue', label='final')
+    ax_final.set_ylabel("app. mag.\n[mag (12'')]")
+    ax_final.legend(loc='best', borderaxespad=0.5, prop={'size':9})
+
+    #
+    # As bottom plot show correction amplitude
+    #
+    # Determine the plotting range
+    max_corr = numpy.nanmax(numpy.fabs(diffphot_correction)) * 1.35
+    ax_corr.plot(time, diffphot_correction, marker='o')
+    ax_corr.set_ylim((-1*max_corr,+1*max_corr))
+    ax_corr.axhline(y=0, linewidth=1, color='grey')
+    ax_corr.set_ylabel("correction\n[mag]")
+
+
+
+def write_target_output(job):
+    """
+
+    Write catalog and (if requested) light curve plot for one target. Plots
+    are drawn with the Agg backend, without pyplot, so this works the same in
+    worker processes.
+
+    """
+
+    logger = logging.getLogger("DiffPhot")
+
+    logger.debug("Writing output catalog %s" % (job['catalog_file']))
+    write_target_catalog(job)
+
+    if (job['plot_file'] == None):
+        return
+
+    try:
+        fig = matplotlib.figure.Figure()
+        matplotlib.backends.backend_agg.FigureCanvasAgg(fig)
+        plot_lightcurve(fig, job)
+        fig.savefig(job['plot_file'])
+        logger.info("Writing plot: %s"  % (job['plot_file']))
+    except:
+        podi_logging.log_exception()
+
+
+
 def my_replace(inp, key, insert):
     out = ""+inp
     while (out.find(key) >= 0):
@@ -383,17 +538,52 @@ DDEC = 4
 
 name_tag = "%name"
 
-def differential_photometry(inputlist, source_coords, 
-                            plot_title=None, plot_filename=None,
-                            reference_star_frame=None,
-                            output_catalog=None,
-                            skipotas=[],
-                            runname="diffphot", 
-                            write_regions=False
-                            ,):
+def differential_photometry(inputlist, source_coords, runname="diffphot", 
+                            shared_catalogs=None, **kwargs):
+    """
+
+    Run the differential photometry (see photometry_from_catalogs). Unless
+    shared_catalogs are given, all catalogs are loaded into a catalog store of
+    this run, which is deleted at the end, even if anything goes wrong.
+
+    """
+
+    catalog_store_path = None
+    if (shared_catalogs is None):
+        catalog_store_path = podi_catalogstore.unique_path(runname if runname else "diffphot")
+
+    try:
+        return photometry_from_catalogs(inputlist, source_coords, 
+                                        runname=runname,
+                                        shared_catalogs=shared_catalogs,
+                                        catalog_store_path=catalog_store_path,
+                                        **kwargs)
+    finally:
+        if (not catalog_store_path == None):
+            shutil.rmtree(catalog_store_path, ignore_errors=True)
+
+
+
+def photometry_from_catalogs(inputlist, source_coords, 
+                             plot_title=None, plot_filename=None,
+                             reference_star_frame=None,
+                             output_catalog=None,
+                             skipotas=[],
+                             runname="diffphot", 
+                             write_regions=False,
+                             debug_level=None,
+                             make_plots=True,
+                             shared_catalogs=None,
+                             catalog_store_path=None,
+                             ):
 
     logger = logging.getLogger("DiffPhot")
 
+    if (debug_level is None):
+        debug_level = globals()['debug_level']
+    debug = podi_debugartifacts.DebugArtifacts(
+        "%s.debug.npz" % (runname if runname else "diffphot"), level=debug_level)
+
     # src_params = []
     # src_names = []
     # # print source_coords
@@ -450,12 +640,7 @@ def differential_photometry(inputlist, source_coords,
     # which we need source catalogs
     #
     logger.info("Using reference frame: %s" % (reference_star_frame))
-    full_filelist = copy.copy(inputlist)
-    if (not reference_star_frame == None and
-        not reference_star_frame in inputlist):
-        full_filelist.append(reference_star_frame)
-    else:
-        full_filelist.append(full_filelist[0])
+    full_filelist = diffphot_filelist(inputlist, reference_star_frame)
 
 #     #     make_catalogs(full_filelist)
 #     # else:
@@ -473,7 +658,15 @@ def differential_photometry(inputlist, source_coords,
     #
     # Create and load all source catalogs
     #
-    cat_filelist, catalog, _mjd_hours, ref_stars, cos_declination = create_load_catalogs(full_filelist)
+    if (shared_catalogs is None):
+        cat_filelist, catalog, _mjd_hours, ref_stars, cos_declination = create_load_catalogs(
+            full_filelist, catalog_store_path=catalog_store_path)
+    else:
+        # Catalogs were loaded by the batch driver and are shared with 
+        # other jobs, so only apply our own cos(dec) correction
+        cos_declination = reference_cos_declination(full_filelist[-1])
+        cat_filelist, catalog, _mjd_hours, ref_stars = sort_catalogs(
+            full_filelist, scale_catalogs(shared_catalogs, full_filelist, cos_declination))
     mjd_hours = numpy.array(_mjd_hours)
     # print mjd_hours, mjd_hours.shape
 
@@ -515,12 +708,9 @@ def differential_photometry(inputlist, source_coords,
                 session_log_file="NASA_horizons__%s.log" % (object_name),
             )
 
-            ephem_data = ephem['data']
-            ra_from_mjd = scipy.interpolate.interp1d( ephem_data[:,0], ephem_data[:,1], kind='linear' )
-            dec_from_mjd = scipy.interpolate.interp1d( ephem_data[:,0], ephem_data[:,2], kind='linear' )
+            ephemeris = ephem['ephemeris']
 
-            target_positions[:,0] = ra_from_mjd(mjd_hours/24.)
-            target_positions[:,1] = dec_from_mjd(mjd_hours/24.)
+            target_positions[:,:] = ephemeris.positions(mjd_hours/24.)
 
             if (len(sc_items) == 5):
                 ref_ra = float(sc_items[2])
@@ -535,8 +725,9 @@ def differential_photometry(inputlist, source_coords,
                         logger.error("Unable to find reference MJD date (%s)" % (src_coord))
                         continue
 
-                target_positions[:,0] = target_positions[:,0] - ra_from_mjd(ref_mjd) + ref_ra
-                target_positions[:,1] = target_positions[:,1] - dec_from_mjd(ref_mjd) + ref_dec
+                target_positions[:,0] = numpy.mod(ephemeris.ra(mjd_hours/24., wrap=False)
+                                                  - ephemeris.ra(ref_mjd, wrap=False) + ref_ra, 360.)
+                target_positions[:,1] = target_positions[:,1] - ephemeris.dec(ref_mjd) + ref_dec
             pass
 
         #
@@ -686,7 +877,7 @@ def differential_photometry(inputlist, source_coords,
     # else:
     #     ref_stars = catalog[0]
 
-    numpy.savetxt("dbg/ref_stars", ref_stars)
+    debug.add("ref_stars", ref_stars)
     print "top 25 reference star Ra/Dec:\n",ref_stars[:25,:2]
 
     # Now find sources that have good photometry in all frames that 
@@ -705,18 +896,20 @@ def differential_photometry(inputlist, source_coords,
     n_ref = 250
     phot_refs = ref_sorted[0:n_ref,0:2]
     print "Ra/Dec of 50 bright differential standards:\n", phot_refs[:,0:2]
-    if (output_debugfiles): numpy.savetxt("diff_stds.cat", phot_refs)
+    debug.add("diff_stds", phot_refs)
 
     # Now go through all catalogs and find the source and the reference 
     # magnitudes
 
     # return
 
-    output_file = open('output.test', 'w')
     match_radius = 2./3600. # 2 arcsec
+    reference_photometry = []
 
-    all_cats = []
-    target_source = []
+    # Catalog entries of the reference stars and targets, for all frames
+    n_targets = all_target_positions.shape[0]
+    all_cats = numpy.empty((len(catalog), phot_refs.shape[0], ref_stars.shape[1]))
+    target_source = numpy.empty((len(catalog), n_targets, ref_stars.shape[1]))
     target_mjd = []
 
     #
@@ -727,10 +920,10 @@ def differential_photometry(inputlist, source_coords,
         # print "\n"*5
 
         src_cat = catalog[i_cat]
-        numpy.savetxt("catdump.%d" % (i_cat+1), src_cat)
+        debug.add("catdump.%d" % (i_cat+1), src_cat, level=podi_debugartifacts.level_all)
 
         # turn the catalog coordinates into a KDTree
-        cat_tree = scipy.spatial.cKDTree(catalog[i_cat][:,0:2])
+        cat_tree = scipy.spatial.cKDTree(src_cat[:,0:2])
         # # print catalog[i_cat][:,0:2]
 
         # # Search for the actual source
@@ -748,7 +941,7 @@ def differential_photometry(inputlist, source_coords,
         # Gather the position of all sources in this frame based on the MJD
         #
         src_radec = all_target_positions[:,i_cat,:]
-        numpy.savetxt("targets.%d" % (i_cat+1), src_radec)
+        debug.add("targets.%d" % (i_cat+1), src_radec, level=podi_debugartifacts.level_frames)
         print "src positions:"
         numpy.savetxt(sys.stdout, src_radec)
 
@@ -758,36 +951,15 @@ def differential_photometry(inputlist, source_coords,
         #
         #########################################################################
 
-        src_tree = scipy.spatial.cKDTree(src_radec)
-        # Search for the source we are interested in
-        # src_counterpart = cat_tree.query_ball_point(src_radec, r=match_radius, p=2)
-#        src_counterpart = cat_tree.query_ball_tree(src_tree, r=match_radius, p=2)
-        src_counterpart = src_tree.query_ball_tree(cat_tree, r=match_radius, p=2)
-
-        src_data = numpy.empty((src_radec.shape[0], catalog[i_cat].shape[1]))
-        src_data.fill(numpy.NaN)
-        # print src_data
-
-        # print src_counterpart
-
-        for obj in range(src_radec.shape[0]):
-            if (len(src_counterpart[obj]) <= 0):
-                # We couldn't find any source counterpart
-                continue
-            elif (len(src_counterpart[obj]) > 1):
-                # Found multiple counterparts
-                # add some brain to pick the most likely one
-                continue
-            else:
-                # 
-                try:
-                    src_data[obj,:] = (src_cat[src_counterpart[obj][0]])
-                except:
-                    podi_logging.log_exception()
-                    continue
-                #print 'src-data=',src_data.shape
-
-        # print src_data
+        # Match targets and reference stars in one go; only sources with a
+        # unique counterpart get photometry
+        matched, n_counterparts = match_unique_counterparts(
+            cat_tree, src_cat, numpy.append(src_radec, phot_refs[:,0:2], axis=0),
+            match_radius)
+        target_source[i_cat] = matched[:n_targets]
+        all_cats[i_cat] = matched[n_targets:]
+        src_data = target_source[i_cat]
+        phot_data = all_cats[i_cat]
 
         # #########################################################################
         # #
@@ -807,12 +979,12 @@ def differential_photometry(inputlist, source_coords,
 
         # By default, use the 4.0'' aperture, but aperture-correct it to 12.0 arcsec
         # Use the weighted difference between the 4 and 12'' magnitude 
-        valid_photometry = (catalog[i_cat][:,SXcolumn[src_aper_err]] < 0.1) & \
-                           (catalog[i_cat][:,SXcolumn['mag_err_12.0']] < 0.1) & \
-                           (catalog[i_cat][:, SXcolumn['flags']] == 0)
-        aperture_diffs = (catalog[i_cat][:,SXcolumn['mag_aper_12.0']] 
-                          - catalog[i_cat][:, SXcolumn[src_aper_mag]])[valid_photometry]
-        if (output_debugfiles): numpy.savetxt("apercorr_%d" % (i_cat), aperture_diffs)
+        valid_photometry = (src_cat[:,SXcolumn[src_aper_err]] < 0.1) & \
+                           (src_cat[:,SXcolumn['mag_err_12.0']] < 0.1) & \
+                           (src_cat[:, SXcolumn['flags']] == 0)
+        aperture_diffs = (src_cat[:,SXcolumn['mag_aper_12.0']] 
+                          - src_cat[:, SXcolumn[src_aper_mag]])[valid_photometry]
+        debug.add("apercorr_%d" % (i_cat), aperture_diffs, level=podi_debugartifacts.level_frames)
 
         aperture_diff_filtered = three_sigma_clip(aperture_diffs)
         aperture_correction = numpy.median(aperture_diff_filtered)
@@ -829,35 +1001,21 @@ def differential_photometry(inputlist, source_coords,
         #
         #########################################################################
 
-        # all_sources = numpy.append(src_radec, phot_refs, axis=0)
-        # print all_sources.shape, match_radius
-        src_tree = scipy.spatial.cKDTree(phot_refs) 
-        counterparts = src_tree.query_ball_tree(cat_tree, r=match_radius, p=2)
-
-        phot_data = numpy.ones((phot_refs.shape[0], catalog[i_cat].shape[1])) 
-        # print phot_data.shape
-        phot_data[:] = numpy.NaN
-
-        print >>output_file, mjd_hours[i_cat], mjd_hours[i_cat]/24., \
-            src_radec[0,0]/cos_declination, src_radec[0,1], \
-            inputlist[i_cat],
-        for i_src in range(len(counterparts)):
-            src = counterparts[i_src]
-            if (len(src) == 1):
-                # Found a unique counterpart
-                # remember the magnitude and error
-                phot_data[i_src,:] = src_cat[src[0], :]
-            if (len(src) == 1):
-                print >>output_file, \
-                    src_cat[src[0], aperture_column],\
-                    src_cat[src[0], aperture_error_column],\
-                    src_cat[src[0], SXcolumn['ra']]/cos_declination, \
-                    src_cat[src[0], SXcolumn['dec']],
-            else:
-                print >>output_file, -99, -99, "x", "x",
-            print >>output_file, len(src),
-
-        print >>output_file
+        # (already matched above, together with the targets)
+
+        # One line per frame: time, target position, and magnitude, error,
+        # position and number of counterparts of each reference star
+        if (debug.enabled(podi_debugartifacts.level_frames)):
+            ref_phot = numpy.empty((phot_data.shape[0], 5))
+            ref_phot[:,0] = phot_data[:, aperture_column]
+            ref_phot[:,1] = phot_data[:, aperture_error_column]
+            ref_phot[:,2] = phot_data[:, SXcolumn['ra']]/cos_declination
+            ref_phot[:,3] = phot_data[:, SXcolumn['dec']]
+            ref_phot[:,4] = n_counterparts[n_targets:]
+            reference_photometry.append(numpy.append(
+                [mjd_hours[i_cat], mjd_hours[i_cat]/24.,
+                 src_radec[0,0]/cos_declination, src_radec[0,1]],
+                ref_phot.ravel()))
 
         #
         # Use the mag_auto data column to hold the aperture-corrected magnitude
@@ -872,18 +1030,13 @@ def differential_photometry(inputlist, source_coords,
         src_data[:,SXcolumn['mag_err_auto']] = src_data[:,SXcolumn[src_aper_err]]
 
 
-        #
-        # Combine all catalogs for later
-        #
-        all_cats.append(phot_data)
-        target_source.append(src_data)
-        logger.debug("Added target sources from frame #%d" % (len(target_source)))
+        logger.debug("Added target sources from frame #%d" % (i_cat+1))
         target_mjd.append(mjd_hours[i_cat])
 
         #
         # Write some region files with info what stars are being used etc.
         #
-        if (write_regions or True):
+        if (write_regions):
             regionfile = "%s.%s.reg" % (cat_filelist[i_cat][:-5], runname)
             logger.debug("Writing regions to %s" % (regionfile))
             reg = open(regionfile, "w")
@@ -903,16 +1056,18 @@ def differential_photometry(inputlist, source_coords,
                 print >>reg, 'text %f %f {%s} # font="helvetica 16" color=white' % (ra, dec-2./3600, all_target_names[i])
             reg.close()
 
+    debug.add("reference_photometry", reference_photometry, level=podi_debugartifacts.level_frames)
+    debug.add("inputlist", inputlist, level=podi_debugartifacts.level_frames)
+
+    # All data we still need has been copied out of the source catalogs; 
+    # the catalog store itself is removed by differential_photometry
+    catalog = None
+
     print "\n"*10
 
     # print target_source
     # print "shapes:",[i.shape for i in target_source]
 
-    #
-    # Convert catalogs into proper numpy catalog
-    #
-    all_cats = numpy.array(all_cats)
-    target_source = numpy.array(target_source)
     target_mjd = numpy.array(target_mjd)
 
     print "target_source.shape", target_source.shape
@@ -921,9 +1076,8 @@ def differential_photometry(inputlist, source_coords,
     print "mjds:", target_mjd
     first_mjd = numpy.min(target_mjd)
 
-    # Dump all uncorrected source catalogs
-    for src in range(target_source.shape[1]):
-        if (output_debugfiles): numpy.savetxt("src.cat.%d" % src, target_source[:,src,:])
+    # All uncorrected source catalogs
+    debug.add("target_source", target_source)
 
 
     all_cats_orig = all_cats.copy()
@@ -937,110 +1091,21 @@ def differential_photometry(inputlist, source_coords,
     col_name = 'mag_aper_4.0'
     mc = [SXcolumn['mag_aper_2.0'], SXcolumn['mag_aper_12.0']+1]
     mec = [SXcolumn['mag_err_2.0'], SXcolumn['mag_err_12.0']+1]
-    all_mags = all_cats[:,:, mc[0]:mc[1]]
-
-    for iteration in range(15):
-
-        #############################################################################
-        #
-        # Now compute the median and filtered magnitude of each reference star
-        #
-        #############################################################################
-        print all_cats[:,:, mc[0]:mc[1]].shape
-
-        median_mags = bottleneck.nanmedian(all_cats[:,:, mc[0]:mc[1]], axis=0)
-        std_mags = bottleneck.nanstd(all_cats[:,:, mc[0]:mc[1]], axis=0)
-        print "MED/STD:", median_mags.shape, std_mags.shape
-        if (output_debugfiles): numpy.savetxt("photcat_median_%d" % iteration, median_mags)
-        if (output_debugfiles): numpy.savetxt("photcat_std_%d" % iteration, std_mags)
-
-        # numpy.savetxt("median_mags.input.%d" % (iteration), all_cats[:,:, SXcolumn[col_name]])
-        # numpy.savetxt("median_mags.corr.%d" % (iteration), all_cats[:,:, SXcolumn[col_name]]-median_mags[:,2])
-
-        # all_cats[outlier, :] = numpy.NaN
-
-        # print all_cats[:,0, mc[0]:mc[1]]
-        # print median_mags[0], std_mags[0]
-
-        #
-        # Cut through the catalog and write out lightcurves 
-        # for each of the reference stars
-        #
-        if (iteration == 14):
-            for s in range(all_cats.shape[1]):
-                logger.debug("Dumping reference catalog % 3d" % (s+1))
-
-                dummy = all_cats[:,s,:].copy()
-                # print dummy.shape
-                dummy = numpy.append(dummy, 
-                                     all_cats[:,s,0:2] - numpy.nanmean(all_cats[:,s,0:2], axis=0),
-                                     axis=1)
-                # print target_mjd.shape
-                dummy = numpy.append(dummy, 
-                                     target_mjd.reshape(target_mjd.shape[0],1)-first_mjd,
-                                     axis=1)
-
-                # compute median magnitudes in each aperture
-                _mags = all_cats[:,s,SXcolumn['mag_aper_2.0']:SXcolumn['mag_err_2.0']]
-                _median_mags = 0# bottleneck.nanmedian(_mags, axis=0)
-                # print _mags.shape, _median_mags.shape
-                _mags -= _median_mags
-                dummy = numpy.append(dummy, _mags, axis=1)
-
-                # dummy[:,:-5] = all_cats[:,s,:]
-                # dummy[:,-3:-1] = all_cats[:,s,0:2] - numpy.nanmean(all_cats[:,s,0:2], axis=0)
-                # dummy[:,-1] = target_mjd
-
-                # dummy = numpy.append(dummy, diffphot_correction.reshape(target_mjd.shape[0],1), axis=1)
-
-                dummy = numpy.append(dummy, numpy.ones((target_mjd.shape[0],1))*median_mags[s], axis=1)
-                dummy = numpy.append(dummy, numpy.ones((target_mjd.shape[0],1))*std_mags[s], axis=1)
-
-                # numpy.savetxt("lightcurve_ref%03d.cat" % (s+1), dummy)
-
-        median_corrected_mags = all_cats[:,:, mc[0]:mc[1]] - median_mags
-        if (output_debugfiles): numpy.savetxt("median_corrected_%d.ap2" % (iteration), median_corrected_mags[:,:,2])
-
-        #
-        # Now we have the differential magnitude correction for each individual star
-        # Again, filter out only the corrections that seem to agree with the 
-        # bulk of the other stars
-        #
-
-        diffphot_correction = bottleneck.nanmedian(median_corrected_mags, axis=1)\
-                                        .reshape((median_corrected_mags.shape[0], 1, median_corrected_mags.shape[2]))
-        if (output_debugfiles): numpy.savetxt("diffcorrection.%d" % (iteration), diffphot_correction[:,0,:])
-        print "diffphot_correction.shape = ",diffphot_correction.shape
-        print "all_mags.shape = ",all_mags.shape
-
-        #diffphot_correction_3d = diffphot_correction
-        #    diffphot_correction.reshape((all_mags.shape[0], 1, all_mags.shape[2]))
-        #print "diffphot_correction_3d (pre-repeat)=",diffphot_correction_3d.shape
-        #diffphot_correction_3d = diffphot_correction_3d.repeat(all_mags.shape[1], axis=1)
-        #print "diffphot_correction_3d (post-repeat)=",diffphot_correction_3d.shape
-        #print "median_corrected_mags.shape=", median_corrected_mags.shape
-
-        dp_corrected = median_corrected_mags - diffphot_correction
-        # dp_corrected = (median_corrected_mags.T-diffphot_correction).T
-
-        for ap in range(dp_corrected.shape[2]):
-            if (output_debugfiles): numpy.savetxt("diffcorrected.%d.ap%d" % (iteration, ap), dp_corrected[:,:,ap])
-        
-        #
-        # Now involve some magic to mask out all outliers
-        #
-        dp_corr_std = bottleneck.nanstd(dp_corrected, axis=1)\
-                                .reshape((dp_corrected.shape[0],1,dp_corrected.shape[2]))
-        print "dp_corr_std.shape=",dp_corr_std.shape
-        if (output_debugfiles): numpy.savetxt("diffcorrection-std.%d" % (iteration), dp_corr_std[:,0,:])
-        
-        # Mask out all datapoints that exceed the standard deviation
-        # dp_corr_std_3d = dp_corr_std.reshape((all_mags.shape[0], 1, all_mags.shape[2])).repeat(all_mags.shape[1], axis=1)
-        # print dp_corr_std_3d.shape
-        outliers = numpy.fabs(dp_corrected) > 3*dp_corr_std
-        
-        all_cats[:,:, mc[0]:mc[1]][outliers] = numpy.NaN
-
+    (diffphot_correction, dp_corr_std, clipped_mags, median_mags, std_mags, n_iterations) = \
+        podi_clipping.clip_differential_photometry(all_cats[:,:, mc[0]:mc[1]],
+                                                   n_sigma=3., max_iterations=15)
+    all_cats[:,:, mc[0]:mc[1]] = clipped_mags
+    logger.info("Clipping converged after %s iterations" % (
+        ",".join(["%d" % i for i in n_iterations])))
+
+    debug.add("photcat_median", median_mags)
+    debug.add("photcat_std", std_mags)
+    debug.add("diffcorrection", diffphot_correction)
+    debug.add("diffcorrection-std", dp_corr_std)
+
+    # Same shape as the catalogs, with one entry per frame and aperture
+    diffphot_correction = diffphot_correction.reshape((all_cats.shape[0], 1, -1))
+    dp_corr_std = dp_corr_std.reshape((all_cats.shape[0], 1, -1))
 
     print diffphot_correction
 
@@ -1107,8 +1172,6 @@ def differential_photometry(inputlist, source_coords,
 
     target_corrected = target_source.copy()
 
-    for i in range(target_corrected.shape[1]):
-        if (output_debugfiles): numpy.savetxt("target_source.prefixed.%d" % (i), target_corrected[:,i,:])
 
     # target_corrected[:, :, SXcolumn['mag_auto']] -= diffphot_correction
     target_corrected[:, :, mc[0]:mc[1]] -= diffphot_correction
@@ -1123,169 +1186,92 @@ def differential_photometry(inputlist, source_coords,
     mag_errors_2 = numpy.hypot(mag_errors, dp_corr_std)
     target_corrected[:, :, mec[0]:mec[1]] = mag_errors_2
 
-    for i in range(target_corrected.shape[1]):
-        if (output_debugfiles): numpy.savetxt("target_source.postfixed.%d" % (i), target_corrected[:,i,:])
+    debug.add("target_corrected", target_corrected)
 
 
     print target_corrected.shape
 
     #
-    # Write the outcome for each source to a text-file
-    # add a header to the top of each file
-    # also add MJD and some correction info to the output
+    # Write the outcome for each source to a text-file, and plot its light
+    # curve; with a plot file given this runs in parallel, one job per target
     #
-    output_file_line_labels = SXcolumn_descriptions
+    output_file_line_labels = list(SXcolumn_descriptions)
     output_file_line_labels.append("MJD")
     for i in range(len(SXapertures)):
         output_file_line_labels.append("differential photometry correction, aperture size %.1f [mag]" % (SXapertures[i]))
     for i in range(len(SXapertures)):
         output_file_line_labels.append("scatter of differential photometry correction, aperture size %.1f [mag]" % (SXapertures[i]))
-    for i in range(target_corrected.shape[1]):
+
+    print all_target_names #src_names
+    jobs = []
+    for i_source in range(target_corrected.shape[1]):
 
         if (output_catalog == None):
-            filename = "target_source.postfixed.%d" % (i)
+            filename = "target_source.postfixed.%d" % (i_source)
         else:
-            filename = my_replace(output_catalog, name_tag, all_target_names[i])
-        print "putput catalog:", output_catalog, filename
+            filename = my_replace(output_catalog, name_tag, all_target_names[i_source])
         filename = my_replace(filename, " ", "_")
 
-        fn = open(filename, "w")
-        for line in range(len(output_file_line_labels)):
-            print >>fn, "Line %02d: %s" % (line+1, output_file_line_labels[line])
-        _dum = target_corrected[:,i,:].copy()
-        print _dum.shape, target_mjd.shape, target_mjd.reshape((-1,1)).shape
-        _dum = numpy.append(_dum, target_mjd.reshape((-1,1))/24., axis=1)
-        _dum = numpy.append(_dum, diffphot_correction[:,0,:], axis=1)
-        _dum = numpy.append(_dum, dp_corr_std[:,0,:], axis=1)
-        numpy.savetxt(fn, _dum)
-        fn.close()
-
-    #############################################################################
-    #
-    # Create some plots for the light curve before & after correction
-    #
-    #############################################################################
-
-    print all_target_names #src_names
-    for i_source in range(len(all_target_names)):
+        this_plot_title = plot_title
+        if (not plot_title == None and not all_target_names[i_source] == None):
+            this_plot_title = my_replace(plot_title, name_tag, all_target_names[i_source])
+
+        this_plot = None
+        if (make_plots and not plot_filename == None):
+            if (not all_target_names[i_source] == None and plot_filename.find('%name') >= 0):
+                names_underscore = my_replace(all_target_names[i_source], " ", "_")
+                this_plot = my_replace(plot_filename, "%name", names_underscore)
+            elif (plot_filename.find('%name') >= 0):
+                name_id = "src_%d" % (i_source+1)
+                this_plot = my_replace(plot_filename, "%name", name_id)
+            else:
+                this_plot = "%s.%d.%s" % (plot_filename[:-4], i_source+1, plot_filename[-3:])
+
+        jobs.append({
+            'catalog_file': filename,
+            'labels': output_file_line_labels,
+            'plot_file': this_plot,
+            'plot_title': this_plot_title,
+            'target_mjd': target_mjd,
+            'target_source': target_source[:, i_source, :],
+            'target_corrected': target_corrected[:, i_source, :],
+            'diffphot_correction': diffphot_correction[:,0,:],
+            'dp_corr_std': dp_corr_std[:,0,:],
+            'col_name': col_name,
+        })
+
+    if (len(jobs) > 1 and sitesetup.number_cpus > 1):
+        podi_workerpool.get_pool().map(write_target_output, jobs)
+    else:
+        for job in jobs:
+            write_target_output(job)
 
-        try:
-            fig = matplotlib.pyplot.figure()
-            #ax_final = fig.add_subplot(311)
-            #ax_raw = fig.add_subplot(312)
-            #ax_corr = fig.add_subplot(313)
-
-            time = target_mjd / 24.
-            time_offset =  math.floor(numpy.min(target_mjd) / 24. - 19./24.)
-            #time = numpy.fmod(target_mjd / 24. - 0.5, 1.0) * 24.
-            time = (target_mjd / 24. - time_offset) * 24.
-
-            #time = (target_mjd / 24. (-19./24.)
-
-            time = numpy.fmod(target_mjd -19., 24.)
-
-            #print time.shape
-            #print target_source.shape
-            #print target_source[0,:,0].shape
-            # break
-
-            width = 0.83
-            ax_final = fig.add_axes([0.15,0.3,width,0.65])
-            ax_corr = fig.add_axes([0.15,0.1,width,0.2])
-
-            if (not plot_title == None):
-                this_plot_title = plot_title
-
-                if (not all_target_names[i_source] == None):
-                    print all_target_names[i_source] 
-                    this_plot_title = my_replace(plot_title, name_tag, all_target_names[i_source])
-
-                    # begin_pos = plot_title.find(name_tag)
-                    # end_pos = begin_pos + len(name_tag)
-                    # this_plot_title = "%s%s%s" % (plot_title[:begin_pos], src_names[i_source], plot_title[end_pos+1:])
-
-                ax_final.set_title(this_plot_title)
-
-            from matplotlib.ticker import NullFormatter
-            nullfmt   = NullFormatter()         # no labels
-            # no labels
-            ax_final.xaxis.set_major_formatter(nullfmt)
-            ax_corr.set_xlabel("hours since last noon") #modified julian date ")
-
-            #
-            # Also plot the uncorrected light curve as crossed connected with a thin line
-            #
-            c = '#A75858'
-            ax_final.scatter(time, target_source[:, i_source, SXcolumn['mag_auto']],
-                             color=c, marker='x', label='aperture-corr.')
-            ax_final.plot(time, target_source[:, i_source, SXcolumn['mag_auto']],
-                             color=c, linestyle='-')
-
-            #
-            # Also show the actual 4'' aperture data
-            #
-            c = '#4AA2A5'
-            ax_final.scatter(time, target_source[:, i_source, SXcolumn['mag_aper_4.0']],
-                             color=c, marker='x', label='raw 4"')
-            ax_final.plot(time, target_source[:, i_source, SXcolumn['mag_aper_4.0']],
-                             color=c, linestyle='-')
-
-            #
-            # Plot the light curve as data points with uncertainties
-            # 
-            ax_final.errorbar(time, target_corrected[:, i_source, SXcolumn[col_name]], 
-                        yerr=target_corrected[:, i_source, SXcolumn['mag_err_4.0']], 
-                        fmt='o', c='blue')
-            ax_final.scatter(time, target_corrected[:, i_source, SXcolumn[col_name]],
-                             c='blue', label='final')
-            ax_final.set_ylabel("app. mag.\n[mag (12'')]")
-            ax_final.legend(loc='best', borderaxespad=0.5, prop={'size':9})
-
-            #
-            # As bottom plot show correction amplitude
-            #
-            # Determine the plotting range
-            max_corr = numpy.nanmax(numpy.fabs(diffphot_correction[:,0,:])) * 1.35
-            ax_corr.plot(time, diffphot_correction[:, 0,:], marker='o')
-            # ax_corr.set_ylim((-0.09,+0.09))
-            ax_corr.set_ylim((-1*max_corr,+1*max_corr))
-            ax_corr.axhline(y=0, linewidth=1, color='grey')
-            ax_corr.set_ylabel("correction\n[mag]")
-
-            if (plot_filename == None):
+    # Without plot file, show all plots interactively
+    if (make_plots and plot_filename == None):
+        for job in jobs:
+            try:
+                fig = matplotlib.pyplot.figure()
+                plot_lightcurve(fig, job)
                 matplotlib.pyplot.show()
-                fig.show()
-            else:
-                if (not all_target_names[i_source] == None and plot_filename.find('%name') >= 0):
-                    names_underscore = my_replace(all_target_names[i_source], " ", "_")
-                    this_plot = my_replace(plot_filename, "%name", names_underscore)
-                elif (plot_filename.find('%name') >= 0):
-                    name_id = "src_%d" % (i_source+1)
-                    this_plot = my_replace(plot_filename, "%name", name_id)
-                else:
-                    this_plot = "%s.%d.%s" % (plot_filename[:-4], i_source+1, plot_filename[-3:])
+            except:
+                podi_logging.log_exception()
 
-    #            fig.savefig(plot_filename)
-                fig.savefig(this_plot)
-                logger.info("Writing plot: %s"  % (this_plot))
-        except:
-            podi_logging.log_exception()
-            pass
+    debug.write()
 
     return
 
 
 
-if __name__ == "__main__":
+def diffphot_arguments():
+    """
 
-    
-    options = set_default_options()
-    podi_logging.setup_logging(options)
-    options = read_options_from_commandline(options)
-    logger = logging.getLogger("DiffPhot: Main")
+    Read all parameters of one diffphot run from the command line (sys.argv);
+    returns the input file list and all keyword arguments for
+    differential_photometry.
 
-    print sys.argv
-    print " ".join(sys.argv)
+    """
+
+    logger = logging.getLogger("DiffPhot: Main")
 
     clean_cmdline = get_clean_cmdline()[1:]
     coord_end = 0
@@ -1301,41 +1287,204 @@ if __name__ == "__main__":
         for i in items:
             skipota.append(int(i))
     logger.info("Excluding all sources from these OTAs: %s" % (
-        ", ".join(skipota)))
+        ", ".join(["%d" % (ota) for ota in skipota])))
     source_data = clean_cmdline[:coord_end]
     inputlist = clean_cmdline[coord_end+1:]
 
-    # source_data = get_clean_cmdline()[1]
-    # catalog_dir = None #get_clean_cmdline()[2]
-    # inputlist = get_clean_cmdline()[2:]
-
     print "source_data:"
     print "\n".join(source_data)
     print "\n\ninput-list:"
     print "\n".join(inputlist)
 
-    # print "source data", source_data
-    # print "filelist",inputlist
-
     title = None
     if (cmdline_arg_isset('-title')):
         title=get_cmdline_arg('-title')
-    plot_filename = cmdline_arg_set_or_default('-plotfile', None)
 
-    reference_frame = cmdline_arg_set_or_default('-refframe', None)
+    kwargs = {
+        'source_coords': source_data,
+        'plot_title': title,
+        'plot_filename': cmdline_arg_set_or_default('-plotfile', None),
+        'reference_star_frame': cmdline_arg_set_or_default('-refframe', None),
+        'output_catalog': cmdline_arg_set_or_default('-catout', None),
+        'skipotas': skipota,
+        'runname': cmdline_arg_set_or_default('-runname', None),
+        'write_regions': cmdline_arg_isset("-writeregions"),
+        'debug_level': int(cmdline_arg_set_or_default("-debug", podi_debugartifacts.level_off)),
+        'make_plots': not cmdline_arg_isset("-noplots"),
+    }
+    return inputlist, kwargs
+
+
+
+def read_batch_manifest(filename):
+    """
+
+    Read a batch manifest: each line holds the arguments of one diffphot run,
+    exactly as they would be given on the command line (without the program
+    name). Empty lines and lines starting with # are ignored.
+
+    Returns a list of (inputlist, keyword arguments) tuples.
 
-    output_catalog = cmdline_arg_set_or_default('-catout', None)
+    """
 
-    runname = cmdline_arg_set_or_default('-runname', None)
-    write_regions = cmdline_arg_isset("-writeregions")
+    logger = logging.getLogger("DiffPhot: Batch")
+
+    jobs = []
+    argv = sys.argv
+    try:
+        with open(filename, "r") as manifest:
+            for line in manifest:
+                line = line.strip()
+                if (len(line) <= 0 or line.startswith("#")):
+                    continue
+                sys.argv = [argv[0]] + shlex.split(line)
+                inputlist, kwargs = diffphot_arguments()
+                if (len(inputlist) <= 0):
+                    logger.warning("No input files in batch job, skipping: %s" % (line))
+                    continue
+                jobs.append((inputlist, kwargs))
+    finally:
+        sys.argv = argv
+
+    logger.info("Read %d jobs from %s" % (len(jobs), filename))
+    return jobs
+
+
+
+def batch_worker(jobqueue, catalog_store_path, frames, n_processes=None):
+    """
+
+    Run diffphot jobs from the queue, with catalogs from the shared store, 
+    using a worker pool of n_processes for all of them.
+
+    """
+
+    podi_workerpool.get_pool(n_processes=n_processes)
+
+    store = podi_catalogstore.CatalogStore(catalog_store_path, 'r')
+    store_frames = store.frames()
+    shared_catalogs = {}
+    for fitsfile in frames:
+        (idx, mjd) = frames[fitsfile]
+        shared_catalogs[fitsfile] = (store_frames[idx], mjd)
+
+    while (True):
+        job = jobqueue.get()
+        if (job == None):
+            jobqueue.task_done()
+            break
+
+        (inputlist, kwargs) = job
+        try:
+            differential_photometry(inputlist, shared_catalogs=shared_catalogs, **kwargs)
+        except:
+            podi_logging.log_exception()
+
+        jobqueue.task_done()
+
+    podi_workerpool.shutdown()
+
+
+
+def run_batch(jobs, n_parallel=1, catalog_store_path=None):
+    """
+
+    Run many diffphot jobs. The catalogs of all frames are created and loaded 
+    only once, even if they are used by several jobs, and are shared by all 
+    jobs via the catalog store. Up to n_parallel jobs run at the same time, 
+    sharing the available CPUs.
+
+    The catalog store is kept in catalog_store_path, which has to be empty 
+    (or not exist yet) and is left in place. Without catalog_store_path, a new
+    directory is created for this batch and removed at the end.
+
+    """
+
+    logger = logging.getLogger("DiffPhot: Batch")
+
+    all_files = []
+    for (inputlist, kwargs) in jobs:
+        for fitsfile in diffphot_filelist(inputlist, kwargs['reference_star_frame']):
+            if (not fitsfile in all_files):
+                all_files.append(fitsfile)
+    logger.info("Loading catalogs for %d unique frames used by %d jobs" % (
+        len(all_files), len(jobs)))
+
+    remove_store = (catalog_store_path == None)
+    if (remove_store):
+        catalog_store_path = podi_catalogstore.unique_path("diffphot_batch")
+    elif (os.path.isdir(catalog_store_path) and len(os.listdir(catalog_store_path)) > 0):
+        raise ValueError("Catalog store directory %s is not empty" % (catalog_store_path))
+
+    # Each job gets its share of the CPUs for its own worker pool
+    n_parallel = max(1, min(n_parallel, len(jobs)))
+    n_job_processes = max(1, sitesetup.number_cpus // n_parallel)
+
+    try:
+        # Each job applies its own cos(dec) correction
+        all_results = load_catalogs(all_files, cos_declination=1.0,
+                                    catalog_store_path=catalog_store_path)
+
+        # Workers attach to the store themselves, so only pass frame indices
+        frames = {}
+        for fitsfile in all_results:
+            (cat, mjd) = all_results[fitsfile]
+            frames[fitsfile] = (cat.frame, mjd)
+        all_results = None
+
+        jobqueue = multiprocessing.JoinableQueue()
+        for job in jobs:
+            jobqueue.put(job)
+
+        # Each job runs its own worker pool, so the workers must not be daemons; 
+        # stop our pool so its idle workers do not sit around meanwhile
+        podi_workerpool.shutdown()
+        processes = []
+        for i in range(n_parallel):
+            p = multiprocessing.Process(target=batch_worker, 
+                                        args=(jobqueue, catalog_store_path, frames, 
+                                              n_job_processes))
+            p.start()
+            processes.append(p)
+            jobqueue.put(None)
+
+        jobqueue.join()
+        for p in processes:
+            p.join()
+
+    finally:
+        if (remove_store):
+            shutil.rmtree(catalog_store_path, ignore_errors=True)
+
+    logger.info("All %d batch jobs done" % (len(jobs)))
+
+
+
+if __name__ == "__main__":
+
+    
+    options = set_default_options()
+    podi_logging.setup_logging(options)
+    options = read_options_from_commandline(options)
+    logger = logging.getLogger("DiffPhot: Main")
+
+    if (cmdline_arg_isset("-horizons")):
+        podi_ephemerides.set_horizons_server(get_cmdline_arg("-horizons"))
+    detection_backend = cmdline_arg_set_or_default("-detect", "sextractor")
+
+    if (cmdline_arg_isset("-batch")):
+        jobs = read_batch_manifest(get_cmdline_arg("-batch"))
+        n_parallel = int(cmdline_arg_set_or_default("-batchjobs", sitesetup.number_cpus))
+        # -batchstore=dir keeps the shared catalogs in dir (which has to be 
+        # empty) instead of a new directory that is removed after the batch
+        batch_store = cmdline_arg_set_or_default("-batchstore", None)
+        run_batch(jobs, n_parallel=n_parallel, catalog_store_path=batch_store)
+    else:
+        print sys.argv
+        print " ".join(sys.argv)
 
-    data = differential_photometry(inputlist, source_coords=source_data,
-                                   plot_title=title, plot_filename=plot_filename,
-                                   reference_star_frame=reference_frame,
-                                   output_catalog=output_catalog,
-                                   skipotas=skipota,
-                                   runname=runname, write_regions=write_regions,
-    )
+        inputlist, kwargs = diffphot_arguments()
+        data = differential_photometry(inputlist, **kwargs)
 
     logger.info("Done, shutting down")
     podi_logging.shutdown_logging(options)
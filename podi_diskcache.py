@@ -0,0 +1,211 @@
+#
+# Copyright (C) 2014, Ralf Kotulla
+#                     kotulla@uwm.edu
+#
+# All rights reserved
+#
+
+"""
+
+Small content-addressed on-disk cache for results of slow network queries.
+
+Each entry is a pickle file in the cache directory, named after a hash of the
+query parameters. Entries are written atomically, so any number of processes
+can share one cache directory. A lock per entry lets concurrent runs wait for
+each other instead of sending the same query twice.
+
+Old entries are evicted by age (max_age, seconds since the entry was written)
+and, least-recently-used first, by total size (max_size, bytes) and number of
+entries (max_entries).
+
+"""
+
+import os
+import time
+import json
+import hashlib
+import logging
+import contextlib
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from podi_catalogcache import write_atomic
+
+entry_extension = ".pkl"
+lock_extension = ".lock"
+
+
+
+def make_key(*items):
+    """
+
+    Return a hash identifying the given (json-serializable) query parameters.
+
+    """
+
+    canonical = json.dumps(items, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+
+
+class DiskCache(object):
+
+    def __init__(self, path, max_size=None, max_age=None, max_entries=None):
+
+        self.path = path
+        self.max_size = max_size
+        self.max_age = max_age
+        self.max_entries = max_entries
+        self.logger = logging.getLogger("DiskCache")
+
+        if (not os.path.isdir(path)):
+            try:
+                os.makedirs(path)
+            except OSError:
+                # some other process might have created it in the meantime
+                if (not os.path.isdir(path)):
+                    raise
+
+    def filename(self, name):
+        return os.path.join(self.path, name + entry_extension)
+
+    def names(self, prefix=""):
+        """
+
+        Return the names of all entries starting with prefix.
+
+        """
+
+        names = []
+        for fn in os.listdir(self.path):
+            if (fn.startswith(prefix) and fn.endswith(entry_extension)):
+                names.append(fn[:-len(entry_extension)])
+        return sorted(names)
+
+    def get(self, name):
+        """
+
+        Return the value stored under name, or None if there is no such entry.
+
+        """
+
+        filename = self.filename(name)
+
+        # Expired entries are only deleted on the next put, but must not be
+        # returned in the meantime
+        if (self.max_age != None):
+            try:
+                if (time.time() - os.stat(filename).st_mtime > self.max_age):
+                    self.logger.debug("Cache entry %s has expired" % (filename))
+                    self.remove(name)
+                    return None
+            except OSError:
+                return None
+
+        try:
+            with open(filename, "rb") as f:
+                value = pickle.load(f)
+        except (IOError, OSError):
+            return None
+        except Exception:
+            self.logger.debug("Unable to read cache entry %s, ignoring it" % (filename))
+            return None
+
+        # Keep track of the last access for LRU eviction, without changing
+        # the modification time used for the age of the entry
+        try:
+            os.utime(filename, (time.time(), os.stat(filename).st_mtime))
+        except OSError:
+            pass
+
+        return value
+
+    def put(self, name, value):
+        """
+
+        Store value under name, replacing any existing entry.
+
+        """
+
+        def write_entry(filename):
+            with open(filename, "wb") as f:
+                pickle.dump(value, f, protocol=2)
+
+        try:
+            write_atomic(self.filename(name), write_entry)
+        except (IOError, OSError):
+            self.logger.warning("Unable to write cache entry %s" % (self.filename(name)))
+            return False
+
+        self.evict()
+        return True
+
+    def remove(self, name):
+        try:
+            os.remove(self.filename(name))
+        except OSError:
+            pass
+
+    @contextlib.contextmanager
+    def lock(self, name):
+        """
+
+        Hold an exclusive lock on name while in the with-block.
+
+        """
+
+        if (fcntl == None):
+            yield
+            return
+
+        lockfile = open(os.path.join(self.path, name + lock_extension), "a")
+        try:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            yield
+        finally:
+            fcntl.flock(lockfile, fcntl.LOCK_UN)
+            lockfile.close()
+
+    def evict(self):
+        """
+
+        Delete expired entries, and the least-recently-used entries until the
+        cache is within the size and entry limits.
+
+        """
+
+        entries = []
+        for name in self.names():
+            try:
+                stat = os.stat(self.filename(name))
+            except OSError:
+                continue
+            entries.append((stat.st_atime, stat.st_mtime, stat.st_size, name))
+
+        now = time.time()
+        keep = []
+        for (atime, mtime, size, name) in entries:
+            if (self.max_age != None and now - mtime > self.max_age):
+                self.logger.debug("Evicting expired cache entry %s" % (name))
+                self.remove(name)
+            else:
+                keep.append((atime, mtime, size, name))
+
+        # least-recently-used first
+        keep.sort()
+        total_size = sum([e[2] for e in keep])
+        while (len(keep) > 0 and
+               ((self.max_size != None and total_size > self.max_size) or
+                (self.max_entries != None and len(keep) > self.max_entries))):
+            (atime, mtime, size, name) = keep.pop(0)
+            self.logger.debug("Evicting cache entry %s" % (name))
+            self.remove(name)
+            total_size -= size
@@ -17,6 +17,48 @@ from podi_commandline import *
 from podi_definitions import *
 import podi_logging
 import logging
+import podi_diskcache
+
+#
+# Default Horizons telnet server and observatory site (695 = Kitt Peak). Use
+# set_horizons_server() (or -horizons=host:port) to point all queries at a
+# different server, e.g. the replay server in podi_horizonsreplay.
+#
+default_horizons_host = 'horizons.jpl.nasa.gov'
+default_horizons_port = 6775
+horizons_host = default_horizons_host
+horizons_port = default_horizons_port
+horizons_site = '695@399'
+
+#
+# On-disk cache of Horizons results. Repeated queries for the same object,
+# site, time-step and quantities are answered from the cache, including
+# queries for a sub-range of an earlier, wider query. Set use_ephemeris_cache
+# to False to always query Horizons.
+#
+use_ephemeris_cache = True
+ephemeris_cache_dir = os.environ.get("PODI_EPHEMERIS_CACHE",
+    os.path.join(os.path.expanduser("~"), ".podi_cache", "ephemerides"))
+ephemeris_cache_max_size = 200 * 2**20
+ephemeris_cache_max_age = 30 * 86400.
+
+
+def parse_horizons_server(server):
+    """
+
+    Split a host:port string; the port defaults to the standard Horizons port.
+
+    """
+
+    host, _, port = server.partition(":")
+    if (port == ""):
+        return host, default_horizons_port
+    return host, int(port)
+
+
+def set_horizons_server(server):
+    global horizons_host, horizons_port
+    horizons_host, horizons_port = parse_horizons_server(server)
 
 
 def safe_float(s):
@@ -30,30 +72,45 @@ def safe_float(s):
 class myTelnet(object):
 
     def __init__(self, *args, **kwargs):
+        self.logfile = kwargs.pop('logfile', None)
+        self.timeout = kwargs.get('timeout', None)
         self.tn = telnetlib.Telnet(*args, **kwargs)
         self.logger = logging.getLogger("Telnet")
 
         self.log = ""
 
+        # Time between sending a command and receiving the next prompt
+        self.timings = []
+        self.last_write = time.time()
+
     def logdump(self, txt):
-        with open("telnet.log", "ab") as f:
+        if (self.logfile is None):
+            return
+        with open(self.logfile, "ab") as f:
             f.write(bytes(str(txt), 'UTF-8'))
 
     def write(self, txt):
         self.logger.debug("Sending: %s" % (txt))
         self.logdump(txt)
+        self.last_write = time.time()
         return self.tn.write(str(txt).encode('ascii'))
 
     def read_some(self):
         x = self.tn.read_some().decode("utf-8")
         self.logdump(x)
+        if (x == ""):
+            raise IOError("Connection closed by Horizons")
         return x
 
     def read_until(self, txt):
         y = str(txt).encode('ascii')
         self.logger.debug("Reading until: %s" % (y))
-        ret = self.tn.read_until(y).decode("utf-8")
+        ret = self.tn.read_until(y, self.timeout).decode("utf-8")
         self.logdump(ret)
+        if (not ret.endswith(str(txt))):
+            raise IOError("Timeout or connection closed while waiting for Horizons to send '%s'" % (
+                str(txt).strip()))
+        self.timings.append((str(txt).strip(), time.time() - self.last_write))
         return ret
 
     def read_all(self):
@@ -67,20 +124,43 @@ class myTelnet(object):
 
 
 
-def get_ephemerides_for_object(object_name, 
-                               start_datetime="2012-01-01",
-                               end_datetime="2014-01-01",
-                               time_interval="6h",
-                               session_log_file=None,
-                               verbose=True,
-                               compute_interpolation=False,
-                               quantities='1,3,7,9'):
+def query_horizons(object_name,
+                   start_datetime,
+                   end_datetime,
+                   time_interval,
+                   session_log_file=None,
+                   verbose=True,
+                   quantities='1,3,7,9',
+                   site=horizons_site,
+                   host=None,
+                   port=None,
+                   scratch_dir=None,
+                   timeout=None,
+                   timings=None):
+    """
+
+    Run one telnet session with Horizons and return the raw CSV ephemeris
+    table (everything between $$SOE and $$EOE), or None if the object is not
+    known.
+
+    If scratch_dir is given, the telnet transcript (telnet.log) and the raw
+    table (telnet.csv) are also written to that directory. With a timeout (in
+    seconds), an IOError is raised if Horizons stops responding. If timings
+    is a list, (prompt, seconds) pairs with the time Horizons took to answer
+    each command are appended to it.
+
+    host and port default to horizons_host and horizons_port.
+
+    """
 
     logger = logging.getLogger("HorizonInterface")
 
+    if (host is None): host = horizons_host
+    if (port is None): port = horizons_port
+
     logger.info("Connecting to NASA Horizon Telnet server, searching for %s" % (object_name))
-    # tn = telnetlib.Telnet('horizons.jpl.nasa.gov', 6775)
-    tn = myTelnet('horizons.jpl.nasa.gov', 6775)
+    telnet_log = None if scratch_dir is None else os.path.join(scratch_dir, "telnet.log")
+    tn = myTelnet(host, port, timeout=timeout, logfile=telnet_log)
     tn.write("vt100\n")
 
     session_log = ""
@@ -118,7 +198,9 @@ def get_ephemerides_for_object(object_name,
         # This was a search for the exact designation
 
         # Read the rest of the output
-        return_string += tn.read_until(":")
+        exact_return = tn.read_until(":")
+        return_string += exact_return
+        session_log += exact_return
         #
         # NASA returns
         # ---
@@ -280,7 +362,7 @@ def get_ephemerides_for_object(object_name,
     session_log += horizon_return 
     if (verbose): print(horizon_return, end=" ")
     logger.debug(horizon_return)
-    tn.write("695@399\n")
+    tn.write("%s\n" % (site))
 
     horizon_return = tn.read_until(" Confirm selected station    [ y/n ] --> ")
     session_log += horizon_return 
@@ -430,10 +512,11 @@ def get_ephemerides_for_object(object_name,
     if (verbose): print(ephemdata, end="")
     logger.debug(ephemdata)
 
-    datafile = open("telnet.csv", "w")
-    print(ephemdata, file=datafile)
-    datafile.close()
-    
+    if (scratch_dir is not None):
+        datafile = open(os.path.join(scratch_dir, "telnet.csv"), "w")
+        print(ephemdata, file=datafile)
+        datafile.close()
+
     horizon_return = tn.read_until(" >>> Select... [A]gain, [N]ew-case, [F]tp, [M]ail, [R]edisplay, ? : ")
     session_log += horizon_return 
     if (verbose): print(horizon_return, end=" ")
@@ -450,37 +533,353 @@ def get_ephemerides_for_object(object_name,
     logger.debug("Closing connection")
     tn.close()
 
+    if (timings is not None):
+        timings.extend(tn.timings)
+
     if (session_log_file is not None):
         logger.debug("Saving session to file %s" % (session_log_file))
         logfile = open(session_log_file, "w")
         print(session_log, file=logfile)
         logfile.close()
 
+    return ephemdata
+
+
+
+#
+# Columns of the ephemeris table, and where to find them in the CSV table
+# returned by Horizons for quantities 1,3,7,9
+#
+ephemeris_dtype = numpy.dtype([
+    ('mjd', numpy.float64),
+    ('ra', numpy.float64),
+    ('dec', numpy.float64),
+    ('rate_ra', numpy.float64),
+    ('rate_dec', numpy.float64),
+    ('mag', numpy.float64),
+])
+ephemeris_csv_columns = [0, 3, 4, 5, 6, 8]
+
+
+def ephemeris_table(data):
+    """
+
+    Return a structured view (columns mjd, ra, dec, rate_ra, rate_dec, mag)
+    of a 2-d ephemeris array, sharing its memory.
+
+    """
+
+    return numpy.ascontiguousarray(data).view(ephemeris_dtype).reshape((-1))
+
+
+def parse_ephemerides(ephemdata):
+    """
+
+    Convert the raw CSV table returned by Horizons into an array with columns
+    MJD, Ra, Dec, Ra rate, Dec rate, magnitude.
+
+    """
+
+    jd2mjd = 2400000.5
+
+    eoe = ephemdata.find("$$EOE")
+    table = ephemdata[:eoe] if eoe >= 0 else ephemdata
+    table = table.replace("\r", "").replace("n.a.", "nan").strip("\n")
+    if (table == ""):
+        return numpy.zeros((0, len(ephemeris_csv_columns)))
+
+    # Split all lines at once; this only works if all lines have the same
+    # number of fields, which is always the case for valid Horizons output
+    n_lines = table.count("\n") + 1
+    fields = table.replace("\n", ",").split(",")
+    n_fields = len(fields) // n_lines
+    if (n_fields * n_lines != len(fields)):
+        raise ValueError("Unable to interpret Horizons ephemeris table")
+
+    data = numpy.empty((n_lines, len(ephemeris_csv_columns)), dtype=numpy.float64)
+    for i, col in enumerate(ephemeris_csv_columns):
+        column = fields[col::n_fields]
+        try:
+            data[:,i] = numpy.fromiter(map(float, column), dtype=numpy.float64, count=n_lines)
+        except ValueError:
+            # Some entries are missing or not numbers
+            data[:,i] = [safe_float(x) for x in column]
+    data[:,0] -= jd2mjd
+
+    return data
+
+
+
+class Ephemeris(object):
+    """
+
+    Cubic-spline interpolation of an ephemeris table (columns MJD, Ra, Dec,
+    Ra rate, Dec rate, and optionally magnitude).
+
+    The spline coefficients are computed once, all evaluations are vectorized
+    over arrays of MJDs. Ra is interpolated after unwrapping it at 0/360
+    degrees, so objects crossing Ra=0 are handled correctly. Requesting times
+    outside the covered MJD range raises a ValueError, like interp1d did.
+
+    """
+
+    columns = ['ra', 'dec', 'rate_ra', 'rate_dec', 'mag']
+
+    def __init__(self, data=None):
+        self.splines = {}
+        self.mjd_range = (numpy.nan, numpy.nan)
+        if (data is None):
+            return
+
+        data = numpy.array(data, dtype=numpy.float64).reshape((-1, numpy.shape(data)[-1]))
+        data = data[numpy.isfinite(data[:,0])]
+        mjd, unique = numpy.unique(data[:,0], return_index=True)
+        data = data[unique]
+        if (mjd.shape[0] < 1):
+            raise ValueError("Ephemeris needs at least one valid entry")
+        self.mjd_range = (mjd[0], mjd[-1])
+
+        # Only unwrap valid entries, a single NaN would spoil all later ones
+        valid_ra = numpy.isfinite(data[:,1])
+        data[valid_ra,1] = numpy.degrees(numpy.unwrap(numpy.radians(data[valid_ra,1])))
+
+        for i, name in enumerate(self.columns[:data.shape[1]-1]):
+            values = data[:,i+1]
+            valid = numpy.isfinite(values)
+            n_valid = numpy.sum(valid)
+            if (n_valid < 1):
+                continue
+            elif (n_valid == 1):
+                self.splines[name] = float(values[valid][0])
+            else:
+                self.splines[name] = tuple(scipy.interpolate.splrep(
+                    mjd[valid], values[valid], k=min(3, n_valid-1), s=0))
+
+    def check_range(self, mjd):
+        mjd = numpy.asarray(mjd, dtype=numpy.float64)
+        if (numpy.any(mjd < self.mjd_range[0] - 1e-9) or numpy.any(mjd > self.mjd_range[1] + 1e-9)):
+            raise ValueError("MJD outside the ephemeris range (%f ... %f)" % (self.mjd_range))
+        return mjd
+
+    def evaluate(self, name, mjd):
+        mjd = self.check_range(mjd)
+        if (not name in self.splines):
+            raise ValueError("Ephemeris has no valid %s data" % (name))
+        spline = self.splines[name]
+        if (not type(spline) == tuple):
+            return numpy.ones_like(mjd) * spline
+        return scipy.interpolate.splev(mjd, spline)
+
+    def ra(self, mjd, wrap=True):
+        """
+
+        Ra at the given MJDs; with wrap=False the Ra is continuous (and may
+        go beyond 0 ... 360 degrees), e.g. to compute differences in Ra.
+
+        """
+
+        ra = self.evaluate('ra', mjd)
+        return numpy.mod(ra, 360.) if wrap else ra
+
+    def dec(self, mjd):
+        return self.evaluate('dec', mjd)
+
+    def rate_ra(self, mjd):
+        return self.evaluate('rate_ra', mjd)
+
+    def rate_dec(self, mjd):
+        return self.evaluate('rate_dec', mjd)
+
+    def mag(self, mjd):
+        return self.evaluate('mag', mjd)
+
+    def positions(self, mjd):
+        """
+
+        Return an array with Ra and Dec for all MJDs.
+
+        """
+
+        mjd = numpy.asarray(mjd, dtype=numpy.float64)
+        positions = numpy.empty(mjd.shape + (2,))
+        positions[...,0] = self.ra(mjd)
+        positions[...,1] = self.dec(mjd)
+        return positions
+
+    def to_dict(self):
+        return {
+            'mjd_range': tuple(self.mjd_range),
+            'splines': dict(self.splines),
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        ephemeris = cls()
+        ephemeris.mjd_range = tuple(d['mjd_range'])
+        ephemeris.splines = dict(d['splines'])
+        return ephemeris
+
+
+
+def datetime_to_mjd(datetime_str):
+    """
+
+    Convert a Horizons start/end time (e.g. 2014-12-30, 2014-12-30 12:00 or
+    2014-Dec-30 12:00) to MJD; returns None for formats we do not understand.
+
+    """
+
+    mjd_ref_datetime = datetime.datetime(2000,1,1,0,0)
+    mjd_to_y2k = 51544.
+
+    for fmt in ["%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d",
+                "%Y-%b-%d %H:%M:%S", "%Y-%b-%d %H:%M", "%Y-%b-%d"]:
+        try:
+            dt = datetime.datetime.strptime(str(datetime_str).strip(), fmt)
+        except ValueError:
+            continue
+        return (dt - mjd_ref_datetime).total_seconds() / 86400. + mjd_to_y2k
+
+    return None
+
+
+
+def get_ephemeris_cache():
+    return podi_diskcache.DiskCache(ephemeris_cache_dir,
+                                    max_size=ephemeris_cache_max_size,
+                                    max_age=ephemeris_cache_max_age)
+
+
+
+def ephemeris_cache_key(object_name, time_interval, quantities, site, host, port):
+    """
+
+    All cache entries for the same object, step, quantities and site share
+    this key as prefix of their name, followed by the covered MJD range.
+    Results from servers other than the real Horizons (e.g. a replay server)
+    are kept apart.
+
+    """
+
+    server = "horizons"
+    if (host != default_horizons_host or port != default_horizons_port):
+        server = "%s:%d" % (host, port)
+    return podi_diskcache.make_key(server, object_name.strip(), time_interval.strip(),
+                                   quantities.strip(), site.strip())
+
+
+
+def find_cached_ephemerides(cache, cache_key, start_mjd, end_mjd):
+    """
+
+    Return the cache entry covering start_mjd ... end_mjd, or None.
+
+    """
+
+    for name in cache.names(prefix=cache_key):
+        try:
+            entry_start, entry_end = [float(x) for x in name[len(cache_key)+1:].split("_")]
+        except ValueError:
+            continue
+        if (entry_start > start_mjd + 1e-6 or entry_end < end_mjd - 1e-6):
+            continue
+
+        entry = cache.get(name)
+        if (entry is not None):
+            return entry
+
+    return None
+
+
+
+def get_ephemerides_for_object(object_name, 
+                               start_datetime="2012-01-01",
+                               end_datetime="2014-01-01",
+                               time_interval="6h",
+                               session_log_file=None,
+                               verbose=True,
+                               compute_interpolation=False,
+                               quantities='1,3,7,9',
+                               site=horizons_site,
+                               host=None,
+                               port=None,
+                               use_cache=None,
+                               scratch_dir=None,
+                               timeout=None):
+
+    logger = logging.getLogger("HorizonInterface")
+
+    if (use_cache is None):
+        use_cache = use_ephemeris_cache
+    if (host is None): host = horizons_host
+    if (port is None): port = horizons_port
+
+    start_mjd = datetime_to_mjd(start_datetime)
+    end_mjd = datetime_to_mjd(end_datetime)
+    if (start_mjd is None or end_mjd is None):
+        logger.debug("Unable to convert %s ... %s to MJD, not using cache" % (
+            start_datetime, end_datetime))
+        use_cache = False
+
+    ephemdata, ephemeris = None, None
+    if (use_cache):
+        cache = get_ephemeris_cache()
+        cache_key = ephemeris_cache_key(object_name, time_interval, quantities, site, host, port)
+
+        # Hold the lock while querying Horizons, so concurrent runs for the
+        # same object wait for this query instead of sending their own
+        with cache.lock(cache_key):
+            entry = find_cached_ephemerides(cache, cache_key, start_mjd, end_mjd)
+            if (entry is not None):
+                logger.info("Using cached ephemeris for %s (%s ... %s, %s)" % (
+                    object_name, start_datetime, end_datetime, time_interval))
+                ephemdata = entry['raw']
+                if ('ephemeris' in entry):
+                    ephemeris = Ephemeris.from_dict(entry['ephemeris'])
+            else:
+                ephemdata = query_horizons(object_name, start_datetime, end_datetime, time_interval,
+                                           session_log_file=session_log_file, verbose=verbose,
+                                           quantities=quantities, site=site, host=host, port=port,
+                                           scratch_dir=scratch_dir, timeout=timeout)
+                if (ephemdata is None):
+                    return None
+                ephemeris = Ephemeris(parse_ephemerides(ephemdata))
+                cache.put("%s_%.6f_%.6f" % (cache_key, start_mjd, end_mjd), {
+                    'object_name': object_name,
+                    'time_interval': time_interval,
+                    'quantities': quantities,
+                    'site': site,
+                    'raw': ephemdata,
+                    'ephemeris': ephemeris.to_dict(),
+                })
+    else:
+        ephemdata = query_horizons(object_name, start_datetime, end_datetime, time_interval,
+                                   session_log_file=session_log_file, verbose=verbose,
+                                   quantities=quantities, site=site, host=host, port=port,
+                                   scratch_dir=scratch_dir, timeout=timeout)
+        if (ephemdata is None):
+            return None
 
     #
     # Analyse the output 
     #
-    jd2mjd = 2400000.5
-    np = []
-    np_all = []
-    ephemdata_lines = str(ephemdata).split("\n")
-    with open("dummy.test", "wb") as f:
-        f.write(bytes(ephemdata, 'UTF-8'))
-
-    logger.info("Interpreting results (%d lines)" % (len(ephemdata_lines)))
-    for line in ephemdata_lines[:-1]:
-        items = line.split(',')
-        mjd = safe_float(items[0]) - jd2mjd
-        ra = safe_float(items[3])
-        dec = safe_float(items[4])
-        rate_ra = safe_float(items[5])
-        rate_dec = safe_float(items[6])
-        mag = safe_float(items[8])
-        np_all.append(items)
-        np.append([mjd,ra,dec,rate_ra,rate_dec, mag])
-    data = numpy.array(np)
-    full_data = np_all #numpy.array(np_all)
-    numpy.savetxt("ephem.data", data)
+    data = parse_ephemerides(ephemdata)
+    logger.info("Interpreting results (%d lines)" % (data.shape[0]))
+    if (ephemeris is None):
+        ephemeris = Ephemeris(data)
+
+    if (use_cache):
+        # Cut the table down to the requested range, in case it came from a
+        # cache entry covering a wider range
+        in_range = (data[:,0] >= start_mjd - 1e-6) & (data[:,0] <= end_mjd + 1e-6)
+        if (not numpy.all(in_range)):
+            ephemdata_lines = str(ephemdata).split("\n")
+            ephemdata = "\n".join([line for line, keep in zip(ephemdata_lines[:-1], in_range) if keep]
+                                  + ephemdata_lines[-1:])
+            data = data[in_range]
+
+    if (scratch_dir is not None):
+        numpy.savetxt(os.path.join(scratch_dir, "ephem.data"), data)
 
     # Now create some interpolation vectors
     if (compute_interpolation):
@@ -496,12 +895,12 @@ def get_ephemerides_for_object(object_name,
         'ra': ra_vs_mjd,
         'dec': dec_vs_mjd,
         'rate_ra': rate_ra_vs_mjd,
-        'rate_ra': rate_dec_vs_mjd,
-        'full_data': full_data,
+        'rate_dec': rate_dec_vs_mjd,
+        'full_data': ephemeris_table(data),
+        'ephemeris': ephemeris,
         #'raw': '',
         'raw': ephemdata,
         }
-    print(ephemdata)
 
     #
     #
@@ -660,8 +1059,9 @@ def load_ephemerides(filename, plot=False):
 
     data = numpy.array(data)
 
-    ra_vs_mjd = scipy.interpolate.interp1d( data[:,0], data[:,1], kind='linear' )
-    dec_vs_mjd = scipy.interpolate.interp1d( data[:,0], data[:,1], kind='linear' )
+    ephemeris = Ephemeris(data)
+    ra_vs_mjd = ephemeris.ra
+    dec_vs_mjd = ephemeris.dec
 
     if (plot):
         fig = matplotlib.pyplot.figure()
@@ -681,6 +1081,9 @@ def load_ephemerides(filename, plot=False):
    
 if __name__ == "__main__":
 
+    if (cmdline_arg_isset("-horizons")):
+        set_horizons_server(get_cmdline_arg("-horizons"))
+
     if (cmdline_arg_isset("-times")):
         filelist = get_clean_cmdline()[1:]
         find_timescale(filelist)
@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2014, Ralf Kotulla
+#                     kotulla@uwm.edu
+#
+# All rights reserved
+#
+
+"""
+
+Local stand-in for the NASA Horizons telnet server.
+
+The server replays the session logs written by podi_ephemerides (via
+session_log_file, e.g. NASA_horizons__<object>.log or the <object>.log files
+of bulk_query.py). Each log is cut into the replies Horizons sent after each
+command, and every line received from a client is answered with the next
+reply of the session for the requested object. This allows to test the
+Horizons client, the table parsing and bulk_query.py without a network
+connection, by pointing them at the replay server with -horizons=host:port.
+
+Usage:
+
+  podi_horizonsreplay.py -port=6775 -latency=0.0 session1.log session2.log ...
+
+    Run the replay server until interrupted. With -latency, each reply is
+    delayed by the given number of seconds to mimic the network round-trip.
+
+  podi_horizonsreplay.py -benchmark -n=20 -workers=4 session1.log ...
+
+    Start the replay server in the background, run n queries with the given
+    number of concurrent clients and report the per-prompt latency.
+
+"""
+
+from __future__ import print_function
+
+import os, sys
+import re
+import time
+import socket
+import threading
+import logging
+import numpy
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+import podi_ephemerides
+from podi_commandline import *
+import podi_logging
+
+#
+# Horizons waits for input after each of these prompts
+#
+prompt_pattern = re.compile(r"(\] :|\] -->|<cr>:|Horizons>|, \? :) ?")
+
+#
+# The client relies on the first lines of a reply arriving in separate
+# packets (like they do from the real server), so these are sent one by one
+#
+trickle_lines = 8
+trickle_delay = 0.002
+
+
+
+def split_session(session_log):
+    """
+
+    Split a session log into the replies Horizons sent after each command,
+    starting with the welcome message.
+
+    """
+
+    replies = []
+    start = 0
+    for match in prompt_pattern.finditer(session_log):
+        replies.append(session_log[start:match.end()])
+        start = match.end()
+    if (start < len(session_log)):
+        replies.append(session_log[start:])
+    return replies
+
+
+
+def normalize_name(name):
+    return re.sub(r"[^a-z0-9]", "", name.lower())
+
+
+
+def load_sessions(filenames):
+    """
+
+    Read all session logs, and return a dictionary of reply lists, indexed by
+    the normalized object name.
+
+    The object name is taken from the echo of the client's query at the start
+    of the second reply, and from the log's filename.
+
+    """
+
+    logger = logging.getLogger("HorizonsReplay")
+
+    sessions = {}
+    for filename in filenames:
+        # Binary mode, to keep the \r\n line endings sent by Horizons
+        with open(filename, "rb") as f:
+            replies = split_session(f.read().decode("utf-8"))
+        if (len(replies) < 3):
+            logger.warning("%s does not look like a Horizons session, skipping" % (filename))
+            continue
+
+        names = [os.path.splitext(os.path.basename(filename))[0].replace("NASA_horizons__", "")]
+        echo = replies[1].strip().splitlines()
+        if (len(echo) > 0):
+            names.append(echo[0])
+
+        for name in names:
+            sessions[normalize_name(name)] = replies
+        logger.debug("Loaded %d replies for %s from %s" % (len(replies), names[-1], filename))
+
+    return sessions
+
+
+
+class ReplayHandler(socketserver.StreamRequestHandler):
+
+    def send_reply(self, reply):
+        time.sleep(self.server.latency)
+
+        lines = reply.split("\n")
+        pieces = [line+"\n" for line in lines[:-1]] + [lines[-1]]
+        for piece in pieces[:trickle_lines]:
+            self.wfile.write(piece.encode("utf-8"))
+            time.sleep(trickle_delay)
+        self.wfile.write("".join(pieces[trickle_lines:]).encode("utf-8"))
+
+    def handle(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        logger = logging.getLogger("HorizonsReplay")
+
+        # The welcome message is the same in all sessions
+        replies = self.server.welcome
+        if (self.rfile.readline() == b""):
+            return
+        self.send_reply(replies[0])
+
+        object_name = self.rfile.readline().decode("utf-8").strip()
+        replies = self.server.sessions.get(normalize_name(object_name), None)
+        if (replies is None):
+            logger.warning("No recorded session for %s" % (object_name))
+            return
+        logger.debug("Replaying session for %s" % (object_name))
+
+        for reply in replies[1:]:
+            self.send_reply(reply)
+            if (reply is replies[-1] or self.rfile.readline() == b""):
+                break
+
+
+
+class ReplayServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, sessions, host="localhost", port=0, latency=0.):
+        if (len(sessions) <= 0):
+            raise ValueError("No Horizons sessions to replay, check the session log files")
+        socketserver.TCPServer.__init__(self, (host, port), ReplayHandler)
+        self.sessions = sessions
+        self.welcome = list(sessions.values())[0]
+        self.latency = latency
+
+    @property
+    def address(self):
+        return "%s:%d" % self.server_address[:2]
+
+
+
+def start_server(filenames, host="localhost", port=0, latency=0.):
+    """
+
+    Start a replay server for the given session logs in a background thread;
+    with port=0 a free port is chosen (see server.address).
+
+    """
+
+    server = ReplayServer(load_sessions(filenames), host=host, port=port, latency=latency)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+
+def benchmark(filenames, n_queries=20, n_workers=4, latency=0.):
+    """
+
+    Run n_queries Horizons queries (cycling through all recorded objects)
+    against a replay server, using n_workers concurrent clients, and return
+    the latency of each prompt and the time needed to parse the tables.
+
+    """
+
+    import multiprocessing.pool
+
+    logger = logging.getLogger("HorizonsReplay")
+
+    server = start_server(filenames, latency=latency)
+    host, port = server.server_address[:2]
+    object_names = []
+    for replies in server.sessions.values():
+        echo = replies[1].strip().splitlines()
+        if (len(echo) > 0 and not echo[0] in object_names):
+            object_names.append(echo[0])
+
+    def run_query(i):
+        timings = []
+        start = time.time()
+        ephemdata = podi_ephemerides.query_horizons(
+            object_names[i % len(object_names)], "2000-01-01", "2000-01-02", "1d",
+            verbose=False, host=host, port=port, timeout=60, timings=timings)
+        session_time = time.time() - start
+
+        start = time.time()
+        podi_ephemerides.parse_ephemerides(ephemdata)
+        return timings, session_time, time.time() - start
+
+    pool = multiprocessing.pool.ThreadPool(n_workers)
+    start = time.time()
+    results = pool.map(run_query, range(n_queries))
+    total_time = time.time() - start
+    pool.close()
+    server.shutdown()
+
+    prompt_latency = {}
+    for (timings, session_time, parse_time) in results:
+        for prompt, seconds in timings:
+            prompt_latency.setdefault(prompt, []).append(seconds)
+
+    logger.info("%d queries in %.2f seconds (%.2f queries/second)" % (
+        n_queries, total_time, n_queries/total_time))
+    return {
+        'prompt_latency': prompt_latency,
+        'session_time': numpy.array([r[1] for r in results]),
+        'parse_time': numpy.array([r[2] for r in results]),
+        'total_time': total_time,
+    }
+
+
+
+if __name__ == "__main__":
+
+    options = read_options_from_commandline(None)
+    podi_logging.setup_logging(options)
+
+    filenames = get_clean_cmdline()[1:]
+    latency = float(cmdline_arg_set_or_default("-latency", 0.))
+
+    if (cmdline_arg_isset("-benchmark")):
+        results = benchmark(filenames,
+                            n_queries=int(cmdline_arg_set_or_default("-n", 20)),
+                            n_workers=int(cmdline_arg_set_or_default("-workers", 4)),
+                            latency=latency)
+
+        print("%-45s %6s %9s %9s %9s" % ("prompt", "count", "mean[ms]", "median", "max"))
+        for prompt, seconds in results['prompt_latency'].items():
+            seconds = numpy.array(seconds) * 1e3
+            print("%-45s %6d %9.2f %9.2f %9.2f" % (
+                prompt[-45:], seconds.shape[0], numpy.mean(seconds), numpy.median(seconds),
+                numpy.max(seconds)))
+        print("session: %.3f s (median), parsing: %.3f s (median), total %.2f s" % (
+            numpy.median(results['session_time']), numpy.median(results['parse_time']),
+            results['total_time']))
+
+    else:
+        server = ReplayServer(load_sessions(filenames),
+                              host=cmdline_arg_set_or_default("-host", "localhost"),
+                              port=int(cmdline_arg_set_or_default("-port", podi_ephemerides.default_horizons_port)),
+                              latency=latency)
+        print("Replaying %d sessions on %s" % (len(filenames), server.address))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        server.server_close()
+
+    podi_logging.shutdown_logging(options)
@@ -5,103 +5,558 @@
 # All rights reserved
 #
 
+"""
+
+Shared SourceExtractor service for all tools that need source catalogs.
+
+Each SourceExtractor run is described by a job dictionary (see
+sextractor_job). A CatalogService runs jobs in the worker pool shared by all
+stages of a run (see podi_workerpool), largest frames first so that no big
+frame ends up running on its own at the end, skips all jobs whose catalogs
+are up to date, and logs a summary of the queue whenever a job completes.
+
+Next to each catalog, a manifest (<catalog>.manifest, JSON) records the
+SourceExtractor command and a fingerprint of each input file -- the image,
+weight map, config and parameter file: size, modification time, a hash of the
+first few FITS blocks (i.e. the header) and a hash of the full file. A
+catalog is up to date if its manifest exists and all fingerprints still
+match. Only if an input was touched or copied (same size and header, but a
+different modification time) is the full hash computed to tell if it really
+changed, so checking a whole semester of catalogs stays cheap.
+
+Jobs either run the SourceExtractor binary (sextractor_job), or the
+in-process detection of podi_detection (detection_job), which avoids
+starting an external program for each frame and writes the binary catalog
+sidecar (see podi_catalogcache) right away. Select the backend with
+catalog_job().
+
+Jobs can be submitted in several batches; wait() blocks until a given
+catalog (or all of them) is complete, so callers can keep working on other
+things while their catalogs are being created.
+
+"""
+
 import numpy
 import logging
-import multiprocessing
+import threading
 import os
 import time
 import subprocess
+import json
+import hashlib
 
 import podi_sitesetup as sitesetup
+import podi_logging
+import podi_catalogcache
+import podi_detection
+import podi_workerpool
+from podi_catalogcache import write_atomic
+
+manifest_extension = ".manifest"
+fingerprint_bytes = 10 * 2880
+hash_blocksize = 2**20
+
+
+
+def default_weightfile(fitsfile):
+    """
+
+    Return the weight image next to fitsfile, or None if there is none.
+
+    """
+
+    weightfile = fitsfile[:-5]+".weight.fits"
+    if (os.path.isfile(weightfile)):
+        return weightfile
+    return None
+
+
+
+def sextractor_job(fitsfile, catfile=None,
+                   sex_config="diffphot.sex", sex_param="diffphot.sexparam",
+                   weightfile=None, weight_type="MAP_WEIGHT",
+                   extra_options=None, config_dir=None):
+    """
+
+    Describe a SourceExtractor run on fitsfile, writing its catalog to catfile
+    (default: fitsfile with .fits replaced by .cat). The config and parameter
+    files are taken from config_dir (default: the config directory of the
+    installation).
+
+    """
+
+    if (catfile is None):
+        catfile = "%s.cat" % (fitsfile[:-5])
+    if (config_dir is None):
+        config_dir = "%s/config" % (sitesetup.exec_dir)
+
+    config = "%s/%s" % (config_dir, sex_config)
+    param = "%s/%s" % (config_dir, sex_param)
+    command = [sitesetup.sextractor,
+               "-c", config,
+               "-PARAMETERS_NAME", param,
+               "-CATALOG_NAME", catfile]
+    if (weightfile is not None):
+        command += ["-WEIGHT_IMAGE", weightfile, "-WEIGHT_TYPE", weight_type]
+    if (extra_options is not None):
+        command += list(extra_options)
+    command.append(fitsfile)
+
+    return {
+        'backend': 'sextractor',
+        'fitsfile': fitsfile,
+        'catfile': catfile,
+        'weightfile': weightfile,
+        'config': config,
+        'param': param,
+        'command': command,
+    }
+
+
+
+def detection_job(fitsfile, catfile=None, weightfile=None, options=None):
+    """
+
+    Describe an in-process detection run (see podi_detection) on fitsfile;
+    options override podi_detection.default_options. The weight map is only
+    used to mask pixels, so any weight type works.
+
+    """
+
+    if (catfile is None):
+        catfile = "%s.cat" % (fitsfile[:-5])
+
+    all_options = dict(podi_detection.default_options)
+    if (options is not None):
+        all_options.update(options)
+
+    # Not a real command, but it records all settings in the manifest
+    command = ["podi_detection"]
+    command += ["%s=%r" % (key, all_options[key]) for key in sorted(all_options)]
+    command += ["catalog=%s" % (catfile), "weight=%s" % (weightfile), fitsfile]
+
+    return {
+        'backend': 'python',
+        'fitsfile': fitsfile,
+        'catfile': catfile,
+        'weightfile': weightfile,
+        'options': all_options,
+        'command': command,
+    }
+
+
+
+def catalog_job(fitsfile, backend="sextractor", catfile=None, weightfile=None,
+                **sextractor_options):
+    """
+
+    Describe a catalog job for the given backend ("sextractor" or "python");
+    sextractor_options are passed on to sextractor_job, and ignored by the
+    python backend.
+
+    """
+
+    if (backend == "python"):
+        return detection_job(fitsfile, catfile=catfile, weightfile=weightfile)
+    elif (backend == "sextractor"):
+        return sextractor_job(fitsfile, catfile=catfile, weightfile=weightfile,
+                              **sextractor_options)
+    raise ValueError("Unknown detection backend: %s" % (backend))
+
+
+
+def job_inputs(job):
+    """
+
+    Return all input files of a job, indexed by their role.
+
+    """
+
+    return {
+        'image': job['fitsfile'],
+        'weight': job['weightfile'],
+        'config': job.get('config', None),
+        'param': job.get('param', None),
+    }
+
+
+
+def file_fingerprint(fn):
+    """
+
+    Return size, modification time and a hash of the first FITS blocks of fn.
+
+    """
+
+    stat = os.stat(fn)
+    with open(fn, "rb") as f:
+        header = hashlib.sha1(f.read(fingerprint_bytes)).hexdigest()
+    return {
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'header': header,
+    }
+
+
+
+def file_hash(fn):
+    sha1 = hashlib.sha1()
+    with open(fn, "rb") as f:
+        while (True):
+            block = f.read(hash_blocksize)
+            if (not block):
+                break
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+
+def manifest_filename(catfile):
+    return catfile + manifest_extension
+
+
+
+def job_manifest(job):
+    """
+
+    Fingerprint and hash all input files of job. The fingerprint of the
+    catalog itself is added by write_manifest once it has been created.
+
+    """
+
+    inputs = {}
+    for role, fn in job_inputs(job).items():
+        if (fn is None):
+            inputs[role] = None
+            continue
+        inputs[role] = file_fingerprint(fn)
+        inputs[role]['path'] = os.path.abspath(fn)
+        inputs[role]['sha1'] = file_hash(fn)
+
+    return {
+        'command': job['command'],
+        'inputs': inputs,
+        'catalog': None,
+    }
+
+
+
+def write_manifest(catfile, manifest):
+
+    stat = os.stat(catfile)
+    manifest['catalog'] = {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+    def write_json(filename):
+        with open(filename, "w") as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+
+    write_atomic(manifest_filename(catfile), write_json)
 
 
-def parallel_sourceextractor(queue, dummy):
+
+def read_manifest(catfile):
+
+    try:
+        with open(manifest_filename(catfile), "r") as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+
+def catalog_is_current(job):
+    """
+
+    Check if the job's catalog exists and was created by the same command from
+    the same input files, as recorded in the catalog's manifest.
+
+    """
+
+    logger = logging.getLogger("MakeCat")
+    catfile = job['catfile']
+
+    if (not os.path.isfile(catfile)):
+        return False
+    manifest = read_manifest(catfile)
+    if (manifest is None):
+        logger.debug("No manifest for %s" % (catfile))
+        return False
+    if (manifest['command'] != job['command']):
+        logger.debug("SourceExtractor options for %s have changed" % (catfile))
+        return False
+
+    # Make sure the catalog is still the one the manifest was written for
+    stat = os.stat(catfile)
+    if (manifest['catalog'] is None or
+        manifest['catalog']['size'] != stat.st_size or
+        manifest['catalog']['mtime'] != stat.st_mtime):
+        logger.debug("Catalog %s was modified" % (catfile))
+        return False
+
+    touched = False
+    for role, fn in job_inputs(job).items():
+        recorded = manifest['inputs'].get(role, None)
+        if (fn is None or recorded is None):
+            if (fn is not None or recorded is not None):
+                return False
+            continue
+
+        try:
+            fingerprint = file_fingerprint(fn)
+        except (IOError, OSError):
+            return False
+        if (fingerprint['size'] != recorded['size'] or
+            fingerprint['header'] != recorded['header']):
+            logger.debug("%s (%s) has changed" % (fn, role))
+            return False
+        if (fingerprint['mtime'] != recorded['mtime']):
+            # Same size and header, but touched or copied -- only the full
+            # hash can tell if the data changed
+            if (file_hash(fn) != recorded['sha1']):
+                logger.debug("%s (%s) has changed" % (fn, role))
+                return False
+            recorded['mtime'] = fingerprint['mtime']
+            touched = True
+
+    if (touched):
+        # Remember the new modification times, so the next check is cheap again
+        try:
+            write_manifest(catfile, manifest)
+        except (IOError, OSError):
+            pass
+
+    return True
+
+
+
+def job_size(job):
+    try:
+        return os.path.getsize(job['fitsfile'])
+    except OSError:
+        return 0
+
+
+
+def run_job(job):
+    """
+
+    Create the catalog for one job, and return a summary of the run.
+
+    """
+
+    if (job.get('backend', 'sextractor') == 'python'):
+        return run_detection(job)
+    return run_sextractor(job)
+
+
+
+def run_detection(job):
+
+    logger = logging.getLogger("Detection")
+
+    logger.info("Creating source catalog for %s" % (job['fitsfile']))
+    start_time = time.time()
+    ok = False
+    try:
+        manifest = job_manifest(job)
+        cat_data = podi_detection.catalog_from_fits(
+            job['fitsfile'], weightfile=job['weightfile'], options=job['options'])
+        podi_catalogcache.save_catalog(job['catfile'], cat_data, job['fitsfile'])
+        write_manifest(job['catfile'], manifest)
+        ok = True
+    except (IOError, OSError, ValueError) as e:
+        podi_logging.log_exception()
+        logger.error("Source detection failed: %s" % (str(e)))
+    end_time = time.time()
+    logger.debug("Source detection returned after %.3f seconds" % (end_time - start_time))
+
+    return {
+        'fitsfile': job['fitsfile'],
+        'catfile': job['catfile'],
+        'returncode': 0 if ok else 1,
+        'time': end_time - start_time,
+        'ok': ok,
+    }
+
+
+
+def run_sextractor(job):
+    """
+
+    Run SourceExtractor for one job, and return a summary of the run.
+
+    """
 
     logger = logging.getLogger("ParSEx")
 
-    while (True):
+    logger.info("Creating source catalog for %s" % (job['fitsfile']))
+    logger.debug("Sextractor command:\n%s" % (" ".join(job['command'])))
+    start_time = time.time()
+    returncode = None
+    try:
+        # Fingerprint the inputs before running, in case they change meanwhile
+        manifest = job_manifest(job)
+        ret = subprocess.Popen(job['command'],
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+        (sex_stdout, sex_stderr) = ret.communicate()
+        returncode = ret.returncode
+        if (ret.returncode != 0):
+            logger.warning("Sextractor might have a problem, check the log")
+            logger.debug("Stdout=\n%s" % (sex_stdout))
+            logger.debug("Stderr=\n%s" % (sex_stderr))
+        elif (os.path.isfile(job['catfile'])):
+            write_manifest(job['catfile'], manifest)
+    except (IOError, OSError) as e:
+        podi_logging.log_exception()
+        logger.error("Execution failed: %s" % (str(e)))
+    end_time = time.time()
+    logger.debug("SourceExtractor returned after %.3f seconds" % (end_time - start_time))
+
+    return {
+        'fitsfile': job['fitsfile'],
+        'catfile': job['catfile'],
+        'returncode': returncode,
+        'time': end_time - start_time,
+        'ok': (returncode == 0 and os.path.isfile(job['catfile'])),
+    }
+
+
+
+class CatalogService(object):
+
+    def __init__(self, n_processes=None):
+
+        self.n_processes = sitesetup.number_cpus if n_processes is None else n_processes
+        self.private_pool = (n_processes is not None)
+        self.pool = None
+        self.pending = {}
+        self.results = {}
+        self.n_submitted = 0
+        self.n_done = 0
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.logger = logging.getLogger("CatalogService")
+
+    def submit(self, jobs, force=False):
+        """
+
+        Queue all jobs whose catalogs are missing or out of date (or all jobs,
+        with force=True), unless the same catalog is still being created by
+        an earlier job. Returns the list of queued jobs.
+
+        """
+
+        # Forget about jobs that are done, their results are kept in 
+        # self.results
+        for catfile in list(self.pending.keys()):
+            if (self.pending[catfile].ready()):
+                del self.pending[catfile]
+
+        todo = []
+        for job in jobs:
+            if (not os.path.isfile(job['fitsfile'])):
+                self.logger.debug("%s does not exist, skipping" % (job['fitsfile']))
+            elif (job['catfile'] in self.pending):
+                self.logger.debug("Catalog %s is already queued" % (job['catfile']))
+            elif (force):
+                todo.append(job)
+            elif (catalog_is_current(job)):
+                self.logger.debug("Catalog %s is up to date" % (job['catfile']))
+            else:
+                todo.append(job)
+
+        # Largest frames first
+        todo.sort(key=job_size, reverse=True)
+
+        self.logger.info("Ordered %d new source catalogs (%d skipped)" % (
+            len(todo), len(jobs)-len(todo)))
+        if (len(todo) <= 0):
+            return todo
+
+        if (self.pool is None):
+            # Use the shared pool, unless asked for a specific number of processes
+            if (self.private_pool):
+                self.pool = podi_workerpool.WorkerPool(n_processes=self.n_processes)
+            else:
+                self.pool = podi_workerpool.get_pool()
+            self.n_processes = self.pool.n_processes
+        for job in todo:
+            with self.lock:
+                self.n_submitted += 1
+            self.pending[job['catfile']] = self.pool.submit(
+                run_job, job, callback=self.job_done)
+
+        return todo
 
-        cmd = queue.get()
-        if (cmd == None):
-            queue.task_done()
-            break
+    def job_done(self, result):
+        with self.lock:
+            self.results[result['catfile']] = result
+            self.n_done += 1
+            n_done = self.n_done
+            n_left = self.n_submitted - n_done
+        n_running = min(n_left, self.n_processes)
+        self.logger.info("%s: %s after %.1f s -- %d done, %d running, %d waiting (%.1f s elapsed)" % (
+            os.path.basename(result['fitsfile']), "done" if result['ok'] else "FAILED",
+            result['time'], n_done, n_running, n_left - n_running,
+            time.time() - self.start_time))
+
+    def wait(self, catfile=None):
+        """
+
+        Wait for the job creating catfile (or all jobs if catfile is None) to
+        complete. Returns the result of that job (None if it was never
+        queued, e.g. because the catalog was up to date), or a dictionary
+        with the results of all jobs.
+
+        """
+
+        if (catfile is not None):
+            if (catfile in self.pending):
+                self.pending[catfile].get()
+            return self.results.get(catfile, None)
+
+        for pending in list(self.pending.values()):
+            pending.get()
+        return self.results
+
+    def close(self):
+        if (self.pool is not None and self.private_pool):
+            self.pool.close()
+        self.pool = None
+
+        if (len(self.results) > 0):
+            cpu_time = numpy.sum([r['time'] for r in self.results.values()])
+            self.logger.info("Created %d source catalogs, %.1f s detection time in %.1f s" % (
+                len(self.results), cpu_time, time.time() - self.start_time))
+
+    def run(self, jobs, force=False):
+        """
+
+        Create the catalogs for all jobs and wait until they are complete.
+
+        """
 
-        sexcmd, fitsfile = cmd
-        logger.info("Creating source catalog for %s" % (fitsfile))
-        start_time = time.time()
         try:
-            ret = subprocess.Popen(sexcmd.split(), 
-                                   stdout=subprocess.PIPE, 
-                                   stderr=subprocess.PIPE)
-            (sex_stdout, sex_stderr) = ret.communicate()
-            #os.system(sexcmd)
-            if (ret.returncode != 0):
-                logger.warning("Sextractor might have a problem, check the log")
-                logger.debug("Stdout=\n"+sex_stdout)
-                logger.debug("Stderr=\n"+sex_stderr)
-        except OSError as e:
-            podi_logging.log_exception()
-            print >>sys.stderr, "Execution failed:", e
-        end_time = time.time()
-        logger.debug("SourceExtractor returned after %.3f seconds" % (end_time - start_time))
-
-        queue.task_done()
-
-def make_catalogs(inputlist, sex_config, sex_param, use_weight=True):
-
-    jobqueue = multiprocessing.JoinableQueue()
+            self.submit(jobs, force=force)
+            return self.wait()
+        finally:
+            self.close()
+
+
+
+def make_catalogs(inputlist, sex_config, sex_param, use_weight=True, n_processes=None,
+                  backend="sextractor"):
 
     logger = logging.getLogger("MakeCat")
 
-    number_sex_runs = 0
+    jobs = []
     for fitsfile in inputlist:
-        catfile = "%s.cat" % (fitsfile[:-5])
-
-        if (os.path.isfile(catfile)):
-            # Don't do anything if the catalog already exists
-            continue
+        weightfile = default_weightfile(fitsfile) if use_weight else None
+        jobs.append(catalog_job(fitsfile, backend=backend, weightfile=weightfile,
+                                sex_config=sex_config, sex_param=sex_param))
 
-        # check if there is a weight image available; if so, use it
-        weight_params = ""
-        weightfile = fitsfile[:-5]+".weight.fits"
-        if (os.path.isfile(weightfile) and use_weight):
-            weight_params = "-WEIGHT_TYPE MAP_WEIGHT -WEIGHT_IMAGE %s" % (weightfile)
-
-        logger.debug("Ordering source catalog for %s" % (fitsfile))
-        sex_config_file = "%s/config/%s" % (sitesetup.exec_dir, sex_config)
-        parameters_file = "%s/config/%s" % (sitesetup.exec_dir, sex_param)
-        sexcmd = "%(sex)s -c %(config)s -PARAMETERS_NAME %(param)s -CATALOG_NAME %(catname)s %(weight)s %(inputfile)s" % {
-            'sex': sitesetup.sextractor,
-            'config': sex_config_file,
-            'param': parameters_file, 
-            'catname': catfile, 
-            'weight': weight_params,
-            'inputfile': fitsfile,
-        }
-        
-        jobqueue.put((sexcmd, fitsfile))
-        number_sex_runs += 1
-
-    logger.info("Ordered %d new source catalogs, please wait" % (number_sex_runs))
-
-    #
-    # Start worker processes
-    #
-    worker_args = (jobqueue, "")
-    processes = []
-    for i in range(sitesetup.number_cpus):
-        p = multiprocessing.Process(target=parallel_sourceextractor, args=worker_args)
-        p.start()
-        processes.append(p)
-
-        # also add a quit-command for each process
-        jobqueue.put(None)
-        
-    #
-    # wait until all work is done
-    #
-    jobqueue.join()
+    results = CatalogService(n_processes=n_processes).run(jobs)
     logger.info("All source catalogs have been created!")
 
-    return
-
+    return results
@@ -13,13 +13,36 @@ import datetime
 import ephem
 import math
 import numpy
+import logging
 
 bn, _ = os.path.split(os.path.abspath(sys.argv[0]))
 sys.path.append("%s/../" % (bn))
 from podi_commandline import *
+import podi_diskcache
+import podi_orbits
 
 verbose = True
 
+web_server = "http://scully.cfa.harvard.edu"
+web_address = "/cgi-bin/mpcheck.cgi"
+
+#
+# On-disk cache of MPC checker results, shared by all fields and runs. Each
+# entry is keyed by epoch, field center, search radius, limiting magnitude 
+# and observatory code. Field center (also in the query) and epoch (only in
+# the key) are rounded, so all frames of one field taken within a few minutes
+# share one query; the cached positions are moved to the epoch of each frame
+# using the rates of motion. Set use_mpc_cache to False to always query the
+# MPC.
+#
+use_mpc_cache = True
+mpc_cache_dir = os.environ.get("PODI_MPC_CACHE",
+    os.path.join(os.path.expanduser("~"), ".podi_cache", "mpchecker"))
+mpc_cache_max_size = 50 * 2**20
+mpc_cache_max_age = 7 * 86400.
+mpc_epoch_resolution = 0.01 # days
+mpc_center_resolution = 1. # arcmin
+
 def rad2sex(r, print_sign=True, second_digits=2):
     sign = "-" if r < 0 else ("+" if print_sign else "")
     r = math.fabs(r)
@@ -34,28 +57,13 @@ def rad2sex(r, print_sign=True, second_digits=2):
     return fmtd
 
 
-def get_mpc_catalog(fitsfile):
-
-    data = urllib.urlencode({
-        'year': 2014,
-        'month': 3,
-        'day': 17.61,
-        'which': 'pos',
-        'ra': '13 22 17',
-        'decl': '-15 33 16',
-        'radius': 25,
-        'TextArea': '',
-        'limit': 20.0,
-        'oc': 695,
-        'sort': 'd',
-        'mot': 'h',
-        'tmot': 's',
-        'pdes': 'u',
-        'needed': 'f',
-        'type': 'p',
-        'ps': 'n',
-        'submit': " Produce list ",
-    })
+def field_epoch_and_center(fitsfile):
+    """
+
+    Return the time of the observation (as datetime) and the field center 
+    (Ra/Dec in degrees) of fitsfile, or None if the file has no valid WCS.
+
+    """
 
     hdulist = astropy.io.fits.open(fitsfile)
     # print hdulist[0].header
@@ -64,12 +72,6 @@ def get_mpc_catalog(fitsfile):
     date_obs = datetime.datetime.strptime(hdulist[0].header['DATE-OBS'], date_format)
     # print date_obs
 
-    #print date_obs.year
-    #print date_obs.month
-    #print date_obs.day + date_obs.hour/24. + date_obs.minute/1440.
-
-    ut_day = date_obs.day + date_obs.hour/24. + date_obs.minute/1440.
-
     found_radec = False
     for i in range(len(hdulist)):
         if ('CRVAL1' in hdulist[i].header and
@@ -83,74 +85,131 @@ def get_mpc_catalog(fitsfile):
         print "Couldn't find an extension containing both CRVAL1 and CRVAL2 !!!"
         return None
 
+    return date_obs, ra, dec
+
+
+
+def mpc_query_parameters(fitsfile, radius=40, limit=23.0, observatory=695):
+    """
+
+    Return the parameters of the MPC checker query for the field and epoch 
+    of fitsfile, or None if the file has no valid WCS. The field center is
+    rounded to mpc_center_resolution.
+
+    """
+
+    field = field_epoch_and_center(fitsfile)
+    if (field is None):
+        return None
+    date_obs, ra, dec = field
+
+    ut_day = date_obs.day + date_obs.hour/24. + date_obs.minute/1440. + \
+             (date_obs.second + date_obs.microsecond*1e-6)/86400.
+
+    ra = round(ra * 60. / mpc_center_resolution) * mpc_center_resolution / 60.
+    dec = round(dec * 60. / mpc_center_resolution) * mpc_center_resolution / 60.
+
     j2k = ephem.Equatorial(math.radians(ra), math.radians(dec), epoch=ephem.J2000)
-    print j2k.ra, j2k.dec
-    print str(j2k.ra).replace(":", " ")
-    print str(j2k.dec).replace(":", " ")
-
- # str(j2k.ra).replace(":", " ")},
-    data2 = [
-        {'year': date_obs.year},
-        {'month': date_obs.month},
-        {'day': ut_day},
-        {'which': 'pos'},
-        {'ra': rad2sex(math.degrees(j2k.ra/15.), False, 2)},
-        {'decl': rad2sex(math.degrees(j2k.dec), True, 2)},
-        {'TextArea': ''},
-        {'radius': 40},
-        {'limit': 23.0},
-        {'oc': 695},
-        {'sort': 'd'},
-        {'mot': 'h'},
-        {'tmot': 's'},
-        {'pdes': 'u'},
-        {'needed': 'f'},
-        {'ps': 'n'},
-        {'type': 'p'},
+    if (verbose):
+        print j2k.ra, j2k.dec
+
+    return [
+        ('year', date_obs.year),
+        ('month', date_obs.month),
+        ('day', "%.5f" % (ut_day)),
+        ('which', 'pos'),
+        ('ra', rad2sex(math.degrees(j2k.ra/15.), False, 2)),
+        ('decl', rad2sex(math.degrees(j2k.dec), True, 2)),
+        ('TextArea', ''),
+        ('radius', radius),
+        ('limit', limit),
+        ('oc', observatory),
+        ('sort', 'd'),
+        ('mot', 'h'),
+        ('tmot', 's'),
+        ('pdes', 'u'),
+        ('needed', 'f'),
+        ('ps', 'n'),
+        ('type', 'p'),
     ]
 
-    if (verbose):
-        print data2
-        # for key in data2:
-        #     print key, "-->", data2[key]
 
-    url2 = ''
-    for i in data2:
-        url2 += urllib.urlencode(i)+"&"
-        # print url2[:-1]
 
+def query_mpc(params):
+    """
+
+    Send the query to the MPC checker, and return the result page.
 
-    web_server = "http://scully.cfa.harvard.edu"
-    web_address = "/cgi-bin/mpcheck.cgi"
+    """
 
     headers = {"Content-type": "application/x-www-form-urlencoded", 
                "Accept": "text/plain",
                "Referer": "http://www.minorplanetcenter.net/cgi-bin/checkmp.cgi",
     }
 
-    #u = urllib2.urlopen("http://scully/cfa/harvard.edu/cgi-bin/", data)
-    #conn = u.request('POST', web_address, data, headers)
+    req = urllib2.Request(web_server+web_address, urllib.urlencode(params), headers)
+    response = urllib2.urlopen(req)
+    return response.read()
 
-    # print data
 
-    if (not os.path.isfile('dump')):
-        req = urllib2.Request(web_server+web_address, url2, headers)
-        response = urllib2.urlopen(req)
-        the_page = response.read()
 
-        dump = open("dump", "w")
-        dump.write(the_page)
-        dump.close()
-    else:
-        dump = open('dump', 'r')
-        the_page = dump.read()
-        dump.close()
+def mpc_cache_key(params):
+    """
+
+    Return the cache key for the query params, with the epoch rounded to
+    mpc_epoch_resolution.
+
+    """
+
+    key_params = []
+    for (name, value) in params:
+        if (name == 'day'):
+            value = "%.2f" % (round(float(value) / mpc_epoch_resolution) * mpc_epoch_resolution)
+        key_params.append((name, value))
+    return podi_diskcache.make_key(web_server+web_address, key_params)
+
+
+
+def move_to_epoch(results, d_hours):
+    """
+
+    Move all positions by d_hours along their rates of motion (arcsec/hour).
+
+    """
+
+    if (d_hours == 0 or len(results['Name']) <= 0):
+        return results
+
+    dec = parse_sexagesimal(results['DEC']) + results['ddec'] * d_hours / 3600.
+    ra = parse_sexagesimal(results['RA'], hours=True) + \
+         results['dracosdec'] * d_hours / 3600. / numpy.cos(numpy.radians(dec))
+    # with one more digit than the MPC, so small offsets are not rounded away
+    results['RA'] = numpy.array([rad2sex((x / 15.) % 24., False, 2) for x in ra])
+    results['DEC'] = numpy.array([rad2sex(x, True, 1) for x in dec])
+    return results
+
 
-    #print the_page
+
+def get_mpc_cache():
+    return podi_diskcache.DiskCache(mpc_cache_dir,
+                                    max_size=mpc_cache_max_size,
+                                    max_age=mpc_cache_max_age)
+
+
+
+def parse_mpc_page(the_page):
+    """
+
+    Extract all known objects from the MPC checker result page; raises a
+    ValueError if the page does not contain a list of objects.
+
+    """
 
     # Search for the <pre> tag
     pre_start = the_page.find("<pre>")
     pre_end = the_page.find("</pre>")
+    if (pre_start < 0 or pre_end < pre_start):
+        raise ValueError("MPC checker page contains no list of objects")
     pre_block = the_page[pre_start:pre_end]
 
     lines = pre_block.split('\n')
@@ -160,9 +219,10 @@ def get_mpc_catalog(fitsfile):
     # The last line is empty
     datablock = lines[4:-1]
 
-    print "\nResults found:\n---"
-    print "\n".join(datablock)
-    print "---"
+    if (verbose):
+        print "\nResults found:\n---"
+        print "\n".join(datablock)
+        print "---"
 
 
     example = """
@@ -181,8 +241,6 @@ def get_mpc_catalog(fitsfile):
     """
 
 
-
-
     name, ra, dec, d_ra, d_dec, comment = [], [], [], [], [], []
     for obs in datablock:
         id = obs[:8].strip()
@@ -210,21 +268,136 @@ def get_mpc_catalog(fitsfile):
         d_dec.append(_d_dec)
         comment.append(_comment)
 
+    return mpc_catalog(name, ra, dec, d_ra, d_dec, comment)
+
 
-    print name
+
+def mpc_catalog(name=[], ra=[], dec=[], d_ra=[], d_dec=[], comment=[]):
+    """
+
+    Return the dictionary of known objects returned by get_mpc_catalog (by
+    default an empty one).
+
+    """
 
     results = {
-        'RA': numpy.array(ra),
-        'DEC': numpy.array(dec),
-        'Name': name,
-        'dracosdec': numpy.array(d_ra),
-        'ddec': numpy.array(d_dec),
-        'comment': comment,
+        'RA': numpy.array(ra, dtype=str),
+        'DEC': numpy.array(dec, dtype=str),
+        'Name': list(name),
+        'dracosdec': numpy.array(d_ra, dtype=numpy.float64),
+        'ddec': numpy.array(d_dec, dtype=numpy.float64),
+        'comment': list(comment),
         }
 
     return results
 
 
+
+def parse_sexagesimal(values, hours=False):
+    """
+
+    Convert sexagesimal strings ("dd mm ss.s", also with colons) to degrees,
+    all at once; with hours=True the values are hours (e.g. Ra).
+
+    """
+
+    values = numpy.char.strip(numpy.asarray(values, dtype=str))
+    if (values.size <= 0):
+        return numpy.zeros(values.shape)
+    sign = numpy.where(numpy.char.startswith(values, "-"), -1., 1.)
+
+    fields = " ".join(values).replace(":", " ").replace("+", " ").replace("-", " ").split()
+    if (len(fields) == 3 * values.size):
+        dms = numpy.array(fields, dtype=numpy.float64).reshape((-1, 3))
+    else:
+        # not all values have degrees, minutes and seconds
+        dms = numpy.zeros((values.size, 3))
+        for i, value in enumerate(values):
+            items = value.replace(":", " ").replace("+", " ").replace("-", " ").split()
+            dms[i, :len(items)] = [float(x) for x in items[:3]]
+
+    degrees = sign * (dms[:, 0] + dms[:, 1] / 60. + dms[:, 2] / 3600.)
+    return degrees * 15. if hours else degrees
+
+
+
+def get_mpc_catalog(fitsfile, radius=40, limit=23.0, observatory=695, use_cache=None):
+    """
+
+    Return all known objects from the MPC checker within radius (arcmin) of
+    the field center of fitsfile at the time of the observation.
+
+    Results are kept in the MPC cache (see use_mpc_cache), so re-running on 
+    the same fields needs no network access. If the MPC can not be reached,
+    this returns an empty list of objects.
+
+    With an orbital element file (podi_orbits.mpcorb_file), all objects are
+    computed locally instead.
+
+    """
+
+    logger = logging.getLogger("MPChecker")
+
+    if (podi_orbits.mpcorb_file is not None):
+        field = field_epoch_and_center(fitsfile)
+        if (field is None):
+            return None
+        date_obs, ra, dec = field
+        mjd = (date_obs - datetime.datetime(1858, 11, 17)).total_seconds() / 86400.
+        logger.info("Computing known objects from %s" % (podi_orbits.mpcorb_file))
+        return podi_orbits.known_objects(mjd, ra, dec, radius / 60., limit=limit)
+
+    if (use_cache is None):
+        use_cache = use_mpc_cache
+
+    params = mpc_query_parameters(fitsfile, radius=radius, limit=limit, observatory=observatory)
+    if (params is None):
+        return None
+
+    if (verbose):
+        print params
+
+    try:
+        if (use_cache):
+            cache = get_mpc_cache()
+            cache_key = mpc_cache_key(params)
+
+            # Hold the lock while querying, so concurrent runs for the same 
+            # field wait for this query instead of sending their own
+            with cache.lock(cache_key):
+                entry = cache.get(cache_key)
+                if (entry is not None):
+                    try:
+                        results = parse_mpc_page(entry['page'])
+                        logger.info("Using cached MPC results for %s" % (fitsfile))
+                        # The cached query might be for a slightly different time
+                        d_hours = (float(dict(params)['day']) - float(dict(entry['params'])['day'])) * 24.
+                        return move_to_epoch(results, d_hours)
+                    except ValueError:
+                        # e.g. an error page cached by an older version
+                        cache.remove(cache_key)
+
+                the_page = query_mpc(params)
+                # Only keep pages with valid results
+                results = parse_mpc_page(the_page)
+                cache.put(cache_key, {
+                    'params': params,
+                    'page': the_page,
+                })
+                return results
+        else:
+            return parse_mpc_page(query_mpc(params))
+    except (urllib2.URLError, IOError) as e:
+        logger.error("Unable to query the MPC for %s (%s), no known objects available" % (
+            fitsfile, str(e)))
+    except ValueError as e:
+        logger.error("Invalid answer from the MPC for %s (%s), no known objects available" % (
+            fitsfile, str(e)))
+
+    return mpc_catalog()
+
+
+
 def mpc_name2id(name):
 
     # first remove the potential space and/or underscore
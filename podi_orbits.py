@@ -0,0 +1,538 @@
+#
+# Copyright (C) 2014, Ralf Kotulla
+#                     kotulla@uwm.edu
+#
+# All rights reserved
+#
+
+"""
+
+Predict the positions of known minor planets locally from their orbital
+elements (MPCORB.DAT format, as distributed by the Minor Planet Center),
+instead of asking the MPC checker or SkyBoT for each field.
+
+The element file is read once; the parsed elements are kept in a numpy
+archive next to it (<file>.npz) and re-used as long as the element file does
+not change. All objects are then propagated with a vectorized two-body
+solver to the epoch of a frame, so there is no network access at all.
+
+To find the objects in a field, a spatial index (KD-tree on unit vectors) is
+built for all slow objects at one epoch and re-used for all frames within
+index_max_age days of it, with the search radius padded by the maximum
+motion in that time. Fast objects (mostly NEOs) are always propagated
+exactly. Only the objects found in the index are then propagated to the
+exact epoch.
+
+Accuracy: the elements are propagated without planetary perturbations, and
+positions are geocentric (no parallax) with the Earth from low-precision
+elements of the Earth-Moon barycenter. This is good to some ten arcseconds
+for main-belt objects within a few months of the element epoch -- plenty to
+identify known objects, but not for astrometry.
+
+Usage:
+
+  podi_orbits.known_objects(mjd, ra, dec, radius, limit=22.)
+
+returns the same dictionary as podi_mpchecker.get_mpc_catalog (Name, RA and
+DEC as sexagesimal strings, dracosdec and ddec in arcsec/hour, comment), plus
+ra/dec in degrees (ra_deg, dec_deg), magnitude (mag) and distance (delta,
+AU). Use ObjectTable(...).array wherever a SkyBoT VOTable is expected.
+
+"""
+
+import os
+import math
+import logging
+import numpy
+import scipy.spatial
+
+from podi_catalogcache import write_atomic
+
+#
+# MPCORB.DAT file to use instead of the MPC/SkyBoT web services; None uses
+# the web services.
+#
+mpcorb_file = os.environ.get("PODI_MPCORB", None)
+
+index_max_age = 1. # days
+index_rate_limit = 1. # degrees per day; faster objects are not indexed
+index_margin = 0.05 # degrees
+
+obliquity = math.radians(23.4392911)
+speed_of_light = 173.1446327 # AU per day
+mjd_j2000 = 51544.5
+arcsec_per_hour = math.degrees(1.) * 3600. / 24. # from radians per day
+
+# Columns of the MPCORB format (first and last+1 character, counting from 0)
+mpcorb_line_length = 202
+mpcorb_columns = {
+    'H': (8, 13),
+    'G': (14, 19),
+    'epoch': (20, 25),
+    'M': (26, 35),
+    'peri': (37, 46),
+    'node': (48, 57),
+    'incl': (59, 68),
+    'e': (70, 79),
+    'n': (80, 91),
+    'a': (92, 103),
+}
+mpcorb_designation = (0, 7)
+mpcorb_name = (166, 194)
+
+_orbit_catalog = None
+
+
+
+def unpack_digits(codes):
+    """
+
+    Decode the MPC packed digits (0-9, A=10 ... Z=35, a=36 ...) in codes, an
+    array of single bytes.
+
+    """
+
+    lookup = numpy.zeros(256, dtype=int)
+    lookup[ord('0'):ord('9')+1] = numpy.arange(10)
+    lookup[ord('A'):ord('Z')+1] = numpy.arange(10, 36)
+    lookup[ord('a'):ord('z')+1] = numpy.arange(36, 62)
+    return lookup[numpy.frombuffer(codes.tobytes(), dtype=numpy.uint8)]
+
+
+
+def unpack_epoch(packed):
+    """
+
+    Convert the packed epochs (e.g. K194R = 2019 Apr 27.0), an array of
+    5-character strings, to MJD.
+
+    """
+
+    chars = packed.view('S1').reshape((-1, 5))
+    year = unpack_digits(chars[:, 0]) * 100 + \
+           unpack_digits(chars[:, 1]) * 10 + unpack_digits(chars[:, 2])
+    month = unpack_digits(chars[:, 3])
+    day = unpack_digits(chars[:, 4])
+
+    # valid for all dates between 1900 and 2100
+    return 367 * year - (7 * (year + (month + 9) // 12)) // 4 \
+        + (275 * month) // 9 + day - 678987.
+
+
+
+def column_values(chars, columns, default=numpy.NaN):
+    """
+
+    Return the numbers in the given columns of all lines (chars is an array
+    of characters, one row per line); blank fields are set to default.
+
+    """
+
+    start, end = columns
+    field = chars[:, start:end].copy().view('S%d' % (end - start)).ravel()
+    field = numpy.char.strip(field)
+    blank = (field == b'')
+    field[blank] = b'0'
+    values = field.astype(numpy.float64)
+    values[blank] = default
+    return values
+
+
+
+def read_mpcorb(filename):
+    """
+
+    Read all orbital elements from an MPCORB-format file. Returns a dictionary
+    of arrays: designation, name, H, G, epoch (MJD), M, peri, node, incl
+    (degrees), e, n (degrees per day) and a (AU).
+
+    """
+
+    logger = logging.getLogger("Orbits")
+
+    with open(filename, "rb") as f:
+        lines = f.read().split(b'\n')
+
+    # Skip the header, if any; it ends with a line of dashes
+    for i, line in enumerate(lines[:100]):
+        if (line.startswith(b'-----')):
+            lines = lines[i+1:]
+            break
+
+    # Only keep lines with a complete set of elements
+    min_length = mpcorb_columns['a'][1]
+    lines = [line.rstrip(b'\r').ljust(mpcorb_line_length)[:mpcorb_line_length]
+             for line in lines if len(line.strip()) >= min_length]
+    chars = numpy.array(lines, dtype='S%d' % (mpcorb_line_length)).view('S1').reshape(
+        (-1, mpcorb_line_length))
+    logger.debug("Read %d orbits from %s" % (chars.shape[0], filename))
+
+    elements = {}
+    for key in ['H', 'M', 'peri', 'node', 'incl', 'e', 'n', 'a']:
+        elements[key] = column_values(chars, mpcorb_columns[key])
+    elements['G'] = column_values(chars, mpcorb_columns['G'], default=0.15)
+
+    start, end = mpcorb_columns['epoch']
+    elements['epoch'] = unpack_epoch(chars[:, start:end].copy().view('S%d' % (end - start)).ravel())
+
+    start, end = mpcorb_designation
+    designation = numpy.char.strip(chars[:, start:end].copy().view('S%d' % (end-start)).ravel())
+    start, end = mpcorb_name
+    name = numpy.char.strip(chars[:, start:end].copy().view('S%d' % (end-start)).ravel())
+    elements['designation'] = designation
+    elements['name'] = numpy.where(name == b'', designation, name)
+
+    return elements
+
+
+
+def load_elements(filename):
+    """
+
+    Return the orbital elements from filename, re-using the parsed elements
+    kept in <filename>.npz if the element file did not change since.
+
+    """
+
+    logger = logging.getLogger("Orbits")
+
+    stat = os.stat(filename)
+    stamp = numpy.array([stat.st_size, stat.st_mtime])
+    sidecar = filename + ".npz"
+
+    if (os.path.isfile(sidecar)):
+        try:
+            archive = numpy.load(sidecar)
+            if (numpy.all(archive['stamp'] == stamp)):
+                logger.debug("Using parsed orbital elements from %s" % (sidecar))
+                return dict([(key, archive[key]) for key in archive.files if not key == 'stamp'])
+        except Exception:
+            logger.debug("Unable to read %s, re-reading %s" % (sidecar, filename))
+
+    elements = read_mpcorb(filename)
+
+    def write_archive(fn):
+        with open(fn, "wb") as f:
+            numpy.savez(f, stamp=stamp, **elements)
+    try:
+        write_atomic(sidecar, write_archive)
+    except (IOError, OSError):
+        logger.warning("Unable to write %s" % (sidecar))
+
+    return elements
+
+
+
+def solve_kepler(M, e, tolerance=1e-12, max_iterations=50):
+    """
+
+    Solve Kepler's equation E - e sin(E) = M (radians) for all orbits.
+
+    """
+
+    E = numpy.where(e < 0.8, M, numpy.pi)
+    for i in range(max_iterations):
+        dE = (E - e * numpy.sin(E) - M) / (1. - e * numpy.cos(E))
+        E -= dE
+        if (numpy.all(numpy.fabs(dE) < tolerance)):
+            break
+    return E
+
+
+
+def orbit_state(a, e, incl, node, peri, M, n):
+    """
+
+    Heliocentric position (AU) and velocity (AU/day) in equatorial J2000
+    coordinates, from elliptic elements (degrees, n in degrees per day).
+    Returns two arrays with shape (3, number of orbits).
+
+    """
+
+    E = solve_kepler(numpy.radians(M), e)
+    cos_E, sin_E = numpy.cos(E), numpy.sin(E)
+    b = a * numpy.sqrt(1. - e**2)
+    dE_dt = numpy.radians(n) / (1. - e * cos_E)
+
+    # in the orbital plane
+    x, y = a * (cos_E - e), b * sin_E
+    vx, vy = -a * sin_E * dE_dt, b * cos_E * dE_dt
+
+    i, O, w = numpy.radians(incl), numpy.radians(node), numpy.radians(peri)
+    cos_O, sin_O = numpy.cos(O), numpy.sin(O)
+    cos_w, sin_w = numpy.cos(w), numpy.sin(w)
+    cos_i, sin_i = numpy.cos(i), numpy.sin(i)
+
+    # rotate into the ecliptic, then into the equator
+    px = cos_w * cos_O - sin_w * sin_O * cos_i
+    py = cos_w * sin_O + sin_w * cos_O * cos_i
+    pz = sin_w * sin_i
+    qx = -sin_w * cos_O - cos_w * sin_O * cos_i
+    qy = -sin_w * sin_O + cos_w * cos_O * cos_i
+    qz = cos_w * sin_i
+
+    cos_eps, sin_eps = math.cos(obliquity), math.sin(obliquity)
+    position = numpy.array([px * x + qx * y, py * x + qy * y, pz * x + qz * y])
+    velocity = numpy.array([px * vx + qx * vy, py * vx + qy * vy, pz * vx + qz * vy])
+    for vector in [position, velocity]:
+        y_ecl, z_ecl = vector[1].copy(), vector[2].copy()
+        vector[1] = cos_eps * y_ecl - sin_eps * z_ecl
+        vector[2] = sin_eps * y_ecl + cos_eps * z_ecl
+
+    return position, velocity
+
+
+
+def earth_state(mjd):
+    """
+
+    Heliocentric position and velocity of the Earth(-Moon barycenter), from
+    the approximate elements of Standish (valid 1800 - 2050).
+
+    """
+
+    T = (numpy.asarray(mjd, dtype=numpy.float64) - mjd_j2000) / 36525.
+    a = 1.00000261 + 0.00000562 * T
+    e = 0.01671123 - 0.00004392 * T
+    incl = -0.00001531 - 0.01294668 * T
+    L = 100.46457166 + 35999.37244981 * T
+    perihelion = 102.93768193 + 0.32327364 * T
+    node = 0. * T
+    n = 35999.37244981 / 36525.
+    return orbit_state(a, e, incl, node, perihelion - node,
+                       numpy.mod(L - perihelion, 360.), n)
+
+
+
+class ObjectTable(object):
+    """
+
+    Minimal stand-in for the SkyBoT VOTable; all columns are in .array.
+
+    """
+
+    def __init__(self, columns):
+        self.array = dict([(key, numpy.asarray(value)) for key, value in columns.items()])
+
+
+
+class OrbitCatalog(object):
+
+    def __init__(self, elements):
+
+        self.elements = elements
+        self.n_objects = elements['a'].shape[0]
+        self.index = None
+        self.logger = logging.getLogger("Orbits")
+
+        # Only elliptic orbits can be propagated
+        self.valid = numpy.isfinite(elements['a']) & (elements['e'] < 1.) & \
+                     numpy.isfinite(elements['n'])
+
+    @classmethod
+    def from_file(cls, filename):
+        return cls(load_elements(filename))
+
+    def propagate(self, mjd, select=None):
+        """
+
+        Compute geocentric positions (ra, dec in degrees), rates (dracosdec,
+        ddec in arcsec/hour), distances (delta and heliocentric r in AU) and
+        V magnitudes of all (or the selected) objects at mjd.
+
+        """
+
+        if (select is None):
+            select = numpy.nonzero(self.valid)[0]
+        el = dict([(key, self.elements[key][select]) for key in
+                   ['a', 'e', 'incl', 'node', 'peri', 'M', 'n', 'epoch', 'H', 'G']])
+
+        earth, earth_velocity = earth_state(mjd)
+        earth = earth.reshape((3, 1))
+        earth_velocity = earth_velocity.reshape((3, 1))
+
+        # Light-time correction: we see the object where it was when the
+        # light left it
+        light_time = 0.
+        for iteration in range(2):
+            dt = mjd - light_time - el['epoch']
+            position, velocity = orbit_state(el['a'], el['e'], el['incl'], el['node'], el['peri'],
+                                             numpy.mod(el['M'] + el['n'] * dt, 360.), el['n'])
+            rho = position - earth
+            delta = numpy.sqrt(numpy.sum(rho**2, axis=0))
+            light_time = delta / speed_of_light
+
+        x, y, z = rho
+        vx, vy, vz = velocity - earth_velocity
+        rxy2 = x**2 + y**2
+        rxy = numpy.sqrt(rxy2)
+        ra = numpy.degrees(numpy.arctan2(y, x)) % 360.
+        dec = numpy.degrees(numpy.arctan2(z, rxy))
+        dracosdec = (x * vy - y * vx) / rxy2 * (rxy / delta) * arcsec_per_hour
+        ddec = (vz * rxy2 - z * (x * vx + y * vy)) / (delta**2 * rxy) * arcsec_per_hour
+
+        # V magnitude from H and G
+        r = numpy.sqrt(numpy.sum(position**2, axis=0))
+        cos_phase = numpy.sum(position * rho, axis=0) / (r * delta)
+        tan_half_phase = numpy.tan(0.5 * numpy.arccos(numpy.clip(cos_phase, -1., 1.)))
+        phi1 = numpy.exp(-3.33 * tan_half_phase**0.63)
+        phi2 = numpy.exp(-1.87 * tan_half_phase**1.22)
+        mag = el['H'] + 5. * numpy.log10(r * delta) \
+              - 2.5 * numpy.log10((1. - el['G']) * phi1 + el['G'] * phi2)
+
+        return {
+            'index': select,
+            'ra': ra,
+            'dec': dec,
+            'dracosdec': dracosdec,
+            'ddec': ddec,
+            'delta': delta,
+            'r': r,
+            'mag': mag,
+        }
+
+    def build_index(self, mjd):
+        """
+
+        Create the spatial index of all slow objects at mjd.
+
+        """
+
+        pos = self.propagate(mjd)
+        rate = numpy.hypot(pos['dracosdec'], pos['ddec']) * 24. / 3600.
+        slow = (rate < index_rate_limit)
+
+        self.index = {
+            'mjd': mjd,
+            'slow': pos['index'][slow],
+            'fast': pos['index'][~slow],
+            'tree': scipy.spatial.cKDTree(unit_vectors(pos['ra'][slow], pos['dec'][slow])),
+        }
+        self.logger.debug("Indexed %d objects at MJD %.3f, %d fast objects" % (
+            numpy.sum(slow), mjd, numpy.sum(~slow)))
+
+    def candidates(self, mjd, ra, dec, radius):
+        """
+
+        Return all objects that might be within radius (degrees) of ra/dec
+        at mjd.
+
+        """
+
+        if (self.index is None or math.fabs(mjd - self.index['mjd']) > index_max_age):
+            self.build_index(mjd)
+
+        dt = math.fabs(mjd - self.index['mjd'])
+        search_radius = min(radius + 2. * index_rate_limit * dt + index_margin, 180.)
+        chord = 2. * math.sin(math.radians(search_radius) / 2.)
+        nearby = self.index['tree'].query_ball_point(unit_vectors(ra, dec)[0], r=chord)
+        return numpy.union1d(self.index['slow'][numpy.array(nearby, dtype=int)], self.index['fast'])
+
+    def objects_in_field(self, mjd, ra, dec, radius, limit=None):
+        """
+
+        Return all objects within radius (degrees) of ra/dec at mjd (and
+        brighter than limit, if given), closest to the center first.
+
+        """
+
+        pos = self.propagate(mjd, select=self.candidates(mjd, ra, dec, radius))
+        distance = angular_distance(ra, dec, pos['ra'], pos['dec'])
+        keep = (distance <= radius)
+        if (limit is not None):
+            keep &= ~(pos['mag'] > limit)
+        order = numpy.argsort(distance[keep])
+        for key in pos:
+            pos[key] = pos[key][keep][order]
+
+        names = [to_str(name) for name in self.elements['name'][pos['index']]]
+        return {
+            'Name': names,
+            'RA': numpy.array([format_sexagesimal(x / 15., False, modulo=24) for x in pos['ra']]),
+            'DEC': numpy.array([format_sexagesimal(x, True) for x in pos['dec']]),
+            'dracosdec': pos['dracosdec'],
+            'ddec': pos['ddec'],
+            'comment': ["V=%.1f" % (m) for m in pos['mag']],
+            'ra_deg': pos['ra'],
+            'dec_deg': pos['dec'],
+            'mag': pos['mag'],
+            'delta': pos['delta'],
+        }
+
+
+
+def to_str(name):
+    if (isinstance(name, bytes) and not isinstance(name, str)):
+        return name.decode('ascii', 'replace')
+    return str(name)
+
+
+
+def unit_vectors(ra, dec):
+    ra = numpy.radians(numpy.atleast_1d(ra))
+    dec = numpy.radians(numpy.atleast_1d(dec))
+    return numpy.array([numpy.cos(dec) * numpy.cos(ra),
+                        numpy.cos(dec) * numpy.sin(ra),
+                        numpy.sin(dec)]).T
+
+
+
+def angular_distance(ra1, dec1, ra2, dec2):
+    """
+
+    Angular distance in degrees (haversine formula).
+
+    """
+
+    ra1, dec1, ra2, dec2 = [numpy.radians(x) for x in [ra1, dec1, ra2, dec2]]
+    h = numpy.sin((dec2 - dec1) / 2.)**2 + \
+        numpy.cos(dec1) * numpy.cos(dec2) * numpy.sin((ra2 - ra1) / 2.)**2
+    return numpy.degrees(2. * numpy.arcsin(numpy.sqrt(numpy.clip(h, 0., 1.))))
+
+
+
+def format_sexagesimal(value, print_sign=True, modulo=None):
+    """
+
+    Format as "dd mm ss.s" (like the MPC checker), rounding to 0.1 seconds;
+    values are wrapped at modulo (e.g. 24 hours), if given.
+
+    """
+
+    sign = "-" if value < 0 else ("+" if print_sign else "")
+    tenths = int(round(math.fabs(value) * 36000.))
+    if (modulo is not None):
+        tenths %= int(modulo * 36000)
+    degrees, rest = divmod(tenths, 36000)
+    minutes, tenths = divmod(rest, 600)
+    return "%s%02d %02d %04.1f" % (sign, degrees, minutes, tenths / 10.)
+
+
+
+def get_orbit_catalog(filename=None):
+    """
+
+    Return the orbit catalog for filename (default: mpcorb_file), reading
+    the elements only once per process.
+
+    """
+
+    global _orbit_catalog
+
+    if (filename is None):
+        filename = mpcorb_file
+    if (_orbit_catalog is None or not _orbit_catalog[0] == filename):
+        _orbit_catalog = (filename, OrbitCatalog.from_file(filename))
+    return _orbit_catalog[1]
+
+
+
+def known_objects(mjd, ra, dec, radius, limit=None, filename=None):
+    """
+
+    Return all known objects within radius (degrees) of ra/dec at mjd, see
+    OrbitCatalog.objects_in_field.
+
+    """
+
+    return get_orbit_catalog(filename).objects_in_field(mjd, ra, dec, radius, limit=limit)
@@ -0,0 +1,291 @@
+#
+# Copyright (C) 2014, Ralf Kotulla
+#                     kotulla@uwm.edu
+#
+# All rights reserved
+#
+
+"""
+
+One long-lived pool of worker processes, shared by all stages of a run
+(source catalogs, catalog loading, tracklet search, plotting, ...), instead
+of starting and stopping a new set of processes for each stage.
+
+Usage:
+
+  pool = podi_workerpool.get_pool()
+  result = pool.submit(function, arg1, arg2, keyword=value)
+  ...
+  value = result.get()          # re-raises any exception from the worker
+  values = pool.map(function, list_of_args)
+
+All functions and arguments need to be picklable, i.e. functions have to be
+defined at module level. Data that all tasks of a stage need (e.g. a spatial
+index built from a catalog store) can be created once per worker with
+worker_state() instead of sending it along with every task. This data
+outlives the stage that created it, so a stage should drop it when it is done
+(e.g. to release memory-mapped files that are about to be deleted):
+
+  pool.broadcast(podi_workerpool.release_state, name)
+
+The pool is created on first use and shut down at exit (or with
+shutdown()). Processes forked after the pool was created (and worker
+processes themselves, which cannot have children of their own) do not use
+the parent's pool: a forked process gets its own pool, and a worker runs
+all tasks it submits itself right away.
+
+"""
+
+import os
+import time
+import atexit
+import logging
+import importlib
+import multiprocessing
+
+import podi_sitesetup as sitesetup
+
+#
+# Modules imported by each worker before it runs its first task. These are
+# imported in the main process first, so forked workers share them.
+#
+preload_modules = [
+    'numpy',
+    'scipy.spatial',
+    'astropy.io.fits',
+]
+
+# Seconds a worker waits for the others to pick up their broadcast task
+broadcast_timeout = 60.
+
+_pool = None
+_worker_state = {}
+_broadcast_counter = None
+
+
+
+def init_worker(modules, broadcast_counter=None):
+    global _broadcast_counter
+    _broadcast_counter = broadcast_counter
+    for module in modules:
+        try:
+            importlib.import_module(module)
+        except ImportError:
+            pass
+
+
+
+def worker_state(name, key, factory):
+    """
+
+    Return the data for name in this worker, creating it with factory() if
+    the worker does not have it yet, or has it for a different key (e.g.
+    from an earlier stage). Only the most recent key is kept for each name.
+
+    """
+
+    if (name in _worker_state and _worker_state[name][0] == key):
+        return _worker_state[name][1]
+
+    # release the old data first
+    _worker_state.pop(name, None)
+    data = factory()
+    _worker_state[name] = (key, data)
+    return data
+
+
+
+def release_state(name):
+    """
+
+    Drop the data stored for name in this process (see worker_state).
+
+    """
+
+    _worker_state.pop(name, None)
+
+
+
+def broadcast_task(func, args, target):
+    """
+
+    Run func(*args), then block until target broadcast tasks have started, so
+    every worker picks up exactly one task of the broadcast. Returns False if
+    the other workers did not show up within broadcast_timeout.
+
+    """
+
+    func(*args)
+
+    if (_broadcast_counter is None):
+        return True
+    with _broadcast_counter.get_lock():
+        _broadcast_counter.value += 1
+    timeout = time.time() + broadcast_timeout
+    while (_broadcast_counter.value < target):
+        if (time.time() > timeout):
+            return False
+        time.sleep(0.01)
+    return True
+
+
+
+class SerialResult(object):
+    """
+
+    Result of a task that ran right away, with the same interface as the
+    results returned by a multiprocessing pool.
+
+    """
+
+    def __init__(self, func, args, kwargs):
+        self.value = None
+        self.error = None
+        try:
+            self.value = func(*args, **kwargs)
+        except Exception as e:
+            self.error = e
+
+    def ready(self):
+        return True
+
+    def successful(self):
+        return (self.error is None)
+
+    def wait(self, timeout=None):
+        return
+
+    def get(self, timeout=None):
+        if (self.error is not None):
+            raise self.error
+        return self.value
+
+
+
+class WorkerPool(object):
+
+    def __init__(self, n_processes=None, modules=None, serial=False):
+
+        self.n_processes = sitesetup.number_cpus if n_processes is None else n_processes
+        self.modules = preload_modules if modules is None else modules
+        self.pid = os.getpid()
+        self.logger = logging.getLogger("WorkerPool")
+
+        self.pool = None
+        self.broadcast_counter = None
+        self.n_broadcast = 0
+        if (not serial):
+            init_worker(self.modules)
+            self.broadcast_counter = multiprocessing.Value('i', 0)
+            self.start()
+
+    def start(self):
+        self.pool = multiprocessing.Pool(processes=self.n_processes,
+                                         initializer=init_worker,
+                                         initargs=(self.modules, self.broadcast_counter))
+        self.logger.debug("Started %d worker processes" % (self.n_processes))
+
+    def submit(self, func, *args, **kwargs):
+        """
+
+        Run func(*args, **kwargs) in one of the workers. Returns the pending
+        result, call its get() method to wait for and return the result.
+
+        """
+
+        callback = kwargs.pop('callback', None)
+        if (self.pool is None):
+            result = SerialResult(func, args, kwargs)
+            if (callback is not None and result.successful()):
+                callback(result.value)
+            return result
+        return self.pool.apply_async(func, args, kwargs, callback=callback)
+
+    def map(self, func, iterable, chunksize=None):
+        """
+
+        Return [func(item) for item in iterable], computed by the workers.
+
+        """
+
+        if (self.pool is None):
+            return [func(item) for item in iterable]
+        return self.pool.map(func, iterable, chunksize)
+
+    def broadcast(self, func, *args):
+        """
+
+        Run func(*args) once in each of the workers (or right away, in a
+        serial pool), and wait until all are done. Only use this when no other
+        tasks are pending, as the workers wait for each other.
+
+        If some worker was still busy and did not get its task in time, all
+        workers are restarted instead, so none of them is left out (e.g. still
+        holding on to data that func should have released).
+
+        """
+
+        if (self.pool is None):
+            func(*args)
+            return
+
+        self.n_broadcast += self.n_processes
+        pending = [self.pool.apply_async(broadcast_task, (func, args, self.n_broadcast))
+                   for i in range(self.n_processes)]
+        complete = True
+        for result in pending:
+            complete = result.get() and complete
+
+        if (not complete):
+            self.logger.error("Not all workers ran %s within %g s, restarting all workers" % (
+                getattr(func, '__name__', str(func)), broadcast_timeout))
+            self.pool.close()
+            self.pool.join()
+            self.start()
+
+    def close(self):
+        if (self.pool is not None and self.pid == os.getpid()):
+            self.pool.close()
+            self.pool.join()
+            self.logger.debug("All worker processes stopped")
+        self.pool = None
+
+
+
+def get_pool(n_processes=None):
+    """
+
+    Return the pool shared by all stages of this process, creating it if
+    necessary. n_processes is only used when the pool is created.
+
+    """
+
+    global _pool
+
+    if (_pool is not None and _pool.pid == os.getpid()):
+        return _pool
+
+    # Forked processes can not use the pool of their parent
+    _pool = None
+    serial = multiprocessing.current_process().daemon
+    _pool = WorkerPool(n_processes=n_processes, serial=serial)
+    return _pool
+
+
+
+def shutdown():
+    """
+
+    Stop the workers of the shared pool, after all submitted tasks are done.
+
+    """
+
+    global _pool
+
+    if (_pool is not None):
+        _pool.close()
+    _pool = None
+
+
+
+atexit.register(shutdown)